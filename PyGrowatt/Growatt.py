@@ -7,6 +7,8 @@ import struct
 
 from pymodbus.pdu import ModbusRequest, ModbusResponse
 
+from PyGrowatt.growatt_schema import Field, LazySchema, MessageSchema
+
 log = logging.getLogger()
 
 configDescription = {
@@ -34,56 +36,141 @@ configDescription = {
     0x39: "WiFi PSK"
 }
 
-inputRegisters = {
-    # "wifi_serial" = ,
-    # "inverter_serial" = ,
-    # "year": ,
-    # "month": ,
-    # "day": ,
-    # "hour": ,
-    # "min": ,
-    # "sec": ,
-    "inverter_status": 0,
-    "Ppv": 1,
-    "Vpv1": 3,
-    "Ipv1": 4,
-    "Ppv1": 5,
-    "Vpv2": 7,
-    "Ipv2": 8,
-    "Ppv2": 9,
-    "Pac": 11,
-    "Fac": 13,
-    "Vac1": 14,
-    "Iac1": 15,
-    "Pac1": 16,
-    # "Vac_RS": ,
-    "Eac_today": 26,
-    "Eac_total": 27,
-    "Epv_total": 28,
-    "Epv1_today": 48,
-    "Epv1_total": 50,
-    "Epv2_today": 52,
-    "Epv2_total": 54,
+# The inverter settings that are set from the config file, by config id
+configOptions = {
+    0x04: ("Growatt", "UpdateInterval"),
+    0x11: ("Growatt", "ServerIP"),
 }
 
-holdingRegisters = {
-    "wifi_serial": 0,
-    "device_serial": 30,
-    "active_rate": 77,
-    "reactive_rate": 79,
-    "power_factor": 81,
-    "p_max": 83,
-    "v_normal": 87,
-    "fw_version": 89,
-    "control_fw_version": 95,
-    "device_type": 139,
-    "year": 161,
-    "month": 163,
-    "day": 165,
-    "hour": 167,
-    "min": 169,
-    "sec": 171,
-}
+# --------------------------------------------------------------------------- #
+# Message layouts
+#   Offsets are into the decrypted payload (after the function code). Fields
+#   with a register are stored in the datastore by the request's execute().
+# --------------------------------------------------------------------------- #
+energySchema = MessageSchema([
+    Field("wifi_serial", 0, "10s"),
+    Field("inverter_serial", 30, "10s"),
+    Field("year", 60, "B"),
+    Field("month", 61, "B"),
+    Field("day", 62, "B"),
+    Field("hour", 63, "B"),
+    Field("min", 64, "B"),
+    Field("sec", 65, "B"),
+    Field("inverter_status", 71, "H", register=0),
+    Field("Ppv", 73, "I", scale=10, register=1),
+    Field("Vpv1", 77, "H", scale=10, register=3),
+    Field("Ipv1", 79, "H", scale=10, register=4),
+    Field("Ppv1", 81, "I", scale=10, register=5),
+    Field("Vpv2", 85, "H", scale=10, register=7),
+    Field("Ipv2", 87, "H", scale=10, register=8),
+    Field("Ppv2", 89, "I", scale=10, register=9),
+    Field("Pac", 117, "I", scale=10, register=11),
+    Field("Fac", 121, "H", scale=100, register=13),
+    Field("Vac1", 123, "H", scale=10, register=14),
+    Field("Iac1", 125, "H", scale=10, register=15),
+    Field("Pac1", 127, "I", scale=10, register=16),
+    Field("Vac_RS", 147, "H", scale=10),
+    Field("Eac_today", 169, "I", scale=10, register=26),
+    Field("Eac_total", 173, "I", scale=10, register=27),
+    Field("Epv_total", 177, "I", scale=10, register=28),
+    Field("Epv1_today", 181, "I", scale=10, register=48),
+    Field("Epv1_total", 185, "I", scale=10, register=50),
+    Field("Epv2_today", 189, "I", scale=10, register=52),
+    Field("Epv2_total", 193, "I", scale=10, register=54),
+])
+
+# Buffered records have Eac_total where live records have Epv_total
+bufferedEnergySchema = MessageSchema([
+    Field("wifi_serial", 0, "10s"),
+    Field("inverter_serial", 30, "10s"),
+    Field("year", 60, "B"),
+    Field("month", 61, "B"),
+    Field("day", 62, "B"),
+    Field("hour", 63, "B"),
+    Field("min", 64, "B"),
+    Field("sec", 65, "B"),
+    Field("inverter_status", 71, "H"),
+    Field("Ppv", 73, "I", scale=10, register=1),
+    Field("Vpv1", 77, "H", scale=10, register=3),
+    Field("Ipv1", 79, "H", scale=10, register=4),
+    Field("Ppv1", 81, "I", scale=10, register=5),
+    Field("Vpv2", 85, "H", scale=10, register=7),
+    Field("Ipv2", 87, "H", scale=10, register=8),
+    Field("Ppv2", 89, "I", scale=10, register=9),
+    Field("Pac", 117, "I", scale=10, register=11),
+    Field("Fac", 121, "H", scale=100, register=13),
+    Field("Vac1", 123, "H", scale=10, register=14),
+    Field("Iac1", 125, "H", scale=10, register=15),
+    Field("Pac1", 127, "I", scale=10, register=16),
+    Field("Vac_RS", 147, "H", scale=10),
+    Field("Eac_today", 169, "I", scale=10, register=26),
+    Field("Eac_total", 177, "I", scale=10, register=27),
+    Field("Epv1_today", 181, "I", scale=10, register=48),
+    Field("Epv1_total", 185, "I", scale=10, register=50),
+    Field("Epv2_today", 189, "I", scale=10, register=52),
+    Field("Epv2_total", 193, "I", scale=10, register=54),
+])
+
+announceSchema = MessageSchema([
+    Field("wifi_serial", 0, "10s", register=0),
+    Field("device_serial", 30, "10s", register=30),
+    Field("active_rate", 77, "H", register=77),
+    Field("reactive_rate", 79, "H", register=79),
+    Field("power_factor", 81, "H", register=81),
+    Field("p_max", 83, "I", register=83),
+    Field("v_normal", 87, "H", register=87),
+    Field("fw_version", 89, "6s", register=89),
+    Field("control_fw_version", 95, "6s", register=95),
+    Field("device_type", 139, "16s", register=139),
+    Field("year", 161, "H", register=161),
+    Field("month", 163, "H", register=163),
+    Field("day", 165, "H", register=165),
+    Field("hour", 167, "H", register=167),
+    Field("min", 169, "H", register=169),
+    Field("sec", 171, "H", register=171),
+])
+
+pingSchema = MessageSchema([
+    Field("wifi_serial", 0, "10s"),
+])
+
+pingResponseSchema = MessageSchema([
+    Field("wifi_serial", 0, "30s"),
+])
+
+configSchema = MessageSchema([
+    Field("wifi_serial", 0, "10s"),
+    Field("config_id", 30, "H"),
+])
+
+configValueSchema = MessageSchema([
+    Field("wifi_serial", 0, "10s"),
+    Field("config_id", 30, "H"),
+    Field("config_length", 32, "H"),
+])
+
+configResponseSchema = MessageSchema([
+    Field("wifi_serial", 0, "30s"),
+    Field("config_id", 30, "H"),
+    Field("config_length", 32, "H"),
+])
+
+queryResponseSchema = MessageSchema([
+    Field("wifi_serial", 0, "30s"),
+    Field("first_config", 30, "H"),
+])
+
+queryRangeSchema = MessageSchema([
+    Field("wifi_serial", 0, "10s"),
+    Field("first_config", 30, "H"),
+    Field("last_config", 32, "H"),
+])
+
+_last_config = struct.Struct(">H")
+
+inputRegisters = energySchema.registers()
+
+holdingRegisters = announceSchema.registers()
 
 inverter_status_description = {
     0: "Waiting",
@@ -92,10 +179,94 @@ inverter_status_description = {
 }
 
 
+def log_energy(message):
+    """ Logs the values of an energy request at debug level
+
+    The arguments are formatted (and lazy fields decoded) here, so callers
+    should only call this once they know debug logging is enabled.
+
+    :param message: The decoded GrowattEnergyRequest or GrowattBufferedEnergyRequest
+    """
+    log.debug("\
+[[[%s-%s-%s_%s:%s:%s]]]\
+Ppv: %.1f, \
+Vpv1: %.1f, Ipv1: %.1f, Ppv1: %.1f, \
+Vpv2: %.1f, Ipv2: %.1f, Ppv2: %.1f, \
+Eac_today: %.1f (%s), \
+Eac_total: %.1f (%s), \
+Epv1_today: %.1f, Epv1_total: %.1f \
+Epv2_today: %.1f, Epv2_total: %.1f ",
+              message.year, message.month, message.day, message.hour, message.min, message.sec,
+              float(message.Ppv) / 10,
+              float(message.Vpv1) / 10, float(message.Ipv1) / 10, float(message.Ppv1) / 10,
+              float(message.Vpv2) / 10, float(message.Ipv2) / 10, float(message.Ppv2) / 10,
+              float(message.Eac_today) / 10, hex(message.Eac_today),
+              float(message.Eac_total) / 10, hex(message.Eac_total),
+              float(message.Epv1_today) / 10, float(message.Epv1_total) / 10,
+              float(message.Epv2_today) / 10, float(message.Epv2_total) / 10
+              )
+
+
+def config_change(config, config_id, current):
+    """ Compares an inverter setting with the config file
+
+    :param config: The GrowattConfig with the inverter settings
+    :param config_id: The config id of the setting
+    :param current: The inverter's value, as bytes
+    :returns: The value from the config file if it differs, otherwise None
+    """
+    option = configOptions.get(config_id)
+    if option is None:
+        return None
+    value = config.get(*option)
+    if value is None:
+        # Settings that are not in the config are left as they are
+        log.debug("%s is not set in the config", option[1])
+        return None
+    if current.rstrip(b'\x00').decode('ascii', 'replace') != value:
+        return value
+    return None
+
+
+def restore_config(context, wifi_serial):
+    """ Restores an inverter's config values from the config cache of a datastore
+
+    :param context: The IModbusSlaveContext of the inverter
+    :param wifi_serial: The serial number of the ShineWiFi-X module
+    :returns: True if the values were restored, False if the inverter has to be queried
+    """
+    cache = getattr(context, 'config_cache', None)
+    values = cache.get(wifi_serial) if cache is not None else None
+    if not values:
+        return False
+
+    # Settings are only pushed to the inverter in reply to a query, so query it if one has to change
+    config = getattr(context, 'config', None)
+    if config is not None and any(config_change(config, config_id, values.get(config_id, b''))
+                                  for config_id in configOptions):
+        return False
+
+    for config_id, value in values.items():
+        context.setValues(GrowattQueryRequest.function_code, config_id, [value])
+    log.info("Restored %d config values of %s from the cache", len(values), wifi_serial)
+    return True
+
+
 class GrowattResponse(ModbusResponse):
     def __init__(self, protocol=6, **kwargs):
         ModbusResponse.__init__(self, protocol=protocol, **kwargs)
 
+    def cache_key(self):
+        """ Identifies the encoded payload, so the framer can reuse the frame
+
+        Responses with the same function code and key must encode to the same
+        payload, the framer then only patches the transaction id of a cached
+        frame rather than building it again.
+
+        :returns: A hashable key, or None if the response must be encoded every time
+        """
+        return None
+
 
 class GrowattRequest(ModbusRequest):
     def __init__(self, protocol=6, **kwargs):
@@ -110,6 +281,10 @@ class GrowattAnnounceResponse(GrowattResponse):
         self.wifi_serial = kwargs.get('wifi_serial', [])
         self.inverter_serial = kwargs.get('inverter_serial', [])
 
+    def cache_key(self):
+        # The ACK is the same for every inverter
+        return ()
+
     def encode(self):
         """ ACK the Announce Request
 
@@ -160,34 +335,13 @@ class GrowattAnnounceRequest(GrowattRequest):
 
     def decode(self, data):
         # Unpack the (known) data
-        self.wifi_serial = struct.unpack_from('>10s', data, 0)[0]
-        self.device_serial = struct.unpack_from('>10s', data, 30)[0]
-        self.active_rate, self.reactive_rate, self.power_factor = struct.unpack_from('>3H', data, 77)
-        self.p_max, self.v_normal = struct.unpack_from('>IH', data, 83)
-        self.fw_version, self.control_fw_version = struct.unpack_from('>6s6s', data, 89)
-        self.device_type = struct.unpack_from('>16s', data, 139)[0]
-        self.year, self.month, self.day, self.hour, self.min, self.sec = struct.unpack_from(">6H", data, 161)
+        announceSchema.decode_into(self, data)
         log.debug("GrowattAnnounceRequest from %s: Device ID: %s, Device Type: %s", self.wifi_serial,
                   self.device_serial, self.device_type)
         return
 
     def execute(self, context):
-        context.setValues(self.function_code, holdingRegisters["wifi_serial"], [self.wifi_serial])
-        context.setValues(self.function_code, holdingRegisters["device_serial"], [self.device_serial])
-        context.setValues(self.function_code, holdingRegisters["active_rate"], [self.active_rate])
-        context.setValues(self.function_code, holdingRegisters["reactive_rate"], [self.reactive_rate])
-        context.setValues(self.function_code, holdingRegisters["power_factor"], [self.power_factor])
-        context.setValues(self.function_code, holdingRegisters["p_max"], [self.p_max])
-        context.setValues(self.function_code, holdingRegisters["v_normal"], [self.v_normal])
-        context.setValues(self.function_code, holdingRegisters["fw_version"], [self.fw_version])
-        context.setValues(self.function_code, holdingRegisters["control_fw_version"], [self.control_fw_version])
-        context.setValues(self.function_code, holdingRegisters["device_type"], [self.device_type])
-        context.setValues(self.function_code, holdingRegisters["year"], [self.year])
-        context.setValues(self.function_code, holdingRegisters["month"], [self.month])
-        context.setValues(self.function_code, holdingRegisters["day"], [self.day])
-        context.setValues(self.function_code, holdingRegisters["hour"], [self.hour])
-        context.setValues(self.function_code, holdingRegisters["min"], [self.min])
-        context.setValues(self.function_code, holdingRegisters["sec"], [self.sec])
+        announceSchema.execute(self, context, self.function_code)
 
         # Check inverter time is within 60 seconds of local time
         inverter_time = time.strptime("{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}".format(self.year, self.month,
@@ -209,6 +363,10 @@ class GrowattEnergyResponse(GrowattResponse):
     def __init__(self, **kwargs):
         GrowattResponse.__init__(self, **kwargs)
 
+    def cache_key(self):
+        # The ACK is the same for every inverter
+        return ()
+
     def encode(self):
         """ ACK the Energy message
 
@@ -231,6 +389,9 @@ class GrowattEnergyResponse(GrowattResponse):
 class GrowattEnergyRequest(GrowattRequest):
     function_code = 0x04
 
+    # Only decode the header (serials and timestamp) up front, the other fields are decoded when first read
+    lazy = True
+
     def __init__(self, **kwargs):
         GrowattRequest.__init__(self, **kwargs)
         self.wifi_serial = []
@@ -241,27 +402,6 @@ class GrowattEnergyRequest(GrowattRequest):
         self.hour = 0
         self.min = 0
         self.sec = 0
-        self.inverter_status = 0
-        self.Ppv = 0
-        self.Vpv1 = 0
-        self.Ipv1 = 0
-        self.Ppv1 = 0
-        self.Vpv2 = 0
-        self.Ipv2 = 0
-        self.Ppv2 = 0
-        self.Pac = 0
-        self.Fac = 0
-        self.Vac1 = 0
-        self.Iac1 = 0
-        self.Pac1 = 0
-        self.Vac_RS = 0
-        self.Eac_today = 0
-        self.Eac_total = 0
-        self.Epv_total = 0
-        self.Epv1_today = 0
-        self.Epv1_total = 0
-        self.Epv2_today = 0
-        self.Epv2_total = 0
 
     def encode(self):
         log.debug("Not implemented (doing nothing)")
@@ -270,44 +410,16 @@ class GrowattEnergyRequest(GrowattRequest):
     def decode(self, data):
         # Unpack the data.
         try:
-            self.wifi_serial = struct.unpack_from(">10s", data, 0)[0]
-            self.inverter_serial = struct.unpack_from(">10s", data, 30)[0]
-            self.year, self.month, self.day = struct.unpack_from(">3B", data, 60)
-            self.hour, self.min, self.sec = struct.unpack_from(">3B", data, 63)
-            self.inverter_status = struct.unpack_from(">H", data, 71)[0]
-            self.Ppv = struct.unpack_from(">I", data, 73)[0]
-            self.Vpv1, self.Ipv1, self.Ppv1 = struct.unpack_from(">HHI", data, 77)
-            self.Vpv2, self.Ipv2, self.Ppv2 = struct.unpack_from(">HHI", data, 85)
-            self.Pac, self.Fac = struct.unpack_from(">IH", data, 117)
-            self.Vac1, self.Iac1, self.Pac1 = struct.unpack_from(">HHI", data, 123)
-            self.Vac_RS = struct.unpack_from(">H", data, 147)[0]
-            self.Eac_today, self.Eac_total, self.Epv_total = struct.unpack_from(">3I", data, 169)
-            self.Epv1_today, self.Epv1_total = struct.unpack_from(">II", data, 181)
-            self.Epv2_today, self.Epv2_total = struct.unpack_from(">II", data, 189)
-
-            log.debug("\
-[[[%s-%s-%s_%s:%s:%s]]]\
-Ppv: %.1f, \
-Vpv1: %.1f, Ipv1: %.1f, Ppv1: %.1f, \
-Vpv2: %.1f, Ipv2: %.1f, Ppv2: %.1f, \
-Eac_today: %.1f (%s), \
-Eac_total: %.1f (%s), \
-Epv1_today: %.1f, Epv1_total: %.1f \
-Epv2_today: %.1f, Epv2_total: %.1f ",
-                      self.year, self.month, self.day, self.hour, self.min, self.sec,
-                      float(self.Ppv) / 10,
-                      float(self.Vpv1) / 10, float(self.Ipv1) / 10, float(self.Ppv1) / 10,
-                      float(self.Vpv2) / 10, float(self.Ipv2) / 10, float(self.Ppv2) / 10,
-                      float(self.Eac_today) / 10, hex(self.Eac_today),
-                      float(self.Eac_total) / 10, hex(self.Eac_total),
-                      float(self.Epv1_today) / 10, float(self.Epv1_total) / 10,
-                      float(self.Epv2_today) / 10, float(self.Epv2_total) / 10
-                      )
-
+            if self.lazy:
+                lazyEnergySchema.decode_into(self, data)
+            else:
+                energySchema.decode_into(self, data)
         except Exception as e:
             log.error("Could not decode GrowattEnergyRequest - %s", repr(e))
             return
 
+        if log.isEnabledFor(logging.DEBUG):
+            log_energy(self)
         return
 
     def execute(self, context):
@@ -317,20 +429,27 @@ Epv2_today: %.1f, Epv2_total: %.1f ",
         :return: A GrowattBufferedEnergyResponse to send back to the client
         """
 
-        context.setValues(self.function_code, inputRegisters["inverter_status"], [self.inverter_status])
-        context.setValues(self.function_code, inputRegisters["Ppv"], [self.Ppv])
-        context.setValues(self.function_code, inputRegisters["Vpv1"], [self.Vpv1, self.Ipv1, self.Ppv1])
-        context.setValues(self.function_code, inputRegisters["Vpv2"], [self.Vpv2, self.Ipv2, self.Ppv2])
-        context.setValues(self.function_code, inputRegisters["Pac"], [self.Pac])
-        context.setValues(self.function_code, inputRegisters["Fac"], [self.Fac])
-        context.setValues(self.function_code, inputRegisters["Vac1"], [self.Vac1, self.Iac1, self.Pac1])
-        context.setValues(self.function_code, inputRegisters["Eac_today"], [self.Eac_today])
-        context.setValues(self.function_code, inputRegisters["Eac_total"], [self.Eac_total])
-        context.setValues(self.function_code, inputRegisters["Epv_total"], [self.Epv_total])
-        context.setValues(self.function_code, inputRegisters["Epv1_today"], [self.Epv1_today])
-        context.setValues(self.function_code, inputRegisters["Epv1_total"], [self.Epv1_total])
-        context.setValues(self.function_code, inputRegisters["Epv2_today"], [self.Epv2_today])
-        context.setValues(self.function_code, inputRegisters["Epv2_total"], [self.Epv2_total])
+        # Swap in the whole frame at once if the datastore keeps snapshots, so a reader never sees half of it
+        snapshots = getattr(context, 'snapshots', None)
+        if snapshots is not None:
+            snapshot = snapshots.update(self)
+            # Without a WiFi serial the frame can't be told apart from those of other inverters
+            key = self.wifi_serial if isinstance(self.wifi_serial, bytes) and self.wifi_serial else None
+            # Replace the inverter's previous values in the running fleet totals, if the datastore keeps them
+            aggregates = getattr(context, 'aggregates', None)
+            if aggregates is not None and key is not None:
+                aggregates.update(key, snapshot)
+            # Hand the snapshot to the publishers, if the datastore has a pipeline. This never waits for them
+            pipeline = getattr(context, 'pipeline', None)
+            if pipeline is not None:
+                pipeline.submit(key, snapshot)
+        else:
+            energySchema.execute(self, context, self.function_code)
+
+        # Keep every sample, not just the latest, if the datastore has a history
+        history = getattr(context, 'history', None)
+        if history is not None:
+            history.append(self)
 
         return GrowattEnergyResponse()
 
@@ -342,12 +461,16 @@ class GrowattPingResponse(GrowattResponse):
         GrowattResponse.__init__(self, **kwargs)
         self.wifi_serial = kwargs.get('wifi_serial', [])
 
+    def cache_key(self):
+        # The reply echoes the serial, so it is the same for every ping from one datalogger
+        return self.wifi_serial if isinstance(self.wifi_serial, bytes) else None
+
     def encode(self):
         """ Encodes response pdu
 
         :returns: The encoded packet message
         """
-        return struct.pack(">30s", self.wifi_serial)
+        return pingResponseSchema.pack(self)
 
     def decode(self, data):
         """ Decodes response pdu
@@ -371,14 +494,14 @@ class GrowattPingRequest(GrowattRequest):
         # return struct.pack('>HH', self.address, self.count)
 
     def decode(self, data):
-        self.wifi_serial = struct.unpack_from('>10s', data, 0)[0]
+        pingSchema.decode_into(self, data)
         log.debug("GrowattPingRequest from '%s'", self.wifi_serial)
         return
 
     def execute(self, context):
-        # If we haven't received the date/time, request all config values.
+        # If we haven't received the date/time, request all config values (unless they are in the config cache)
         inverter_date = context.getValues(0x19, 0x1F)[0]
-        if inverter_date == 0:
+        if inverter_date == 0 and not restore_config(context, self.wifi_serial):
             # This will not send an ACK for the Ping, but that shouldn't cause any issues
             return GrowattQueryResponse(wifi_serial=self.wifi_serial, first_config=0x01, last_config=0x1F)
 
@@ -400,13 +523,8 @@ class GrowattConfigResponse(GrowattResponse):
 
         :returns: The encoded packet message
         """
-        data = struct.pack(">30sHH" + str(self.config_length) + "s",
-                           self.wifi_serial,
-                           self.config_id,
-                           self.config_length,
-                           self.config_value.encode('UTF-8'))
-
-        return data
+        value = self.config_value.encode('UTF-8')[:self.config_length]
+        return configResponseSchema.pack(self) + value.ljust(self.config_length, b'\x00')
 
     def decode(self, data):
         """ Decodes response pdu
@@ -432,13 +550,12 @@ class GrowattConfigRequest(GrowattRequest):
         return
 
     def decode(self, data):
-        self.wifi_serial = struct.unpack_from('>10s', data, 0)[0]
-        self.config_id = struct.unpack_from('>H', data, 30)[0]
-
         # An ACK will have a single 0x00 byte after the configID, otherwise it has the length and value
         if len(data) > 34:
-            self.config_length = struct.unpack_from('>H', data, 32)[0]
-            self.config_value = struct.unpack_from('>' + str(self.config_length) + 's', data, 34)[0]
+            configValueSchema.decode_into(self, data)
+            self.config_value = bytes(data[34:34 + self.config_length])
+        else:
+            configSchema.decode_into(self, data)
 
         return
 
@@ -460,23 +577,19 @@ class GrowattQueryResponse(GrowattResponse):
 
         :returns: The packet data to send
         """
-        data = struct.pack(">30sH", self.wifi_serial, self.first_config)
+        data = queryResponseSchema.pack(self)
 
         # If this is an ACK, send a 0x00 payload
         if self.last_config is None:
-            data += struct.pack("x")
-        else:
-            data += struct.pack(">H", self.last_config)
-
-        return data
+            return data + b'\x00'
+        return data + _last_config.pack(self.last_config)
 
     def decode(self, data):
         """ Decodes response pdu
 
         :param data: The packet data to decode
         """
-        self.wifi_serial = struct.unpack_from(">10s", data, 0)[0]
-        self.first_config, self.last_config = struct.unpack_from(">2H", data, 30)
+        queryRangeSchema.decode_into(self, data)
 
 
 class GrowattQueryRequest(GrowattRequest):
@@ -494,9 +607,8 @@ class GrowattQueryRequest(GrowattRequest):
         return
 
     def decode(self, data):
-        self.wifi_serial = struct.unpack_from('>10s', data, 0)[0]
-        self.config_id, self.config_length = struct.unpack_from('>HH', data, 30)
-        self.config_value = struct.unpack_from(">" + str(self.config_length) + "s", data, 34)[0]
+        configValueSchema.decode_into(self, data)
+        self.config_value = bytes(data[34:34 + self.config_length])
         return
 
     def execute(self, context):
@@ -506,25 +618,18 @@ class GrowattQueryRequest(GrowattRequest):
         except KeyError:
             log.info("Set UNKNOWN (0x%02x): %s", self.config_id, self.config_value)
 
-        try:
-            import configparser
-            config = configparser.ConfigParser()
-            # FIXME: The config file will not be in this relative directory once the package is installed.
-            config.read("../scripts/config.ini")
-
-            # Set inverter settings to the value specified in the config file
-            if self.config_id == 0x04: # Update Interval
-                update_interval = str(config['Growatt']['UpdateInterval'])
-                if self.config_value != update_interval:
-                    return GrowattConfigResponse(wifi_serial=self.wifi_serial, config_id=self.config_id,
-                                                 config_value=update_interval)
-            elif self.config_id == 0x11: # Server IP
-                server_ip = str(config['Growatt']['ServerIP'])
-                if self.config_value != server_ip:
-                    return GrowattConfigResponse(wifi_serial=self.wifi_serial, config_id=self.config_id,
-                                                 config_value=server_ip)
-        except KeyError:
-            log.error("Could not find key")
+        # Remember the values, so the inverter does not have to be queried again after a restart
+        cache = getattr(context, 'config_cache', None)
+        if cache is not None:
+            cache.put(self.wifi_serial, self.config_id, self.config_value)
+
+        # Set inverter settings to the value specified in the config file
+        config = getattr(context, 'config', None)
+        if config is not None:
+            value = config_change(config, self.config_id, self.config_value)
+            if value is not None:
+                return GrowattConfigResponse(wifi_serial=self.wifi_serial, config_id=self.config_id,
+                                             config_value=value)
 
         # If setting is correct, ACK the query
         return GrowattQueryResponse(wifi_serial=self.wifi_serial, first_config=self.config_id)
@@ -537,6 +642,10 @@ class GrowattBufferedEnergyResponse(GrowattResponse):
         GrowattResponse.__init__(self, **kwargs)
         self.wifi_serial = kwargs.get('wifi_serial', [])
 
+    def cache_key(self):
+        # The ACK is the same for every inverter
+        return ()
+
     def encode(self):
         """ ACK the Buffered Energy message
 
@@ -556,6 +665,9 @@ class GrowattBufferedEnergyResponse(GrowattResponse):
 class GrowattBufferedEnergyRequest(GrowattRequest):
     function_code = 0x50
 
+    # Only decode the header (serials and timestamp) up front, the other fields are decoded when first read
+    lazy = True
+
     def __init__(self, **kwargs):
         GrowattRequest.__init__(self, **kwargs)
         self.wifi_serial = kwargs.get("wifi_serial", [])
@@ -566,26 +678,9 @@ class GrowattBufferedEnergyRequest(GrowattRequest):
         self.hour = kwargs.get("hour", 0)
         self.min = kwargs.get("min", 0)
         self.sec = kwargs.get("sec", 0)
-        self.inverter_status = kwargs.get("inverter_status", 0)
-        self.Ppv = kwargs.get("Ppv", 0)
-        self.Vpv1 = kwargs.get("Vpv1", 0)
-        self.Ipv1 = kwargs.get("Ipv1", 0)
-        self.Ppv1 = kwargs.get("Ppv1", 0)
-        self.Vpv2 = kwargs.get("Vpv2", 0)
-        self.Ipv2 = kwargs.get("Ipv2", 0)
-        self.Ppv2 = kwargs.get("Ppv2", 0)
-        self.Pac = kwargs.get("Pac", 0)
-        self.Fac = kwargs.get("Fac", 0)
-        self.Vac1 = kwargs.get("Vac1", 0)
-        self.Iac1 = kwargs.get("Iac1", 0)
-        self.Pac1 = kwargs.get("Pac1", 0)
-        self.Vac_RS = kwargs.get("Vac_RS", 0)
-        self.Eac_today = kwargs.get("Eac_today", 0)
-        self.Eac_total = kwargs.get("Eac_total", 0)
-        self.Epv1_today = kwargs.get("Epv1_today", 0)
-        self.Epv1_total = kwargs.get("Epv1_total", 0)
-        self.Epv2_today = kwargs.get("Epv2_today", 0)
-        self.Epv2_total = kwargs.get("Epv2_total", 0)
+        for name in lazyBufferedEnergySchema.lazy_names:
+            if name in kwargs:
+                setattr(self, name, kwargs[name])
 
     def encode(self):
         log.debug("Not implemented (doing nothing)")
@@ -594,45 +689,16 @@ class GrowattBufferedEnergyRequest(GrowattRequest):
     def decode(self, data):
         # Unpack the data.
         try:
-            self.wifi_serial = struct.unpack_from(">10s", data, 0)[0]
-            self.inverter_serial = struct.unpack_from(">10s", data, 30)[0]
-            self.year, self.month, self.day = struct.unpack_from(">3B", data, 60)
-            self.hour, self.min, self.sec = struct.unpack_from(">3B", data, 63)
-            self.inverter_status = struct.unpack_from(">H", data, 71)[0]
-            self.Ppv = struct.unpack_from(">I", data, 73)[0]
-            self.Vpv1, self.Ipv1, self.Ppv1 = struct.unpack_from(">HHI", data, 77)
-            self.Vpv2, self.Ipv2, self.Ppv2 = struct.unpack_from(">HHI", data, 85)
-            self.Pac, self.Fac = struct.unpack_from(">IH", data, 117)
-            self.Vac1, self.Iac1, self.Pac1 = struct.unpack_from(">HHI", data, 123)
-            self.Vac_RS = struct.unpack_from(">H", data, 147)[0]
-            self.Eac_today = struct.unpack_from(">I", data, 169)[0]
-            self.Eac_total = struct.unpack_from(">I", data, 177)[0]
-            self.Epv1_today, self.Epv1_total = struct.unpack_from(">II", data, 181)
-            self.Epv2_today, self.Epv2_total = struct.unpack_from(">II", data, 189)
-
-            log.debug("\
-[[[%s-%s-%s_%s:%s:%s]]]\
-Ppv: %.1f, \
-Vpv1: %.1f, Ipv1: %.1f, Ppv1: %.1f, \
-Vpv2: %.1f, Ipv2: %.1f, Ppv2: %.1f, \
-Eac_today: %.1f (%s), \
-Eac_total: %.1f (%s), \
-Epv1_today: %.1f, Epv1_total: %.1f \
-Epv2_today: %.1f, Epv2_total: %.1f ",
-                      self.year, self.month, self.day, self.hour, self.min, self.sec,
-                      float(self.Ppv) / 10,
-                      float(self.Vpv1) / 10, float(self.Ipv1) / 10, float(self.Ppv1) / 10,
-                      float(self.Vpv2) / 10, float(self.Ipv2) / 10, float(self.Ppv2) / 10,
-                      float(self.Eac_today) / 10, hex(self.Eac_today),
-                      float(self.Eac_total) / 10, hex(self.Eac_total),
-                      float(self.Epv1_today) / 10, float(self.Epv1_total) / 10,
-                      float(self.Epv2_today) / 10, float(self.Epv2_total) / 10
-                      )
-
+            if self.lazy:
+                lazyBufferedEnergySchema.decode_into(self, data)
+            else:
+                bufferedEnergySchema.decode_into(self, data)
         except Exception as e:
             log.error("Could not decode GrowattBufferedEnergyRequest - %s", repr(e))
             return
 
+        if log.isEnabledFor(logging.DEBUG):
+            log_energy(self)
         return
 
     def execute(self, context):
@@ -641,17 +707,17 @@ Epv2_today: %.1f, Epv2_total: %.1f ",
         :param context: The IModbusSlaveContext to store the data
         :return: A GrowattBufferedEnergyResponse to send back to the client
         """
-        context.setValues(self.function_code, inputRegisters["Ppv"], [self.Ppv])
-        context.setValues(self.function_code, inputRegisters["Vpv1"], [self.Vpv1, self.Ipv1, self.Ppv1])
-        context.setValues(self.function_code, inputRegisters["Vpv2"], [self.Vpv2, self.Ipv2, self.Ppv2])
-        context.setValues(self.function_code, inputRegisters["Pac"], [self.Pac])
-        context.setValues(self.function_code, inputRegisters["Fac"], [self.Fac])
-        context.setValues(self.function_code, inputRegisters["Vac1"], [self.Vac1, self.Iac1, self.Pac1])
-        context.setValues(self.function_code, inputRegisters["Eac_today"], [self.Eac_today])
-        context.setValues(self.function_code, inputRegisters["Eac_total"], [self.Eac_total])
-        context.setValues(self.function_code, inputRegisters["Epv1_today"], [self.Epv1_today])
-        context.setValues(self.function_code, inputRegisters["Epv1_total"], [self.Epv1_total])
-        context.setValues(self.function_code, inputRegisters["Epv2_today"], [self.Epv2_today])
-        context.setValues(self.function_code, inputRegisters["Epv2_total"], [self.Epv2_total])
+        bufferedEnergySchema.execute(self, context, self.function_code)
+
+        # Queue the record for a bulk upload, as the registers only keep the last one
+        backfill = getattr(context, 'backfill', None)
+        if backfill is not None:
+            backfill.add(self)
 
         return GrowattBufferedEnergyResponse(wifi_serial=self.wifi_serial)
+
+
+# The fields decoded up front by the lazy energy requests, enough to route, date and de-duplicate a record
+energyHeaderFields = ("wifi_serial", "inverter_serial", "year", "month", "day", "hour", "min", "sec")
+lazyEnergySchema = LazySchema(energySchema, GrowattEnergyRequest, energyHeaderFields)
+lazyBufferedEnergySchema = LazySchema(bufferedEnergySchema, GrowattBufferedEnergyRequest, energyHeaderFields)
@@ -0,0 +1,321 @@
+"""
+Growatt Fleet Aggregates
+--------------------------------------------------------------------------
+
+Reporting the fleet's total Pac, its energy today or how many inverters
+are in Fault status used to mean reading every inverter's snapshot.
+FleetAggregates keeps those totals up to date instead: when
+GrowattEnergyRequest.execute replaces an inverter's snapshot, the
+inverter's previous values are subtracted from the running sums and
+counts of the fleet and of each of its groups (e.g. a site or a tag), and
+the new values added, so reading a total costs the same however many
+inverters are connected.
+
+The minimum and maximum of each field are kept in heaps whose entries are
+invalidated, rather than removed, when an inverter's value changes, and
+skipped when they reach the top. An
+inverter that has not sent a frame for the timeout is retracted from every
+aggregate, when the next frame of any inverter arrives or expire() is
+called.
+"""
+import heapq
+import itertools
+import threading
+import time
+from collections import Counter, OrderedDict
+from operator import attrgetter
+
+from PyGrowatt.Growatt import inverter_status_description
+from PyGrowatt.growatt_snapshot import registerScales
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+# The inverter_status of an inverter in Fault status
+FAULT_STATUS = 3
+
+
+class Aggregate(object):
+    """ The running sums, counts and extremes of a set of inverters
+
+    The sums, minimums and maximums are of the raw register values, use
+    summary() for the values in engineering units.
+    """
+
+    def __init__(self, fields, lock):
+        """ Initializes an empty aggregate
+
+        :param fields: The names of the energy fields to aggregate
+        :param lock: The lock shared by every aggregate
+        """
+        self.fields = tuple(fields)
+        self._index = dict((name, index) for index, name in enumerate(self.fields))
+        self._lock = lock
+        self.sums = dict((name, 0) for name in self.fields)
+        # inverter_status: the number of inverters with that status
+        self.statuses = Counter()
+        # key: (values, status) of each inverter in the aggregate
+        self._members = {}
+        # The (value, sequence, key) heaps of each field, with negated values for the maximum
+        self._minimums = [[] for _ in self.fields]
+        self._maximums = [[] for _ in self.fields]
+        self._sequence = itertools.count()
+        # The entries in the heaps of every field that may no longer match their inverter's value
+        self._stale = 0
+
+    def __len__(self):
+        return len(self._members)
+
+    @property
+    def count(self):
+        """ The number of inverters """
+        return len(self._members)
+
+    @property
+    def faults(self):
+        """ The number of inverters in Fault status """
+        return self.statuses[FAULT_STATUS]
+
+    def _push(self, index, key, value):
+        sequence = next(self._sequence)
+        heapq.heappush(self._minimums[index], (value, sequence, key))
+        heapq.heappush(self._maximums[index], (-value, sequence, key))
+
+    def _set(self, key, values, status):
+        """ Adds an inverter, or replaces its previous values """
+        sums = self.sums
+        previous = self._members.get(key)
+        self._members[key] = (values, status)
+        if previous is None:
+            self.statuses[status] += 1
+            for index, (name, value) in enumerate(zip(self.fields, values)):
+                sums[name] += value
+                self._push(index, key, value)
+            return
+        old_values, old_status = previous
+        if status != old_status:
+            self._count_status(old_status, -1)
+            self.statuses[status] += 1
+        for index, (name, value, old) in enumerate(zip(self.fields, values, old_values)):
+            # Only a changed value needs a new heap entry, the old entry is invalid from now on
+            if value != old:
+                sums[name] += value - old
+                self._push(index, key, value)
+                self._stale += 1
+        if self._stale > len(self.fields) * len(self._members) + 16:
+            self._compact()
+
+    def _discard(self, key):
+        """ Removes an inverter, if it is in the aggregate """
+        previous = self._members.pop(key, None)
+        if previous is None:
+            return
+        values, status = previous
+        self._count_status(status, -1)
+        for name, value in zip(self.fields, values):
+            self.sums[name] -= value
+        # Its heap entries are left, and discarded once they reach the top
+        self._stale += len(self.fields)
+        if self._stale > len(self.fields) * len(self._members) + 16:
+            self._compact()
+
+    def _count_status(self, status, change):
+        self.statuses[status] += change
+        if not self.statuses[status]:
+            del self.statuses[status]
+
+    def _compact(self):
+        # Rebuild the heaps from the current values once the invalid entries outnumber them
+        members = list(self._members.items())
+        for index in range(len(self.fields)):
+            self._minimums[index] = [(values[index], next(self._sequence), key) for key, (values, _) in members]
+            self._maximums[index] = [(-values[index], next(self._sequence), key) for key, (values, _) in members]
+            heapq.heapify(self._minimums[index])
+            heapq.heapify(self._maximums[index])
+        self._stale = 0
+
+    def _top(self, index, heap, sign):
+        members = self._members
+        while heap:
+            value, _, key = heap[0]
+            member = members.get(key)
+            if member is not None and member[0][index] == sign * value:
+                return sign * value
+            # The value has since been replaced or retracted
+            heapq.heappop(heap)
+        return None
+
+    def minimum(self, name):
+        """ Returns the smallest raw value of a field
+
+        :param name: The field name
+        :returns: The value, or None if there are no inverters
+        """
+        index = self._index[name]
+        with self._lock:
+            return self._top(index, self._minimums[index], 1)
+
+    def maximum(self, name):
+        """ Returns the largest raw value of a field
+
+        :param name: The field name
+        :returns: The value, or None if there are no inverters
+        """
+        index = self._index[name]
+        with self._lock:
+            return self._top(index, self._maximums[index], -1)
+
+    def summary(self):
+        """ Returns the aggregate in engineering units
+
+        :returns: A dict with the count, the faults, the count of each status
+            description, and the sum, minimum and maximum of each field
+        """
+        with self._lock:
+            summary = {"count": self.count, "faults": self.faults,
+                       "statuses": dict((inverter_status_description.get(status, status), count)
+                                        for status, count in self.statuses.items())}
+            for name in self.fields:
+                scale = float(registerScales[name])
+                minimum, maximum = self.minimum(name), self.maximum(name)
+                summary[name] = {"sum": self.sums[name] / scale,
+                                 "min": minimum / scale if minimum is not None else None,
+                                 "max": maximum / scale if maximum is not None else None}
+        return summary
+
+
+class FleetAggregates(object):
+    """ Fleet and group aggregates, updated with each energy frame
+
+    GrowattEnergyRequest.execute updates the aggregates of the datastore
+    (if it has one) with every snapshot::
+
+        aggregates = FleetAggregates(groups={b'ABC1D2345E': ("north-roof",)}, timeout=15 * 60)
+        server = GrowattServerContext(factory=lambda: create_slave_context(aggregates=aggregates))
+        ...
+        total_pac = aggregates.fleet.sums["Pac"] / 10.0
+        faults = aggregates.group("north-roof").faults
+    """
+
+    # The energy fields to aggregate
+    fields = ("Pac", "Ppv", "Eac_today", "Eac_total")
+
+    def __init__(self, fields=None, groups=None, timeout=None, clock=time.monotonic):
+        """ Initializes empty aggregates
+
+        :param fields: The names of the energy fields to aggregate
+        :param groups: A dict of WiFi serial to the names of the groups the inverter belongs to
+        :param timeout: Seconds without a frame before an inverter is retracted, or None to keep them forever
+        :param clock: The clock to time out the inverters with, for testing
+        """
+        if fields is not None:
+            self.fields = tuple(fields)
+        self._getter = attrgetter(*self.fields)
+        self.groups = dict((key, tuple(names)) for key, names in (groups or {}).items())
+        self.timeout = timeout
+        self._clock = clock
+        self._lock = threading.RLock()
+        self.fleet = Aggregate(self.fields, self._lock)
+        self._groups = {}
+        # key: (groups, updated), ordered by when it was updated
+        self._inverters = OrderedDict()
+        self.retracted = 0
+
+    def __len__(self):
+        return len(self._inverters)
+
+    def _aggregates(self, groups):
+        aggregates = [self.fleet]
+        for name in groups:
+            aggregate = self._groups.get(name)
+            if aggregate is None:
+                aggregate = self._groups[name] = Aggregate(self.fields, self._lock)
+            aggregates.append(aggregate)
+        return aggregates
+
+    def update(self, key, snapshot, now=None):
+        """ Replaces an inverter's values in the aggregates
+
+        :param key: The WiFi serial of the inverter
+        :param snapshot: The EnergySnapshot of its latest frame
+        :param now: The current time on the clock, for testing
+        """
+        now = self._clock() if now is None else now
+        values = self._getter(snapshot)
+        if len(self.fields) == 1:
+            values = (values,)
+        status = snapshot.inverter_status
+        groups = self.groups.get(key, ())
+        with self._lock:
+            self._inverters.pop(key, None)
+            self._inverters[key] = (groups, now)
+            for aggregate in self._aggregates(groups):
+                aggregate._set(key, values, status)
+            if self.timeout is not None:
+                self._expire(now - self.timeout)
+
+    def assign(self, key, groups):
+        """ Sets the groups of an inverter, moving its current values to them
+
+        :param key: The WiFi serial of the inverter
+        :param groups: The names of the groups it belongs to
+        """
+        groups = tuple(groups)
+        with self._lock:
+            self.groups[key] = groups
+            entry = self._inverters.get(key)
+            if entry is None:
+                return
+            previous, updated = entry
+            # Replaced in place, so its timeout is unchanged
+            self._inverters[key] = (groups, updated)
+            values, status = self.fleet._members[key]
+            for name in set(previous) - set(groups):
+                self._groups[name]._discard(key)
+            for aggregate in self._aggregates(groups)[1:]:
+                aggregate._set(key, values, status)
+
+    def _expire(self, cutoff):
+        expired = []
+        while self._inverters:
+            key, (groups, updated) = next(iter(self._inverters.items()))
+            if updated >= cutoff:
+                break
+            del self._inverters[key]
+            for aggregate in self._aggregates(groups):
+                aggregate._discard(key)
+            expired.append(key)
+            _logger.info("Retracted inverter %s from the aggregates", key)
+        self.retracted += len(expired)
+        return expired
+
+    def expire(self, now=None):
+        """ Retracts the inverters that have not sent a frame for longer than the timeout
+
+        :param now: The current time on the clock, for testing
+        :returns: A list of the keys of the retracted inverters
+        """
+        if self.timeout is None:
+            return []
+        now = self._clock() if now is None else now
+        with self._lock:
+            return self._expire(now - self.timeout)
+
+    def items(self):
+        """ Returns every aggregate
+
+        :returns: A list of (group name, Aggregate), the fleet first with the name None
+        """
+        with self._lock:
+            return [(None, self.fleet)] + sorted(self._groups.items())
+
+    def group(self, name):
+        """ Returns the aggregate of a group
+
+        :param name: The name of the group
+        :returns: The Aggregate, or None if no inverter has been in the group
+        """
+        return self._groups.get(name)
@@ -0,0 +1,251 @@
+"""
+Growatt Snapshot API
+--------------------------------------------------------------------------
+
+A small read-only HTTP API for the other services on the host, serving the
+latest energy values and the announce metadata of each inverter as JSON:
+
+ * /inverters lists every inverter with the time and sequence number of its
+   latest energy frame
+ * /inverters/<serial> returns an inverter (by WiFi or inverter serial) with
+   its latest energy values, scaled to engineering units, and its metadata
+
+Each document is serialised once, the first time it is requested after a
+new energy frame or announce, and served from the cache until the next
+one. Every response has an ETag, so a client polling with If-None-Match is
+answered with an empty 304 until the inverter's document changes.
+"""
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+from PyGrowatt.Growatt import holdingRegisters, inverter_status_description
+from PyGrowatt.growatt_snapshot import registerFields, registerScales
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "application/json"
+
+
+def _text(value):
+    # The serials and versions are fixed length, padded with NULs or spaces
+    return value.strip(b"\x00 ").decode("ascii", "replace")
+
+
+def _json(value):
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def _etag(body):
+    return '"%s"' % hashlib.blake2b(body, digest_size=8).hexdigest()
+
+
+class SnapshotApi(object):
+    """ Renders the JSON documents of the API, caching each until it changes
+
+    The context is either a GrowattServerContext, whose inverters are
+    listed, or the GrowattSlaveContext of a single inverter, which is listed
+    under the WiFi serial it announced.
+
+    Example::
+
+        api = SnapshotApi(store)
+        body, etag = api.inverter(b'ABC1D2345E')
+    """
+
+    def __init__(self, context):
+        """ Initializes the API
+
+        :param context: The GrowattServerContext or GrowattSlaveContext to serve
+        """
+        self.context = context
+        self._lock = threading.Lock()
+        # wifi serial: (snapshot, inverter serial, metadata version, body, etag)
+        self._documents = {}
+        # (key, body, etag), the key identifies the latest frame of every inverter
+        self._fleet = (None, None, None)
+        self.renders = 0
+
+    def _inverters(self):
+        """ Returns the (wifi serial, inverter serial, datastore) of every inverter """
+        inverters = getattr(self.context, "inverters", None)
+        if inverters is not None:
+            return [(inverter.wifi_serial, inverter.inverter_serial, inverter.context) for inverter in inverters()]
+        wifi_serial = self.context.getValues(3, holdingRegisters["wifi_serial"], 1)[0]
+        if not isinstance(wifi_serial, bytes):
+            # The inverter has not announced itself yet
+            return []
+        return [(wifi_serial.rstrip(b"\x00 "), None, self.context)]
+
+    def _find(self, serial):
+        if getattr(self.context, "inverters", None) is not None:
+            inverter = self.context.get(serial)
+            return (inverter.wifi_serial, inverter.inverter_serial, inverter.context) if inverter else None
+        for entry in self._inverters():
+            if entry[0] == serial:
+                return entry
+        return None
+
+    @staticmethod
+    def metadata(datastore):
+        """ Reads the announce metadata of an inverter from its holding registers
+
+        :param datastore: The GrowattSlaveContext of the inverter
+        :returns: A dict of field name to value, strings for the serials and versions, or None if the
+            inverter has not announced itself
+        """
+        if not isinstance(datastore.getValues(3, holdingRegisters["wifi_serial"], 1)[0], bytes):
+            return None
+        metadata = {}
+        for name, address in holdingRegisters.items():
+            value = datastore.getValues(3, address, 1)[0] if datastore.validate(3, address, 1) else None
+            metadata[name] = _text(value) if isinstance(value, bytes) else value
+        return metadata
+
+    def _render(self, wifi_serial, inverter_serial, datastore, snapshot):
+        document = {"wifi_serial": _text(wifi_serial),
+                    "inverter_serial": _text(inverter_serial) if inverter_serial else None,
+                    "sequence": None, "received": None, "status": None, "values": None,
+                    "metadata": self.metadata(datastore)}
+        if snapshot is not None:
+            document["sequence"] = snapshot.sequence
+            document["received"] = snapshot.received
+            document["status"] = inverter_status_description.get(snapshot.inverter_status,
+                                                                 snapshot.inverter_status)
+            document["values"] = dict((name, value / registerScales[name] if registerScales[name] != 1 else value)
+                                      for name, value in zip(registerFields, snapshot[2:]))
+        self.renders += 1
+        return _json(document)
+
+    def inverter(self, serial):
+        """ Returns the document of an inverter
+
+        :param serial: The WiFi or inverter serial number, as bytes
+        :returns: The (body, etag), or None if the inverter is not known
+        """
+        entry = self._find(serial)
+        if entry is None:
+            return None
+        wifi_serial, inverter_serial, datastore = entry
+        snapshot = datastore.snapshots.current
+        # Read before rendering, so metadata that changes while rendering is picked up by the next request
+        version = getattr(datastore, "metadata_version", None)
+        cached = self._documents.get(wifi_serial)
+        if cached is not None and cached[0] is snapshot and cached[1:3] == (inverter_serial, version):
+            return cached[3], cached[4]
+        body = self._render(wifi_serial, inverter_serial, datastore, snapshot)
+        etag = _etag(body)
+        with self._lock:
+            self._documents[wifi_serial] = (snapshot, inverter_serial, version, body, etag)
+        return body, etag
+
+    def fleet(self):
+        """ Returns the document listing every inverter
+
+        :returns: The (body, etag)
+        """
+        inverters = []
+        for wifi_serial, inverter_serial, datastore in self._inverters():
+            snapshot = datastore.snapshots.current
+            inverters.append((wifi_serial, inverter_serial,
+                              snapshot.sequence if snapshot is not None else None,
+                              snapshot.received if snapshot is not None else None))
+        key = tuple(inverters)
+        cached = self._fleet
+        if cached[0] == key:
+            return cached[1], cached[2]
+        body = _json({"inverters": [{"wifi_serial": _text(wifi_serial),
+                                     "inverter_serial": _text(inverter_serial) if inverter_serial else None,
+                                     "sequence": sequence, "received": received}
+                                    for wifi_serial, inverter_serial, sequence, received in inverters]})
+        self.renders += 1
+        etag = _etag(body)
+        with self._lock:
+            self._fleet = (key, body, etag)
+            # Forget the documents of inverters that have been evicted
+            for wifi_serial in set(self._documents) - set(entry[0] for entry in inverters):
+                del self._documents[wifi_serial]
+        return body, etag
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    # Keep the connection open, so a polling client does not reconnect for every request
+    protocol_version = "HTTP/1.1"
+    # The headers and body are written separately, don't let Nagle hold the body back for the client's ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path in ("", "/inverters"):
+            document = self.server.api.fleet()
+        elif path.startswith("/inverters/"):
+            document = self.server.api.inverter(unquote(path[len("/inverters/"):]).encode("latin-1"))
+        else:
+            document = None
+        if document is None:
+            self.send_error(404)
+            return
+        body, etag = document
+        match = self.headers.get("If-None-Match")
+        if match is not None and (match.strip() == "*" or etag in [tag.strip() for tag in match.split(",")]):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class ApiServer(object):
+    """ Serves a SnapshotApi from a background thread
+    """
+
+    def __init__(self, context, address=("127.0.0.1", 9109)):
+        """ Initializes a new server
+
+        :param context: The GrowattServerContext or GrowattSlaveContext to serve
+        :param address: The (interface, port) to bind to. Only localhost by default
+        """
+        self.api = SnapshotApi(context)
+        self.address = address
+        self._server = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1] if self._server is not None else None
+
+    def start(self):
+        """ Starts serving the API
+        """
+        self._server = ThreadingHTTPServer(self.address, _ApiHandler)
+        self._server.daemon_threads = True
+        self._server.api = self.api
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={"poll_interval": 0.1},
+                                        name="ApiServer", daemon=True)
+        self._thread.start()
+        _logger.info("Serving the snapshot API on http://%s:%d/inverters", self.address[0] or "0.0.0.0", self.port)
+
+    def stop(self):
+        """ Stops serving
+        """
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
@@ -0,0 +1,208 @@
+"""
+Growatt Buffered Energy Backfill
+--------------------------------------------------------------------------
+
+After an outage the ShineWiFi-X module replays the records it stored as
+GrowattBufferedEnergyRequest (0x50) frames, often hundreds in a burst.
+Writing them to the registers keeps only the last one, so BackfillQueue
+collects them instead, drops the records it has already seen (by serial and
+timestamp), and hands them to a sink in time ordered batches from its own
+thread, separate from the live data publishers.
+"""
+import heapq
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from operator import attrgetter
+
+from PyGrowatt.Growatt import bufferedEnergySchema
+from PyGrowatt.growatt_history import inverter_timestamp
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+# The timestamp comes first so that records sort (and heap) in time order
+backfillFields = (("timestamp", "serial") +
+                  bufferedEnergySchema.names[bufferedEnergySchema.names.index("inverter_status"):])
+
+BackfillRecord = namedtuple("BackfillRecord", backfillFields)
+
+
+class BackfillQueue(object):
+    """ A de-duplicating, time ordered queue of buffered energy records
+
+    The sink is a callable that is given a list of BackfillRecord, oldest
+    first. If it raises, the batch is queued again and retried after
+    retry_interval seconds.
+
+    Example::
+
+        backfill = BackfillQueue(PVOutputBatchSink(api_key, system_id))
+        backfill.start()
+        store = create_slave_context(backfill=backfill)
+    """
+
+    # PVOutput accepts up to 30 statuses per batch request
+    batch_size = 30
+    # Seconds to wait for more records before sending a partial batch
+    linger = 2.0
+    # Seconds to wait before retrying a batch the sink failed to send
+    retry_interval = 30.0
+    # The number of (serial, timestamp) keys remembered to detect replays
+    max_seen = 65536
+
+    def __init__(self, sink=None, batch_size=None, linger=None, retry_interval=None):
+        """ Initializes an empty queue
+
+        :param sink: The callable to send each batch to
+        :param batch_size: The maximum number of records per batch
+        :param linger: Seconds to wait for a full batch
+        :param retry_interval: Seconds to wait after the sink fails
+        """
+        self.sink = sink
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if linger is not None:
+            self.linger = linger
+        if retry_interval is not None:
+            self.retry_interval = retry_interval
+        self._values = attrgetter(*backfillFields[2:])
+        self._pending = []
+        self._seen = OrderedDict()
+        self._condition = threading.Condition()
+        self._last_added = 0
+        self._retry_at = 0
+        self._stopping = False
+        self._thread = None
+        self.duplicates = 0
+        self.undated = 0
+        self.sent = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, message):
+        """ Queues a decoded buffered energy request
+
+        :param message: The GrowattBufferedEnergyRequest
+        :returns: True if the record was queued, False if it was a duplicate or had no date
+        """
+        timestamp = inverter_timestamp(message)
+        if timestamp is None:
+            self.undated += 1
+            return False
+        serial = message.inverter_serial or message.wifi_serial
+        key = (serial, timestamp)
+
+        with self._condition:
+            if key in self._seen:
+                self.duplicates += 1
+                return False
+            self._seen[key] = None
+            if len(self._seen) > self.max_seen:
+                self._seen.popitem(last=False)
+            heapq.heappush(self._pending, BackfillRecord(timestamp, serial, *self._values(message)))
+            self._last_added = time.monotonic()
+            self._condition.notify()
+        return True
+
+    def take(self, count=None):
+        """ Removes the oldest records from the queue
+
+        :param count: The maximum number of records, defaults to batch_size
+        :returns: A list of BackfillRecord, oldest first
+        """
+        with self._condition:
+            return self._take(count or self.batch_size)
+
+    def _take(self, count):
+        pending = self._pending
+        return [heapq.heappop(pending) for _ in range(min(count, len(pending)))]
+
+    def requeue(self, records):
+        """ Puts records that could not be sent back on the queue
+
+        :param records: The list of BackfillRecord
+        """
+        with self._condition:
+            for record in records:
+                heapq.heappush(self._pending, record)
+
+    def flush(self):
+        """ Sends every queued record to the sink from the calling thread
+
+        :returns: The number of records sent
+        """
+        sent = 0
+        while True:
+            batch = self.take()
+            if not batch:
+                return sent
+            if not self._send(batch):
+                return sent
+            sent += len(batch)
+
+    def _send(self, batch):
+        try:
+            self.sink(batch)
+        except Exception as e:
+            _logger.error("Unable to send %d backfill records: %s", len(batch), repr(e))
+            self.requeue(batch)
+            return False
+        self.sent += len(batch)
+        _logger.debug("Sent %d backfill records", len(batch))
+        return True
+
+    def start(self):
+        """ Starts sending batches to the sink from a background thread
+        """
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="BackfillThread")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Stops the background thread, leaving any unsent records queued
+
+        :param timeout: Seconds to wait for the thread to finish
+        """
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        thread.join(timeout)
+
+    def _next_batch(self):
+        """ Waits until a batch is due
+
+        :returns: A list of BackfillRecord, or None when stopping
+        """
+        with self._condition:
+            while not self._stopping:
+                if not self._pending:
+                    self._condition.wait()
+                    continue
+                now = time.monotonic()
+                # A full batch goes straight away, a partial one once the burst has ended
+                due = self._last_added + self.linger if len(self._pending) < self.batch_size else now
+                due = max(due, self._retry_at)
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+                return self._take(self.batch_size)
+        return None
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if not self._send(batch):
+                self._retry_at = time.monotonic() + self.retry_interval
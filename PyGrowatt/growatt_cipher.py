@@ -0,0 +1,89 @@
+"""
+Growatt XOR cipher
+--------------------------------------------------------------------------
+
+Version 6 of the Growatt protocol obfuscates every payload by XORing it
+with a repeating key (b'Growatt' by default). The key stream for a given
+length never changes, so it is built once, cached as an integer and then
+applied to a whole buffer with a single big-int XOR.
+"""
+import threading
+
+
+class GrowattCipher(object):
+    """ XOR cipher with a cached key stream
+
+    The same operation both encrypts and decrypts::
+
+        cipher = GrowattCipher(b'Growatt')
+        payload = cipher.xor(encrypted)
+    """
+
+    # Number of distinct payload lengths to cache before starting over
+    max_cached_lengths = 64
+
+    def __init__(self, key=b'Growatt'):
+        """ Initializes a new instance of the cipher
+
+        :param key: The repeating key to XOR the payload with
+        """
+        if not key:
+            raise ValueError("The XOR key must not be empty")
+        self._key = bytes(key)
+        self._keystreams = {}
+
+    @property
+    def key(self):
+        return self._key
+
+    def keystream(self, length):
+        """ Returns the repeating key stream for a payload length
+
+        :param length: The number of bytes in the payload
+        :returns: The key stream as a big-endian integer
+        """
+        keystream = self._keystreams.get(length)
+        if keystream is None:
+            repeats = length // len(self._key) + 1
+            keystream = int.from_bytes((self._key * repeats)[:length], 'big')
+            if len(self._keystreams) >= self.max_cached_lengths:
+                self._keystreams = {}
+            self._keystreams[length] = keystream
+        return keystream
+
+    def xor(self, data, start=0):
+        """ Encrypts or decrypts a payload
+
+        :param data: The payload (bytes, bytearray or memoryview)
+        :param start: The number of leading bytes to copy without XORing,
+                      e.g. 1 to leave a function code in front of the payload
+        :returns: The XORed payload as bytes
+        """
+        length = len(data)
+        if length <= start:
+            return bytes(data)
+        # The key stream is aligned to the end of the big-endian integer, so
+        # a shorter key stream leaves the leading bytes untouched
+        value = int.from_bytes(data, 'big') ^ self.keystream(length - start)
+        return value.to_bytes(length, 'big')
+
+
+_ciphers = {}
+_ciphers_lock = threading.Lock()
+
+
+def get_cipher(key=b'Growatt'):
+    """ Returns the shared cipher for a key
+
+    Every connection using the same key shares one cipher, so the key
+    stream cache is only built once per process.
+
+    :param key: The repeating key to XOR the payload with
+    :returns: A GrowattCipher instance
+    """
+    key = bytes(key)
+    cipher = _ciphers.get(key)
+    if cipher is None:
+        with _ciphers_lock:
+            cipher = _ciphers.setdefault(key, GrowattCipher(key))
+    return cipher
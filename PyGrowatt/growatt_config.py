@@ -0,0 +1,131 @@
+"""
+Growatt Config
+--------------------------------------------------------------------------
+
+The configuration file, parsed once and cached. The file is only parsed
+again when its modification time changes (checked at most every few
+seconds) or when the process receives SIGHUP, so reading a value never
+touches the disk on the request path.
+
+The config is given to the requests through the datastore: pass it to
+create_slave_context and the 0x19 query handler will push the settings in
+it to each inverter.
+"""
+import configparser
+import os
+import signal
+import threading
+import time
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+
+class GrowattConfig(object):
+    """ A cached, hot-reloadable configuration file
+
+    Example::
+
+        config = GrowattConfig("config.ini")
+        config.install_signal_handler()
+        interval = config.get('Growatt', 'UpdateInterval')
+    """
+
+    # Seconds between checks of the file's modification time
+    check_interval = 5.0
+
+    def __init__(self, path, check_interval=None, clock=time.monotonic):
+        """ Loads a config file
+
+        :param path: The path of the file. A missing file is treated as empty until it is created
+        :param check_interval: Seconds between checks of the modification time, 0 to check on every read
+        :param clock: The clock to throttle the checks with, for testing
+        """
+        self.path = path
+        if check_interval is not None:
+            self.check_interval = check_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._parser = configparser.ConfigParser()
+        self._signature = None
+        self._stale = False
+        self.reloads = 0
+        self._reload(self._stat())
+        self._next_check = clock() + self.check_interval
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _reload(self, signature):
+        parser = configparser.ConfigParser()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                parser.read_file(f)
+        except FileNotFoundError:
+            _logger.warning("Config file %s not found", self.path)
+        except (OSError, configparser.Error) as e:
+            # Keep the last good config rather than dropping every setting
+            _logger.error("Unable to load config file %s: %s", self.path, e)
+            self._signature = signature
+            return
+        self._parser = parser
+        self._signature = signature
+        self.reloads += 1
+        _logger.debug("Loaded config file %s", self.path)
+
+    def _current(self):
+        """ Returns the parser, reloading it first if the file has changed """
+        now = self._clock()
+        if not self._stale and now < self._next_check:
+            return self._parser
+        with self._lock:
+            self._next_check = now + self.check_interval
+            signature = self._stat()
+            if self._stale or signature != self._signature:
+                self._stale = False
+                self._reload(signature)
+        return self._parser
+
+    def reload(self):
+        """ Reloads the file on the next read, whether or not it has changed
+        """
+        self._stale = True
+
+    def install_signal_handler(self, signum=getattr(signal, "SIGHUP", None)):
+        """ Reloads the file when the process receives a signal
+
+        Must be called from the main thread. The handler only marks the
+        config as stale, the file is parsed on the next read.
+
+        :param signum: The signal, SIGHUP by default
+        """
+        if signum is None:
+            _logger.warning("Signals are not supported, the config is only reloaded when it changes")
+            return
+        signal.signal(signum, lambda *args: self.reload())
+
+    def get(self, section, option, fallback=None):
+        """ Returns a config value
+
+        :param section: The section name
+        :param option: The option name
+        :param fallback: The value to return if the option is not set
+        :returns: The value as a str, or fallback
+        """
+        return self._current().get(section, option, fallback=fallback)
+
+    def has_section(self, section):
+        return self._current().has_section(section)
+
+    def __getitem__(self, section):
+        return self._current()[section]
+
+    def __contains__(self, section):
+        return self._current().has_section(section)
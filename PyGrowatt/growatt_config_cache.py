@@ -0,0 +1,181 @@
+"""
+Growatt Inverter Config Cache
+--------------------------------------------------------------------------
+
+Until the server knows an inverter's date (config 0x1F), every ping is
+answered with a query for all of its config values (0x01 to 0x1F), and the
+inverter sends them back one frame at a time. That happens for every
+inverter after every restart. ConfigCache keeps the values of each
+inverter in a file, so a known inverter's values are restored from the
+file instead and the query only runs for new inverters, or once the
+cached values are older than the TTL.
+"""
+import json
+import os
+import threading
+import time
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+
+def _text(value):
+    # Serials and config values are bytes, latin-1 maps every byte to one character and back
+    return value.decode("latin-1")
+
+
+def _bytes(text):
+    return text.encode("latin-1")
+
+
+class ConfigCache(object):
+    """ The config values of every inverter, persisted to a file
+
+    Each completed query is appended to the file as one line of JSON, so
+    saving an inverter does not rewrite every other inverter's values. The
+    last line for an inverter wins when the file is loaded, and the file is
+    rewritten without the superseded lines once they outnumber the rest.
+
+    Example::
+
+        cache = ConfigCache("inverters.jsonl")
+        store = create_slave_context(config_cache=cache)
+    """
+
+    # Seconds before an inverter's cached values are stale and it is queried again
+    ttl = 7 * 24 * 60 * 60
+    # The inverter sends the config values in order, so the query is complete once this one is received
+    last_config = 0x1F
+
+    def __init__(self, path, ttl=None, clock=time.time):
+        """ Loads the cache file
+
+        :param path: The path of the file. A missing file is treated as empty and created on the first save
+        :param ttl: Seconds before the cached values are stale
+        :param clock: The wall clock, for testing
+        """
+        self.path = path
+        if ttl is not None:
+            self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # wifi serial: (time the query completed, {config id: value})
+        self._entries = {}
+        # wifi serial: {config id: value} received since the last complete query
+        self._received = {}
+        self._lines = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            # The cache only saves round trips, so start again rather than refusing to run
+            _logger.error("Unable to load config cache %s: %s", self.path, e)
+            return
+        invalid = 0
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                values = dict((int(config_id), _bytes(value)) for config_id, value in entry["values"].items())
+                self._entries[_bytes(entry["serial"])] = (float(entry["updated"]), values)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                # A line left part written by a crash, or a corrupt file
+                invalid += 1
+        self._lines = len(lines)
+        if invalid:
+            _logger.error("Ignored %d invalid lines in config cache %s", invalid, self.path)
+            self._compact()
+        _logger.debug("Loaded the config of %d inverters from %s", len(self._entries), self.path)
+
+    @staticmethod
+    def _line(serial, updated, values):
+        return json.dumps({"serial": _text(serial), "updated": updated,
+                           "values": dict((str(config_id), _text(value))
+                                          for config_id, value in sorted(values.items()))},
+                          separators=(",", ":")) + "\n"
+
+    def _append(self, serial):
+        if self._lines >= 2 * len(self._entries) + 16:
+            self._compact()
+            return
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(self._line(serial, *self._entries[serial]))
+            self._lines += 1
+        except OSError as e:
+            _logger.error("Unable to save config cache %s: %s", self.path, e)
+
+    def _compact(self):
+        """ Rewrites the file with one line per inverter """
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.writelines(self._line(serial, updated, values)
+                             for serial, (updated, values) in self._entries.items())
+            os.replace(tmp, self.path)
+            self._lines = len(self._entries)
+        except OSError as e:
+            _logger.error("Unable to save config cache %s: %s", self.path, e)
+
+    def get(self, wifi_serial):
+        """ Returns the cached config values of an inverter
+
+        :param wifi_serial: The serial number of the ShineWiFi-X module
+        :returns: A dict of config id to value, or None if the inverter is unknown or its values are stale
+        """
+        with self._lock:
+            entry = self._entries.get(wifi_serial)
+            if entry is None:
+                self.misses += 1
+                return None
+            updated, values = entry
+            if self._clock() - updated > self.ttl:
+                self.stale += 1
+                return None
+            self.hits += 1
+            return dict(values)
+
+    def put(self, wifi_serial, config_id, value):
+        """ Records a config value sent by an inverter
+
+        The values are saved once the last config value of a query is
+        received, merged with the values already cached for the inverter.
+
+        :param wifi_serial: The serial number of the ShineWiFi-X module
+        :param config_id: The config id
+        :param value: The value, as bytes
+        """
+        with self._lock:
+            received = self._received.setdefault(wifi_serial, {})
+            received[config_id] = bytes(value)
+            if config_id != self.last_config:
+                return
+            del self._received[wifi_serial]
+            entry = self._entries.get(wifi_serial)
+            values = dict(entry[1]) if entry is not None else {}
+            values.update(received)
+            self._entries[wifi_serial] = (self._clock(), values)
+            self._append(wifi_serial)
+
+    def discard(self, wifi_serial):
+        """ Removes an inverter from the cache, so it is queried on its next ping
+
+        :param wifi_serial: The serial number of the ShineWiFi-X module
+        """
+        with self._lock:
+            self._received.pop(wifi_serial, None)
+            if self._entries.pop(wifi_serial, None) is not None:
+                self._compact()
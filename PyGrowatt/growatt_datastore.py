@@ -0,0 +1,273 @@
+"""
+Growatt Fleet Datastore
+--------------------------------------------------------------------------
+
+A single ModbusSlaveContext is shared by every connection, so a second
+inverter overwrites the first inverter's registers. GrowattServerContext
+keeps one slave context per inverter, indexed by WiFi serial (and by
+inverter serial once an energy frame has been received), and routes each
+decoded request to the context of the inverter that sent it.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from pymodbus.datastore import ModbusSparseDataBlock, ModbusSlaveContext, ModbusServerContext
+
+from PyGrowatt.Growatt import inputRegisters
+from PyGrowatt.growatt_history import EnergyHistory
+from PyGrowatt.growatt_snapshot import SnapshotStore, registerCount
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+
+class GrowattSlaveContext(ModbusSlaveContext):
+    """ The datastore for a single inverter
+
+    As well as the registers, it keeps the recent energy samples in an
+    EnergyHistory which GrowattEnergyRequest.execute appends to, and
+    GrowattBufferedEnergyRequest.execute adds buffered records to the
+    backfill queue (if there is one). GrowattQueryRequest.execute pushes the
+    settings in the config (if there is one) to the inverter, and records the
+    inverter's values in the config cache (if there is one) which
+    GrowattPingRequest.execute restores them from after a restart.
+
+    GrowattEnergyRequest.execute swaps each frame into a SnapshotStore rather
+    than writing the input registers, getValues(4, ...) reads them from the
+    latest snapshot. Each snapshot is also submitted to the pipeline (if
+    there is one) for the publishers, and replaces the inverter's previous
+    values in the fleet aggregates (if there are any).
+
+    Every write to the holding registers (the announce metadata and the
+    config values) increments metadata_version, so a reader that caches
+    them can tell when they have changed.
+    """
+
+    def __init__(self, history_capacity=None, backfill=None, config=None, config_cache=None, pipeline=None,
+                 aggregates=None, **kwargs):
+        """ Initializes the datastore
+
+        :param history_capacity: The number of energy samples to keep
+        :param backfill: The BackfillQueue for buffered energy records, or None
+        :param config: The GrowattConfig with the inverter settings, or None
+        :param config_cache: The ConfigCache of the inverter config values, or None
+        :param pipeline: The Pipeline to submit each energy snapshot to, or None
+        :param aggregates: The FleetAggregates to update with each energy snapshot, or None
+        """
+        ModbusSlaveContext.__init__(self, **kwargs)
+        self.history = EnergyHistory(history_capacity)
+        self.snapshots = SnapshotStore()
+        self.backfill = backfill
+        self.config = config
+        self.config_cache = config_cache
+        self.pipeline = pipeline
+        self.aggregates = aggregates
+        self.metadata_version = 0
+
+    def setValues(self, fx, address, values):
+        """ Sets the datastore with the supplied values
+
+        :param fx: The function we are working with
+        :param address: The starting address
+        :param values: The new values to be set
+        """
+        ModbusSlaveContext.setValues(self, fx, address, values)
+        if self.decode(fx) == 'h':
+            self.metadata_version += 1
+
+    def getValues(self, fx, address, count=1):
+        """ Get values from the datastore
+
+        :param fx: The function we are working with
+        :param address: The starting address
+        :param count: The number of values to retrieve
+        :returns: The requested values from a:a+c
+        """
+        snapshot = self.snapshots.current
+        if fx != 4 or snapshot is None:
+            return ModbusSlaveContext.getValues(self, fx, address, count)
+        registers = snapshot.registers()[address:address + count]
+        return registers + [0] * (count - len(registers))
+
+    def reset(self):
+        """ Resets all the datastores and forgets the latest snapshot
+        """
+        ModbusSlaveContext.reset(self)
+        self.snapshots.clear()
+        self.metadata_version += 1
+
+
+def create_slave_context(history_capacity=None, backfill=None, config=None, config_cache=None, pipeline=None,
+                         aggregates=None):
+    """ Creates the datastore for a single inverter
+
+    The Holding Register is used for config data, the Input Register is used
+    for 'live' energy data and the BufferedEnergy (0x50) is stored in a
+    "Buffered Input Register".
+
+    :param history_capacity: The number of energy samples to keep
+    :param backfill: The BackfillQueue for buffered energy records, or None
+    :param config: The GrowattConfig with the inverter settings, or None
+    :param config_cache: The ConfigCache of the inverter config values, or None
+    :param pipeline: The Pipeline to submit each energy snapshot to, or None
+    :param aggregates: The FleetAggregates to update with each energy snapshot, or None
+    :returns: A GrowattSlaveContext
+    """
+    input_register = ModbusSparseDataBlock([0] * 100)
+    holding_register = ModbusSparseDataBlock([0] * 100)
+    buffered_input_register = ModbusSparseDataBlock([0] * 100)
+    store = GrowattSlaveContext(history_capacity=history_capacity,
+                                backfill=backfill,
+                                config=config,
+                                config_cache=config_cache,
+                                pipeline=pipeline,
+                                aggregates=aggregates,
+                                hr=holding_register,
+                                ir=input_register,
+                                zero_mode=True)
+    store.register(0x18, 'h', holding_register)
+    store.register(0x19, 'h', holding_register)
+    store.register(0x50, 'bi', buffered_input_register)
+    return store
+
+
+def read_snapshot(datastore):
+    """ Reads the energy input registers of a datastore
+
+    A datastore with a SnapshotStore is read from its latest snapshot, so
+    the values always come from a single frame.
+
+    :param datastore: The ModbusSlaveContext of an inverter
+    :returns: A dict of the raw register values, by field name
+    """
+    snapshots = getattr(datastore, 'snapshots', None)
+    snapshot = snapshots.latest() if snapshots is not None else None
+    if snapshot is not None:
+        return snapshot.values()
+    # Every input register is read with a single getValues call
+    values = ModbusSlaveContext.getValues(datastore, 4, 0, registerCount)
+    return {name: values[address] for name, address in inputRegisters.items()}
+
+
+class GrowattInverter(object):
+    """ An inverter known to the server
+    """
+
+    def __init__(self, wifi_serial, context):
+        """ Initializes a new inverter
+
+        :param wifi_serial: The serial number of the ShineWiFi-X module
+        :param context: The ModbusSlaveContext that stores its data
+        """
+        self.wifi_serial = wifi_serial
+        self.inverter_serial = None
+        self.context = context
+        self.last_seen = time.time()
+        self._last_seen_monotonic = time.monotonic()
+
+
+class GrowattServerContext(ModbusServerContext):
+    """ A collection of per-inverter slave contexts
+
+    Requests without a WiFi serial fall back to the default context, which is
+    also what context[unit_id] returns so this can be used anywhere a single
+    ModbusServerContext is expected.
+    """
+
+    def __init__(self, idle_timeout=None, factory=create_slave_context):
+        """ Initializes a new fleet datastore
+
+        :param idle_timeout: Seconds without a frame before an inverter is evicted, or None to keep them forever
+        :param factory: A callable that creates the ModbusSlaveContext for a new inverter
+        """
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        ModbusServerContext.__init__(self, slaves=factory(), single=True)
+        # Ordered by last seen, so the idle inverters are always at the front
+        self._inverters = OrderedDict()
+        self._by_inverter_serial = {}
+        self._lock = threading.Lock()
+
+    def route(self, request, now=None):
+        """ Returns the slave context for the inverter that sent a request
+
+        :param request: The decoded request
+        :param now: The current time.monotonic(), for testing
+        :returns: The ModbusSlaveContext to execute the request against
+        """
+        wifi_serial = getattr(request, 'wifi_serial', None)
+        if not wifi_serial:
+            return self[request.unit_id]
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            inverter = self._inverters.get(wifi_serial)
+            if inverter is None:
+                inverter = GrowattInverter(wifi_serial, self.factory())
+                self._inverters[wifi_serial] = inverter
+                _logger.info("New inverter %s", wifi_serial)
+            else:
+                self._inverters.move_to_end(wifi_serial)
+            inverter.last_seen = time.time()
+            inverter._last_seen_monotonic = now
+
+            inverter_serial = getattr(request, 'inverter_serial', None)
+            if inverter_serial and inverter_serial != inverter.inverter_serial:
+                self._by_inverter_serial.pop(inverter.inverter_serial, None)
+                self._by_inverter_serial[inverter_serial] = wifi_serial
+                inverter.inverter_serial = inverter_serial
+
+            if self.idle_timeout is not None:
+                self._evict(now - self.idle_timeout)
+
+        return inverter.context
+
+    def get(self, serial):
+        """ Looks up an inverter by WiFi serial or inverter serial
+
+        :param serial: The WiFi or inverter serial number
+        :returns: The GrowattInverter, or None if it is not known
+        """
+        inverter = self._inverters.get(serial)
+        if inverter is None:
+            wifi_serial = self._by_inverter_serial.get(serial)
+            if wifi_serial is not None:
+                inverter = self._inverters.get(wifi_serial)
+        return inverter
+
+    def inverters(self):
+        """ Returns every known inverter, least recently seen first
+
+        :returns: A list of GrowattInverter
+        """
+        with self._lock:
+            return list(self._inverters.values())
+
+    def evict_idle(self, now=None):
+        """ Removes the inverters that have been idle for longer than idle_timeout
+
+        :param now: The current time.monotonic(), for testing
+        :returns: A list of the evicted GrowattInverter
+        """
+        if self.idle_timeout is None:
+            return []
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return self._evict(now - self.idle_timeout)
+
+    def _evict(self, cutoff):
+        evicted = []
+        while self._inverters:
+            inverter = next(iter(self._inverters.values()))
+            if inverter._last_seen_monotonic >= cutoff:
+                break
+            del self._inverters[inverter.wifi_serial]
+            if self._by_inverter_serial.get(inverter.inverter_serial) == inverter.wifi_serial:
+                del self._by_inverter_serial[inverter.inverter_serial]
+            evicted.append(inverter)
+            _logger.info("Evicted idle inverter %s", inverter.wifi_serial)
+        return evicted
@@ -0,0 +1,145 @@
+"""
+Growatt Report By Exception
+--------------------------------------------------------------------------
+
+Most of the fields of an energy frame (the grid voltage and frequency, the
+energy totals, the status) barely change from one frame to the next, so
+publishing every field of every frame mostly repeats what the broker has
+already retained. DeadbandFilter tracks the last published value of each
+field, and only passes a field on when it has moved beyond its deadband,
+or when its heartbeat interval has expired so subscribers can still tell
+that the inverter is alive.
+
+A deadband is either absolute, in the units of the published value (e.g.
+"0.5" for half a volt), or relative to the last published value (e.g. "2%").
+"""
+import threading
+import time
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+
+def parse_deadband(text):
+    """ Parses a deadband from the configuration file
+
+    :param text: An absolute deadband (e.g. "0.5") or a relative one (e.g. "2%")
+    :returns: The (absolute, relative) deadband, one of which is 0
+    """
+    text = text.strip()
+    if text.endswith("%"):
+        relative = float(text[:-1]) / 100
+        if relative < 0:
+            raise ValueError("Invalid deadband: %s" % text)
+        return 0.0, relative
+    absolute = float(text)
+    if absolute < 0:
+        raise ValueError("Invalid deadband: %s" % text)
+    return absolute, 0.0
+
+
+def parse_deadbands(options, fields):
+    """ Parses the deadbands of a section of the configuration file
+
+    :param options: A list of (field name, deadband), e.g. the items of the section
+    :param fields: The names of the fields, which the options are matched to regardless of case
+    :returns: A dict of field name to (absolute, relative) deadband
+    """
+    names = dict((name.lower(), name) for name in fields)
+    deadbands = {}
+    for option, text in options:
+        if option.lower() not in names:
+            raise ValueError("Unknown field for a deadband: %s" % option)
+        deadbands[names[option.lower()]] = parse_deadband(text)
+    return deadbands
+
+
+class DeadbandFilter(object):
+    """ Suppresses the fields that have not changed since they were last published
+
+    A numeric field is passed on when it differs from its last published
+    value by more than its deadband. Any other field (e.g. the status
+    description) is passed on when it differs at all. Every field is passed
+    on at least once every heartbeat seconds.
+
+    Example::
+
+        deadband = DeadbandFilter({"Vac1": parse_deadband("1"), "Pac": parse_deadband("2%")}, heartbeat=300)
+        publisher = GrowattMqttPublisher("test.mosquitto.org", deadband=deadband)
+    """
+
+    # Seconds after which a field is published even if it has not changed
+    heartbeat = 300.0
+    # The (absolute, relative) deadband of the fields without one, which passes on any change
+    default = (0.0, 0.0)
+
+    def __init__(self, deadbands=None, heartbeat=None, default=None, clock=time.monotonic):
+        """ Initializes the filter
+
+        :param deadbands: A dict of field name to (absolute, relative) deadband
+        :param heartbeat: Seconds after which a field is published even if it has not changed
+        :param default: The (absolute, relative) deadband of the other fields
+        :param clock: The clock to time the heartbeats with, for testing
+        """
+        self.deadbands = dict(deadbands or {})
+        if heartbeat is not None:
+            self.heartbeat = heartbeat
+        if default is not None:
+            self.default = default
+        self._clock = clock
+        self._lock = threading.Lock()
+        # (key, field name): (last published value, time it was published)
+        self._published = {}
+        self.passed = 0
+        self.suppressed = 0
+
+    def _changed(self, name, value, last):
+        if value == last:
+            return False
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not isinstance(last, (int, float)):
+            return True
+        absolute, relative = self.deadbands.get(name, self.default)
+        return abs(value - last) > max(absolute, relative * abs(last))
+
+    def filter(self, key, fields):
+        """ Returns the fields that should be published, and records them as published
+
+        :param key: What the fields belong to, e.g. the topic prefix of the inverter
+        :param fields: A list of (name, value)
+        :returns: The list of (name, value) to publish
+        """
+        now = self._clock()
+        published = self._published
+        passed = []
+        with self._lock:
+            for name, value in fields:
+                last = published.get((key, name))
+                if last is None or now - last[1] >= self.heartbeat or self._changed(name, value, last[0]):
+                    published[(key, name)] = (value, now)
+                    passed.append((name, value))
+            self.passed += len(passed)
+            self.suppressed += len(fields) - len(passed)
+        return passed
+
+    def forget(self, key):
+        """ Forgets what was published for a key, so all of its fields are published next time
+
+        :param key: What the fields belong to, e.g. the topic prefix of the inverter
+        """
+        with self._lock:
+            for entry in [entry for entry in self._published if entry[0] == key]:
+                del self._published[entry]
+
+    def clear(self):
+        """ Forgets everything that was published, so every field of every key is published next time
+        """
+        with self._lock:
+            self._published.clear()
+
+    def suppressed_ratio(self):
+        """ Returns the fraction of the fields that were suppressed, or 0.0 if none have been filtered """
+        total = self.passed + self.suppressed
+        return self.suppressed / total if total else 0.0
@@ -1,17 +1,128 @@
 import struct
-import sys
+import threading
+from collections import OrderedDict
+from time import perf_counter
 
 from pymodbus.exceptions import ModbusIOException
 from pymodbus.framer import SOCKET_FRAME_HEADER
 from pymodbus.framer.socket_framer import ModbusSocketFramer
+from pymodbus.pdu import ExceptionResponse
 from pymodbus.utilities import computeCRC, hexlify_packets, checkCRC
 
+from PyGrowatt.growatt_cipher import get_cipher
+from PyGrowatt.growatt_metrics import registry, functionCodeLabels, framesReceived, crcErrors, discardedBytes, \
+    decodeSeconds
+
 # --------------------------------------------------------------------------- #
 # Logging
 # --------------------------------------------------------------------------- #
 import logging
 _logger = logging.getLogger(__name__)
 
+FRAME_COMPLETE = 0
+FRAME_INCOMPLETE = 1
+FRAME_INVALID = 2
+
+
+def _tid_tables(length):
+    """ Returns the change in CRC for every transaction id of a packet length
+
+    The Modbus CRC is affine, so the CRC of a packet whose transaction id is
+    tid is the CRC of the same packet with a zero transaction id XOR
+    high[tid >> 8] XOR low[tid & 0xff]. Each table is built from the CRC of
+    the eight single bit values of its byte.
+
+    :param length: The length of the packet, excluding the CRC
+    :returns: A (high, low) tuple of 256 entry lists
+    """
+    tables = _tidTables.get(length)
+    if tables is None:
+        zero = computeCRC(bytes(length))
+        tables = ([0] * 256, [0] * 256)
+        for position, table in enumerate(tables):
+            for bit in range(8):
+                value = 1 << bit
+                packet = bytearray(length)
+                packet[position] = value
+                delta = computeCRC(packet) ^ zero
+                for lower in range(value):
+                    table[value | lower] = table[lower] ^ delta
+        _tidTables[length] = tables
+    return tables
+
+
+_tidTables = {}
+
+
+class ResponseCache(object):
+    """ A bounded LRU cache of encoded response frames
+
+    Most replies (the ACKs, and the ping reply for a given datalogger) are
+    the same apart from their transaction id. The cache keeps the encrypted
+    frame of each with a zero transaction id, so GrowattV6Framer.buildPacket
+    only has to patch in the transaction id and correct the CRC. A single
+    cache is shared by every connection.
+    """
+
+    # The maximum number of frames to keep, the least recently used is evicted first
+    max_size = 1024
+
+    def __init__(self, max_size=None):
+        """ Initializes an empty cache
+
+        :param max_size: The maximum number of frames to keep
+        """
+        if max_size is not None:
+            self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Returns a cached frame and marks it as recently used
+
+        :param key: The key of the response
+        :returns: The (tail, crc, high, low) frame template, or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def put(self, key, packet):
+        """ Caches the frame of a response
+
+        :param key: The key of the response
+        :param packet: The packet with a zero transaction id, excluding the CRC
+        :returns: The (tail, crc, high, low) frame template
+        """
+        entry = (bytes(packet[2:]), computeCRC(packet)) + _tid_tables(len(packet))
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def clear(self):
+        """ Removes every frame from the cache
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+responseCache = ResponseCache()
+
 
 class GrowattV6Framer(ModbusSocketFramer):
     """ Growatt Modbus Socket Frame controller
@@ -31,67 +142,274 @@ class GrowattV6Framer(ModbusSocketFramer):
           2b     2b     2b        1b           1b         (N-2)b   2b
 
         while len(message) > 0:
-            tid, pid, length`, uid = struct.unpack(">HHHB", message)
-            request = message[0:7 + length - 1`]
-            message = [7 + length - 1:-2]
-            checksum = [-2:]
+            tid, pid, length, uid = struct.unpack(">HHHB", message)
+            request = message[0:6 + length]
+            checksum = message[6 + length:6 + length + 2]
+            message = message[6 + length + 2:]
 
-        * length = uid + function code + data + checksum
-        * The -1 is to account for the uid byte
+        * length = uid + function code + data
+        * The checksum is a Modbus CRC of the request
     """
 
+    # Number of consumed bytes to keep before moving the unprocessed data to the front of the buffer
+    compact_threshold = 4096
+    # The cache of constant response frames, or None to encode every response
+    response_cache = responseCache
+    # A header is only plausible with this protocol id and at most this MBAP length
+    protocol_id = 6
+    max_length = 1024
+
     def __init__(self, decoder, client=None, key=b'Growatt'):
         """ Initializes a new instance of the framer
 
         :param decoder: The decoder factory implementation to use
+        :param key: The key used to XOR the payload
         """
         self._key = key
+        self._cipher = get_cipher(key)
+        self._pid_marker = struct.pack('>H', self.protocol_id)
+        self.crc_errors = 0
+        self.discarded_bytes = 0
         ModbusSocketFramer.__init__(self, decoder, client=client)
 
-    def _process(self, callback, error=False):
+    # ----------------------------------------------------------------------- #
+    # Buffer management
+    #   Received data is appended to a bytearray and consumed by moving a read
+    #   offset, so processing a frame never copies the rest of the buffer. The
+    #   consumed bytes are only compacted away once there are enough of them.
+    # ----------------------------------------------------------------------- #
+    @property
+    def _buffer(self):
+        """ The unprocessed data (a copy, for compatibility with ModbusSocketFramer) """
+        return bytes(self._frame_buffer[self._offset:])
+
+    @_buffer.setter
+    def _buffer(self, data):
+        self._frame_buffer = bytearray(data)
+        self._offset = 0
+
+    def addToFrame(self, message):
+        """ Adds new packet data to the current frame buffer
+
+        :param message: The most recent packet
+        """
+        if self._offset and (self._offset >= self.compact_threshold or self._offset == len(self._frame_buffer)):
+            self._compact()
+        try:
+            self._frame_buffer += message
+        except BufferError:
+            # A memoryview of a previous frame is still alive, leave it with the old buffer
+            self._frame_buffer = self._frame_buffer[self._offset:] + message
+            self._offset = 0
+
+    def _compact(self):
+        try:
+            del self._frame_buffer[:self._offset]
+        except BufferError:
+            self._frame_buffer = self._frame_buffer[self._offset:]
+        self._offset = 0
+
+    def isFrameReady(self):
+        """ Check if there is enough data for a header
+
+        :returns: True if ready, False otherwise
+        """
+        return len(self._frame_buffer) - self._offset > self._hsize
+
+    def getFrame(self):
+        """ Return the current frame from the buffered data
+
+        :returns: The function code and encrypted payload of the frame
+        """
+        start = self._offset + self._hsize
+        return bytes(self._frame_buffer[start:self._offset + self._frameLength() - 2])
+
+    def getRawFrame(self):
+        """ Returns the complete (unprocessed) buffer
+        """
+        return self._buffer
+
+    def resetFrame(self):
+        """ Reset the entire message frame.
+        """
+        self._buffer = b''
+        self._header = {'tid': 0, 'pid': 0, 'len': 0, 'uid': 0}
+
+    # ----------------------------------------------------------------------- #
+    # Framing
+    # ----------------------------------------------------------------------- #
+    def processIncomingPacket(self, data, callback, unit, **kwargs):
+        """ Adds new data to the buffer and processes every complete frame
+
+        A single read may hold several frames, or only part of one. Every
+        complete frame is decoded and pushed to the callback; an incomplete
+        frame is kept in the buffer until the rest of it arrives.
+
+        :param data: The new packet data
+        :param callback: The function to send results to
+        :param unit: Process if unit id matches, ignore otherwise (could be a
+               list of unit ids (server) or single unit id(client/server)
+        :param single: True or False (If True, ignore unit address validation)
+        """
+        if not isinstance(unit, (list, tuple)):
+            unit = [unit]
+        single = kwargs.get("single", False)
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug("Processing: " + hexlify_packets(data))
+        self.addToFrame(data)
+        for header, frame in self.scanFrames():
+            self._header = header
+            try:
+                if self._validate_unit_id(unit, single):
+                    self._processFrame(frame, callback)
+                else:
+                    _logger.debug("Not a valid unit id - {}, ignoring!!".format(header['uid']))
+            except ModbusIOException as e:
+                # Keep going, the other frames in this read are still valid
+                _logger.warning("Unable to decode frame (tid: %d): %s", header['tid'], e)
+            finally:
+                frame.release()
+        self._header = {'tid': 0, 'pid': 0, 'len': 0, 'uid': 0}
+
+    def scanFrames(self):
+        """ Removes every complete frame from the buffer
+
+        The frame boundaries are found from the MBAP length, and the CRC of
+        each frame is only checked once all of its bytes have arrived. If
+        the header is implausible or the CRC is invalid, the buffer is
+        resynchronised to the next plausible header.
+
+        Each frame is a memoryview into the buffer. Release it (or drop every
+        reference to it) once it has been processed, otherwise the next
+        addToFrame has to copy the buffer rather than extend it.
+
+        :returns: A list of (header, frame) tuples, where frame is the
+                  function code followed by the encrypted payload
+        """
+        frames = []
+        with memoryview(self._frame_buffer) as view:
+            while self.isFrameReady():
+                status = self._frameStatus(view)
+                if status == FRAME_INCOMPLETE:
+                    break
+                if status == FRAME_COMPLETE:
+                    start = self._offset + self._hsize
+                    frames.append((dict(self._header), view[start:self._offset + self._frameLength() - 2]))
+                    self.advanceFrame()
+                else:
+                    self._resync()
+        return frames
+
+    def _isPlausible(self, offset):
+        """ Checks whether a header could start at an offset in the buffer
+
+        The protocol id, length and function code are checked. The caller
+        must ensure the header and function code are in the buffer.
+
+        :param offset: The position of the candidate header
+        :returns: True if the header looks valid
+        """
+        pid, length, _, function_code = struct.unpack_from('>2xHHBB', self._frame_buffer, offset)
+        return (pid == self.protocol_id and 2 <= length <= self.max_length and
+                self.decoder.lookupPduClass(function_code) is not ExceptionResponse)
+
+    def _resync(self):
+        """ Discards bytes up to the next plausible header
+
+        The protocol id is located with bytearray.find, so the cost is
+        proportional to the number of bytes skipped. A candidate is not
+        trusted until the next scan has checked its CRC, which sends us back
+        here (one byte further on) if it was a false match.
+        """
+        buffer = self._frame_buffer
+        start = self._offset
+        # The protocol id follows the 2 byte transaction id
+        position = buffer.find(self._pid_marker, start + 3)
+        while position != -1:
+            candidate = position - 2
+            if len(buffer) - candidate <= self._hsize or self._isPlausible(candidate):
+                break
+            position = buffer.find(self._pid_marker, position + 1)
+        else:
+            # No candidate, keep enough bytes that a header split across reads is not lost
+            candidate = max(start + 1, len(buffer) - self._hsize)
+
+        discarded = candidate - start
+        self.discarded_bytes += discarded
+        if registry.enabled:
+            discardedBytes.inc(discarded)
+        self._offset = candidate
+        self._header = {'tid': 0, 'pid': 0, 'len': 0, 'uid': 0}
+        _logger.debug("Resynchronising, discarded %d bytes", discarded)
+
+    def _frameStatus(self, view=None):
+        """ Decodes the header at the read offset and checks the frame
+
+        :param view: A memoryview of the buffer, to avoid creating another
+        :returns: FRAME_COMPLETE, FRAME_INCOMPLETE or FRAME_INVALID
         """
-        Process incoming packets irrespective error condition
+        offset = self._offset
+        (self._header['tid'], self._header['pid'],
+         self._header['len'], self._header['uid']) = struct.unpack_from('>HHHB', self._frame_buffer, offset)
+
+        # someone sent us an error or garbage? don't wait for the rest of it
+        if not self._isPlausible(offset):
+            return FRAME_INVALID
+
+        end = offset + self._frameLength()
+        if len(self._frame_buffer) < end:
+            return FRAME_INCOMPLETE
+
+        # Swap byte order for CRC. Not sure why the computeCRC function swaps the two bytes, but it does. To work
+        # around this, we will just unpack the CRC as little-endian
+        crc = struct.unpack_from("<H", self._frame_buffer, end - 2)[0]
+        if view is None:
+            with memoryview(self._frame_buffer) as view:
+                valid = checkCRC(view[offset:end - 2], crc)
+        else:
+            valid = checkCRC(view[offset:end - 2], crc)
+        if not valid:
+            _logger.debug("CRC invalid, discarding packet!!")
+            self.crc_errors += 1
+            if registry.enabled:
+                crcErrors.inc()
+            return FRAME_INVALID
+        return FRAME_COMPLETE
+
+    def _frameLength(self):
+        # The MBAP length counts the uid, function code and data. Add the rest of the header and the CRC.
+        return self._hsize + self._header['len'] + 1
+
+    def _processFrame(self, frame, callback):
+        """ Decrypts and decodes a single frame
+
+        :param frame: The function code followed by the encrypted payload
+        :param callback: The function to send the result to
         """
-        data = self.getRawFrame() if error else self.getFrame()
-        # data contains the function_code, then encrypted payload
-        payload = self._xor(data[1:])
-        data = bytes([data[0]]) + payload
+        # Decrypt everything after the function code in one pass, then hand
+        # the decoder a view so slicing off the function code does not copy
+        start = perf_counter() if registry.enabled else None
+        data = memoryview(self._cipher.xor(frame, 1))
         result = self.decoder.decode(data)
+        if start is not None:
+            labels = functionCodeLabels[frame[0]]
+            decodeSeconds.observe(perf_counter() - start, labels)
+            framesReceived.inc(1, labels)
         if result is None:
             raise ModbusIOException("Unable to decode request")
-        elif error and result.function_code < 0x80:
-            if self.checkFrame():
-                _logger.info(
-                    "tid: " + hex(self._header["tid"]) + ", pid: " + hex(self._header["pid"]) + ", len: " + str(
-                        self._header["len"]) + ", uid: " + hex(self._header["uid"]) + "fc: " + hex(
-                        result.function_code) + " Raw Frame: " + hexlify_packets(data))
-        else:
-            self.populateResult(result)
-            self.advanceFrame()
-            callback(result)  # defer or push to a thread?
+        self.populateResult(result)
+        callback(result)  # defer or push to a thread?
 
     def checkFrame(self):
         """
-        Check and decode the next frame Return true if we were successful
+        Check the next frame, return True if it is complete and its CRC is valid
         """
         if self.isFrameReady():
-            (self._header['tid'], self._header['pid'],
-             self._header['len'], self._header['uid']) = struct.unpack(
-                '>HHHB', self._buffer[0:self._hsize])
-            data = self._buffer[:-2]
-            # Swap byte order for CRC. Not sure why the computeCRC function swaps the two bytes, but it does. To work
-            # around this, we will just unpack the CRC as little-endian
-            crc = struct.unpack("<H", self._buffer[-2:])[0]
-            if not checkCRC(data, crc):
-                _logger.debug("CRC invalid, discarding packet!!")
-                return False
-
-            # someone sent us an error? ignore it
-            if self._header['len'] < 2:
-                self.advanceFrame()
-            # we have at least a complete message, continue
-            elif len(self._buffer) - self._hsize + 1 >= self._header['len']:
+            status = self._frameStatus()
+            if status == FRAME_COMPLETE:
                 return True
+            if status == FRAME_INVALID and self._header['len'] < 2:
+                self.advanceFrame()
         # we don't have enough of a message yet, wait
         return False
 
@@ -102,37 +420,48 @@ class GrowattV6Framer(ModbusSocketFramer):
         current frame header handle
         """
         # Override the ModbusSocketFramer method to account for the extra two bytes per frame due to the CRC.
-        # Instead of being "-1" to account for double-counting the uid in the header, we "-1+2", or simply "+1" byte.
-        length = self._hsize + self._header['len'] + 1
-        self._buffer = self._buffer[length:]
+        self._offset += self._frameLength()
+        if self._offset >= len(self._frame_buffer):
+            self._offset = len(self._frame_buffer)
         self._header = {'tid': 0, 'pid': 0, 'len': 0, 'uid': 0}
 
     def buildPacket(self, message):
         """ Creates a ready to send modbus packet
 
+        A response with a cache_key is only encoded the first time, after
+        that the cached frame is reused with the transaction id patched in.
+
+        :param message: The populated request/response to send
+        """
+        cache = self.response_cache
+        cache_key = getattr(message, 'cache_key', None)
+        key = cache_key() if cache is not None and cache_key is not None else None
+        if key is None:
+            packet = self._encodePacket(message, message.transaction_id)
+            return packet + struct.pack("<H", computeCRC(packet))
+
+        key = (self._key, message.protocol_id, message.unit_id, message.function_code, key)
+        entry = cache.get(key)
+        if entry is None:
+            entry = cache.put(key, self._encodePacket(message, 0))
+        tail, crc, high, low = entry
+        tid = message.transaction_id & 0xffff
+        return struct.pack(">H", tid) + tail + struct.pack("<H", crc ^ high[tid >> 8] ^ low[tid & 0xff])
+
+    def _encodePacket(self, message, transaction_id):
+        """ Encodes and encrypts a message, without the CRC
+
         :param message: The populated request/response to send
+        :param transaction_id: The transaction id to put in the header
         """
         data = message.encode()
         packet = struct.pack(SOCKET_FRAME_HEADER,
-                             message.transaction_id,
+                             transaction_id,
                              message.protocol_id,
                              len(data) + 2,
                              message.unit_id,
                              message.function_code)
-        packet += self._xor(data)
-        packet += struct.pack("<H", computeCRC(packet))
-        return packet
+        return packet + self._xor(data)
 
     def _xor(self, data):
-        if sys.version_info[0] == 2:
-            decrypted = ''
-            for i in range(0, len(data)):
-                decrypted += chr(ord(data[i]) ^ ord(self._key[i % len(self._key)]))
-            return decrypted
-        elif sys.version_info[0] == 3:
-            decrypted = b''
-            for i in range(0, len(data)):
-                decrypted += bytes([data[i] ^ self._key[i % len(self._key)]])
-            return decrypted
-        else:
-            return data
+        return self._cipher.xor(data)
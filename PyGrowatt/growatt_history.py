@@ -0,0 +1,121 @@
+"""
+Growatt Energy History
+--------------------------------------------------------------------------
+
+GrowattEnergyRequest.execute overwrites the input registers, so any frame
+that arrives between two publishes is lost when the publisher resets the
+store. EnergyHistory keeps the last N decoded energy frames of an inverter
+in a fixed size ring buffer backed by a flat array, so publishers can read
+every sample since their last cursor instead.
+"""
+import threading
+import time
+from array import array
+from collections import namedtuple
+from operator import attrgetter
+
+from PyGrowatt.Growatt import energySchema
+
+# The stored fields, in the order they are stored in each row
+historyFields = ("timestamp",) + tuple(energySchema.registers())
+
+EnergySample = namedtuple("EnergySample", historyFields)
+
+
+def inverter_timestamp(message, default=None):
+    """ Converts the date and time of an energy frame to a Unix timestamp
+
+    Energy frames carry a two digit year in the inverter's local time.
+
+    :param message: The decoded energy request
+    :param default: The value to return if the frame has no valid date
+    :returns: The timestamp in seconds
+    """
+    if not (1 <= message.month <= 12 and 1 <= message.day <= 31 and message.hour < 24 and message.min < 60
+            and message.sec < 60):
+        return default
+    year = message.year + 2000 if message.year < 100 else message.year
+    try:
+        return int(time.mktime((year, message.month, message.day, message.hour, message.min, message.sec,
+                                0, 0, -1)))
+    except (OverflowError, ValueError):
+        return default
+
+
+class EnergyHistory(object):
+    """ A fixed capacity ring buffer of energy samples
+
+    Every sample is given a sequence number. A reader keeps the number of
+    the next sample it wants (its cursor) and calls since(cursor) to get
+    every sample it has not seen yet::
+
+        samples, cursor = history.since(cursor)
+    """
+
+    # One day of samples with a 1 minute update interval
+    default_capacity = 24 * 60
+
+    def __init__(self, capacity=None):
+        """ Initializes an empty history
+
+        :param capacity: The number of samples to keep
+        """
+        self.capacity = capacity or self.default_capacity
+        self.width = len(historyFields)
+        # Every stored value is an unsigned 32 bit register (the timestamp fits until 2106)
+        self._data = array('I', [0]) * (self.width * self.capacity)
+        self._values = attrgetter(*historyFields[1:])
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def cursor(self):
+        """ The sequence number the next sample will be given """
+        return self._count
+
+    @property
+    def nbytes(self):
+        """ The size of the sample storage in bytes """
+        return self._data.itemsize * len(self._data)
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def append(self, message, timestamp=None):
+        """ Adds the values of a decoded energy request, overwriting the oldest sample when full
+
+        :param message: The decoded GrowattEnergyRequest
+        :param timestamp: The time of the sample, defaults to the inverter's timestamp
+        """
+        if timestamp is None:
+            timestamp = inverter_timestamp(message, default=int(time.time()))
+        row = array('I', [timestamp])
+        row.extend(self._values(message))
+        with self._lock:
+            start = (self._count % self.capacity) * self.width
+            self._data[start:start + self.width] = row
+            self._count += 1
+
+    def since(self, cursor=0):
+        """ Returns every sample from a cursor onwards
+
+        If the reader has fallen more than capacity samples behind, the
+        samples that have been overwritten are skipped.
+
+        :param cursor: The sequence number of the first sample wanted
+        :returns: A list of EnergySample, and the cursor to use next time
+        """
+        with self._lock:
+            end = self._count
+            start = max(cursor, end - self.capacity, 0)
+            width = self.width
+            samples = []
+            for sequence in range(start, end):
+                offset = (sequence % self.capacity) * width
+                samples.append(EnergySample._make(self._data[offset:offset + width]))
+        return samples, end
+
+    def latest(self):
+        """ Returns the most recent sample, or None if the history is empty """
+        samples, _ = self.since(self._count - 1)
+        return samples[0] if samples else None
@@ -0,0 +1,344 @@
+"""
+Growatt Metrics
+--------------------------------------------------------------------------
+
+Counters, gauges and histograms for the server hot path, and a local HTTP
+endpoint that serves them in the Prometheus text format.
+
+Collection is disabled until the registry is enabled (starting a
+MetricsServer does so). Every instrumented call site checks
+registry.enabled first, so a disabled registry costs one attribute lookup
+per frame.
+
+Example::
+
+    registry.add_collector(InverterCollector(context))
+    MetricsServer(address=("127.0.0.1", 9108)).start()
+"""
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from the tens of microseconds a frame takes to decode to the seconds an upload can take
+DEFAULT_BUCKETS = (25e-6, 50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3, 100e-3,
+                   250e-3, 500e-3, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        """ Initializes a new metric
+
+        :param name: The metric name
+        :param documentation: The HELP text
+        :param labels: The label names, the values are passed as a tuple in the same order
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _label_string(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % (name, _escape(value)) for name, value in pairs) + "}"
+
+    def clear(self):
+        """ Removes every sample """
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """ Returns the samples of the metric
+
+        :returns: A list of (name, label string, value)
+        """
+        with self._lock:
+            return [(self.name, self._label_string(labels), value) for labels, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.kind)]
+        lines.extend("%s%s %s" % (name, labels, _format_value(value)) for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """ A value that only goes up """
+    kind = "counter"
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+
+class Gauge(_Metric):
+    """ A value that goes up and down """
+    kind = "gauge"
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+
+class Histogram(_Metric):
+    """ Counts observations into buckets """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        """ Initializes a new histogram
+
+        :param name: The metric name
+        :param documentation: The HELP text
+        :param labels: The label names
+        :param buckets: The upper bounds of the buckets, in increasing order
+        """
+        _Metric.__init__(self, name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # The count in each bucket (and +Inf), then the sum
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[bisect_left(self.buckets, value)] += 1
+            state[-1] += value
+
+    def count(self, labels=()):
+        state = self._values.get(labels)
+        return sum(state[:-1]) if state is not None else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for labels, state in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), state):
+                    cumulative += count
+                    samples.append((self.name + "_bucket", self._label_string(labels, [("le", _format_value(bound))]),
+                                    cumulative))
+                samples.append((self.name + "_sum", self._label_string(labels), state[-1]))
+                samples.append((self.name + "_count", self._label_string(labels), cumulative))
+        return samples
+
+
+class MetricsRegistry(object):
+    """ The metrics to expose, and whether they are being collected
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics = OrderedDict()
+        self._collectors = []
+
+    def _add(self, cls, name, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError("%s is already registered as a %s" % (name, metric.kind))
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._add(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, labels=()):
+        return self._add(Gauge, name, documentation, labels)
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram, name, documentation, labels, buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def add_collector(self, collector):
+        """ Adds a callable that returns a list of metrics each time they are rendered
+
+        :param collector: The callable
+        """
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        self._collectors.remove(collector)
+
+    def reset(self):
+        """ Removes the samples of every metric """
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def render(self):
+        """ Formats every metric in the Prometheus text format
+
+        :returns: The text, as a str
+        """
+        metrics = list(self._metrics.values())
+        for collector in list(self._collectors):
+            try:
+                metrics.extend(collector())
+            except Exception as e:
+                _logger.warning("Metrics collector %r failed: %s", collector, e)
+        return "".join(metric.render() + "\n" for metric in metrics)
+
+
+class InverterCollector(object):
+    """ Reports the last time each inverter was seen, from a GrowattServerContext
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    def __call__(self):
+        gauge = Gauge("growatt_inverter_last_seen_timestamp_seconds", "When each inverter last sent a frame",
+                      ("wifi_serial",))
+        for inverter in self.context.inverters():
+            gauge.set(inverter.last_seen, (inverter.wifi_serial.decode("ascii", "replace"),))
+        return [gauge]
+
+
+class AggregateCollector(object):
+    """ Reports the fleet and group totals of a FleetAggregates, the fleet with an empty group label
+    """
+
+    def __init__(self, aggregates):
+        self.aggregates = aggregates
+
+    def __call__(self):
+        inverters = Gauge("growatt_fleet_inverters", "Inverters reporting energy frames", ("group",))
+        faults = Gauge("growatt_fleet_faults", "Inverters in Fault status", ("group",))
+        sums = Gauge("growatt_fleet_sum", "The sum of an energy field over the inverters, in engineering units",
+                     ("group", "field"))
+        for name, aggregate in self.aggregates.items():
+            group = name or ""
+            summary = aggregate.summary()
+            inverters.set(summary["count"], (group,))
+            faults.set(summary["faults"], (group,))
+            for field in aggregate.fields:
+                sums.set(summary[field]["sum"], (group, field))
+        return [inverters, faults, sums]
+
+
+# --------------------------------------------------------------------------- #
+# The metrics of the server hot path
+# --------------------------------------------------------------------------- #
+registry = MetricsRegistry()
+
+# The function code label of every possible function code, so the hot path never formats one
+functionCodeLabels = tuple(("0x%02x" % code,) for code in range(256))
+
+framesReceived = registry.counter("growatt_frames_received_total", "Frames received, by function code",
+                                  ("function_code",))
+crcErrors = registry.counter("growatt_crc_errors_total", "Frames discarded because of an invalid CRC")
+discardedBytes = registry.counter("growatt_discarded_bytes_total", "Bytes skipped to find the next frame")
+decodeSeconds = registry.histogram("growatt_decode_seconds", "Time to decrypt and decode a frame",
+                                   ("function_code",))
+executeSeconds = registry.histogram("growatt_execute_seconds", "Time to execute a request against the datastore",
+                                    ("function_code",))
+activeConnections = registry.gauge("growatt_connections", "Connected ShineWiFi-X modules")
+sinkPublishSeconds = registry.histogram("growatt_sink_publish_seconds", "Time to publish to a sink", ("sink",))
+sinkFailures = registry.counter("growatt_sink_failures_total", "Failed publishes to a sink", ("sink",))
+sinkDropped = registry.counter("growatt_sink_dropped_total", "Items dropped by a full sink queue", ("sink",))
+sinkQueueDepth = registry.gauge("growatt_sink_queue_depth", "Items waiting to be published to a sink", ("sink",))
+sinkSuppressed = registry.counter("growatt_sink_suppressed_total",
+                                  "Messages not published to a sink because nothing changed beyond its deadband",
+                                  ("sink",))
+# From the energy frame arriving at the server to the sink publishing it, which can be minutes if a sink polls
+sinkLatencySeconds = registry.histogram("growatt_sink_latency_seconds",
+                                        "Time from an energy frame arriving to it being published to a sink",
+                                        ("sink",), buckets=(10e-3, 25e-3, 50e-3, 100e-3, 250e-3, 500e-3, 1.0, 2.5,
+                                                            5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class MetricsServer(object):
+    """ Serves a registry at /metrics from a background thread
+    """
+
+    def __init__(self, registry=registry, address=("127.0.0.1", 9108)):
+        """ Initializes a new server
+
+        :param registry: The MetricsRegistry to serve
+        :param address: The (interface, port) to bind to. Only localhost by default
+        """
+        self.registry = registry
+        self.address = address
+        self._server = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1] if self._server is not None else None
+
+    def start(self):
+        """ Enables the registry and starts serving it
+        """
+        self._server = ThreadingHTTPServer(self.address, _MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.registry = self.registry
+        self.registry.enabled = True
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={"poll_interval": 0.1},
+                                        name="MetricsServer", daemon=True)
+        self._thread.start()
+        _logger.info("Serving metrics on http://%s:%d/metrics", self.address[0] or "0.0.0.0", self.port)
+
+    def stop(self):
+        """ Stops serving, the registry is left enabled
+        """
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+
@@ -0,0 +1,247 @@
+"""
+Growatt MQTT Publisher
+--------------------------------------------------------------------------
+
+Publishes the energy data of an inverter to an MQTT broker over a single
+long lived connection. The paho client reconnects in its network thread if
+the broker goes away, and queues (a bounded number of) messages while it
+is disconnected.
+
+Each cycle reads the input registers once and publishes them either as one
+topic per field (the topics used by the example script) or as a single
+compact JSON payload. With a DeadbandFilter, only the topics whose field
+has changed beyond its deadband (or whose heartbeat has expired) are
+published, and the JSON payload is only published if any field has.
+Every field is published again after a failed publish or a reconnect.
+"""
+import json
+import time
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:  # pragma: no cover
+    mqtt = None
+
+from PyGrowatt.Growatt import inverter_status_description
+from PyGrowatt.growatt_datastore import read_snapshot
+from PyGrowatt.growatt_metrics import registry, sinkPublishSeconds, sinkFailures, sinkSuppressed
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+# The (topic, field, divisor) of each published input register
+mqttTopics = [
+    ("inverter/status", "inverter_status", None),
+    ("PV/power", "Ppv", 10),
+    ("PV/energy/total", "Epv_total", 10),
+    ("PV1/voltage", "Vpv1", 10),
+    ("PV1/current", "Ipv1", 10),
+    ("PV1/power", "Ppv1", 10),
+    ("PV1/energy/today", "Epv1_today", 10),
+    ("PV1/energy/total", "Epv1_total", 10),
+    ("PV2/voltage", "Vpv2", 10),
+    ("PV2/current", "Ipv2", 10),
+    ("PV2/power", "Ppv2", 10),
+    ("PV2/energy/today", "Epv2_today", 10),
+    ("PV2/energy/total", "Epv2_total", 10),
+    ("AC/power", "Pac", 10),
+    ("AC/frequency", "Fac", 100),
+    ("AC1/voltage", "Vac1", 10),
+    ("AC1/current", "Iac1", 10),
+    ("AC1/power", "Pac1", 10),
+    ("AC/energy/today", "Eac_today", 10),
+    ("AC/energy/total", "Eac_total", 10),
+]
+
+
+def scale_snapshot(snapshot):
+    """ Converts the raw register values to the published values
+
+    :param snapshot: A dict of raw register values, by field name
+    :returns: A list of (topic, field, value)
+    """
+    scaled = []
+    for topic, name, divisor in mqttTopics:
+        value = snapshot[name]
+        if divisor is None:
+            value = inverter_status_description.get(value, value)
+        else:
+            value = value / divisor
+        scaled.append((topic, name, value))
+    return scaled
+
+
+def check_published(infos):
+    """ Raises an IOError if any message could not be handed to the broker
+
+    At QoS 0, GrowattMqttPublisher.publish does not raise while the broker
+    is unreachable, each message info just has an error code. A Sink only
+    retries an item when its publish callable raises, so the callable should
+    check the infos with this.
+
+    :param infos: The list of paho MQTTMessageInfo returned by publish()
+    """
+    failed = [info for info in infos if info.rc != mqtt.MQTT_ERR_SUCCESS]
+    if failed:
+        raise IOError("%d of %d MQTT messages were not sent: %s" % (len(failed), len(infos),
+                                                                     mqtt.error_string(failed[0].rc)))
+
+
+class GrowattMqttPublisher(object):
+    """ A persistent connection to an MQTT broker
+
+    Example::
+
+        publisher = GrowattMqttPublisher("test.mosquitto.org")
+        publisher.start()
+        publisher.publish_datastore(store)
+    """
+
+    def __init__(self, host, port=1883, client_id="Growatt MQTT", prefix="home/solar", payload="topics", qos=0,
+                 retain=True, max_inflight=20, max_queued=1000, keepalive=60, deadband=None):
+        """ Initializes the publisher
+
+        :param host: The broker host name or IP address
+        :param port: The broker port
+        :param client_id: The MQTT client id
+        :param prefix: The topic every message is published under
+        :param payload: "topics" to publish a topic per field, or "json" for one JSON payload
+        :param qos: The QoS of published messages
+        :param retain: Whether the broker should retain the published messages
+        :param max_inflight: The maximum number of QoS > 0 messages awaiting acknowledgement. QoS 0 messages
+                             are not acknowledged, so this has no effect at the default qos
+        :param max_queued: The maximum number of messages queued while disconnected (0 is unbounded)
+        :param keepalive: Seconds between pings when idle
+        :param deadband: A DeadbandFilter to only publish the fields that have changed, or None to publish every field
+        """
+        if mqtt is None:
+            raise ImportError("GrowattMqttPublisher requires paho-mqtt")
+        if payload not in ("topics", "json"):
+            raise ValueError("Unknown MQTT payload type: %s" % payload)
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.keepalive = keepalive
+        self.deadband = deadband
+        self.connected = False
+        self._stopping = False
+        self.cycles = 0
+        self.last_cycle = None
+        # Messages published, and not published because of the deadband filter
+        self.published = 0
+        self.suppressed = 0
+
+        try:
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+        except AttributeError:
+            # paho-mqtt < 2.0
+            self.client = mqtt.Client(client_id=client_id)
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.max_queued_messages_set(max_queued)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=120)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        self.connected = rc == 0
+        if self.deadband is not None:
+            # QoS 0 messages can be lost with the connection, so publish every field again
+            self.deadband.clear()
+        _logger.info("Connected to MQTT broker %s:%s (%s)", self.host, self.port, rc)
+
+    def _on_disconnect(self, client, userdata, *args):
+        self.connected = False
+        if not self._stopping:
+            _logger.warning("Disconnected from MQTT broker %s:%s, reconnecting", self.host, self.port)
+
+    def start(self):
+        """ Connects to the broker in the background, reconnecting whenever the connection is lost
+        """
+        _logger.debug("Connecting to %s:%s", self.host, self.port)
+        self._stopping = False
+        self.client.connect_async(self.host, self.port, keepalive=self.keepalive)
+        self.client.loop_start()
+
+    def stop(self):
+        """ Disconnects from the broker
+        """
+        self._stopping = True
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def messages(self, snapshot, prefix=None):
+        """ Builds the messages for a snapshot
+
+        :param snapshot: A dict of raw register values, by field name
+        :param prefix: The topic prefix, defaults to the publisher's
+        :returns: A list of (topic, payload), less any the deadband filter suppresses
+        """
+        prefix = prefix or self.prefix
+        scaled = scale_snapshot(snapshot)
+        changed = None
+        if self.deadband is not None:
+            changed = set(name for name, _ in self.deadband.filter(prefix, [(name, value)
+                                                                            for _, name, value in scaled]))
+        if self.payload == "json":
+            if changed is not None and not changed:
+                return []
+            payload = json.dumps({name: value for _, name, value in scaled}, separators=(",", ":"))
+            return [(prefix + "/state", payload)]
+        return [(prefix + "/" + topic, str(value)) for topic, name, value in scaled
+                if changed is None or name in changed]
+
+    def publish(self, snapshot, prefix=None, timeout=None):
+        """ Publishes a snapshot
+
+        The messages are all handed to the network thread before waiting,
+        so they are pipelined on the connection rather than sent one by one.
+
+        :param snapshot: A dict of raw register values, by field name
+        :param prefix: The topic prefix, defaults to the publisher's
+        :param timeout: Seconds to wait for the messages to be sent, or None to not wait
+        :returns: The list of paho MQTTMessageInfo
+        """
+        start = time.monotonic()
+        infos = [self.client.publish(topic, payload, qos=self.qos, retain=self.retain)
+                 for topic, payload in self.messages(snapshot, prefix)]
+        if self.deadband is not None and any(info.rc != mqtt.MQTT_ERR_SUCCESS for info in infos):
+            # The filter recorded the fields as published, forget them so the next frame is published in full
+            self.deadband.forget(prefix or self.prefix)
+        suppressed = (1 if self.payload == "json" else len(mqttTopics)) - len(infos)
+        self.published += len(infos)
+        self.suppressed += suppressed
+        if timeout is not None:
+            deadline = start + timeout
+            for info in infos:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    break
+                info.wait_for_publish(remaining)
+        self.cycles += 1
+        self.last_cycle = time.monotonic() - start
+        if registry.enabled:
+            sinkPublishSeconds.observe(self.last_cycle, ("mqtt",))
+            if suppressed:
+                sinkSuppressed.inc(suppressed, ("mqtt",))
+            if any(info.rc != mqtt.MQTT_ERR_SUCCESS or (timeout is not None and not info.is_published())
+                   for info in infos):
+                sinkFailures.inc(1, ("mqtt",))
+        _logger.debug("Published %d messages (%d suppressed) in %.1fms", len(infos), suppressed,
+                      self.last_cycle * 1000)
+        return infos
+
+    def publish_datastore(self, datastore, prefix=None, timeout=None):
+        """ Reads a snapshot of a datastore and publishes it
+
+        :param datastore: The ModbusSlaveContext of an inverter
+        :param prefix: The topic prefix, defaults to the publisher's
+        :param timeout: Seconds to wait for the messages to be sent, or None to not wait
+        :returns: The list of paho MQTTMessageInfo
+        """
+        return self.publish(read_snapshot(datastore), prefix, timeout)
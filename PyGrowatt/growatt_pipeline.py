@@ -0,0 +1,499 @@
+"""
+Growatt Sink Pipeline
+--------------------------------------------------------------------------
+
+Hands each energy snapshot from the server to the publishers (MQTT,
+PVOutput, ...) as it arrives, instead of the publishers polling the
+datastore on a timer. Every sink has its own bounded queue and worker
+thread, so a slow or failing sink only ever delays itself: the server
+thread puts a snapshot on each queue without waiting, and a full queue
+applies its overflow policy rather than blocking:
+
+ * drop-oldest: the oldest queued item is dropped to make room
+ * coalesce-latest: only the latest item per key (inverter) is kept
+ * spill: items that do not fit are appended to a file on disk, and read
+   back in order once the sink catches up
+
+A coalesce-latest queue can also hold each inverter's item for a window
+after it arrives, so a burst of frames is published once, and cap how
+often each inverter is published.
+"""
+import heapq
+import json
+import threading
+import time
+from collections import deque, OrderedDict
+
+from PyGrowatt.growatt_metrics import registry, sinkFailures, sinkDropped, sinkQueueDepth, sinkLatencySeconds
+from PyGrowatt.growatt_snapshot import EnergySnapshot
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop-oldest"
+COALESCE_LATEST = "coalesce-latest"
+SPILL = "spill"
+
+overflowPolicies = (DROP_OLDEST, COALESCE_LATEST, SPILL)
+
+
+def dump_snapshot(key, snapshot):
+    """ Encodes a queued (key, EnergySnapshot) as a line of the spill file
+
+    :param key: The WiFi serial of the inverter, or None
+    :param snapshot: The EnergySnapshot
+    :returns: The line, as bytes
+    """
+    return json.dumps([key.decode("latin-1") if key is not None else None, list(snapshot)],
+                      separators=(",", ":")).encode("utf-8")
+
+
+def load_snapshot(line):
+    """ Decodes a line written by dump_snapshot
+
+    :param line: The line, as bytes
+    :returns: The (key, EnergySnapshot)
+    """
+    key, values = json.loads(line)
+    return key.encode("latin-1") if key is not None else None, EnergySnapshot._make(values)
+
+
+class _SpillFile(object):
+    """ An append-only file of queued items, read back in order
+
+    The offset of the first unread item is saved alongside it (in
+    path + ".offset"), so items that were read before a restart are not
+    read again.
+    """
+
+    def __init__(self, path, dumps, loads):
+        self.path = path
+        self._dumps = dumps
+        self._loads = loads
+        self._file = open(path, "a+b")
+        # Items left by the last run are still pending, less a partial line left by a crash
+        self._file.seek(0)
+        data = self._file.read()
+        if data and not data.endswith(b"\n"):
+            data = data[:data.rfind(b"\n") + 1]
+            self._file.truncate(len(data))
+        self._offset_file = open(path + ".offset", "a+b")
+        self._offset_file.seek(0)
+        try:
+            offset = int(self._offset_file.read() or 0)
+        except ValueError:
+            offset = 0
+        if offset > len(data) or (offset and data[offset - 1:offset] != b"\n"):
+            # Not the start of an item, read everything again rather than lose any
+            _logger.warning("Ignoring the invalid offset %d of %s", offset, path)
+            offset = 0
+        self._count = data.count(b"\n", offset)
+        self._offset = offset
+
+    def __len__(self):
+        return self._count
+
+    def append(self, key, item):
+        self._file.write(self._dumps(key, item) + b"\n")
+        self._file.flush()
+        self._count += 1
+
+    def read(self, count):
+        """ Removes up to count items from the front of the file
+
+        :returns: A list of (key, item)
+        """
+        self._file.seek(self._offset)
+        lines = [self._file.readline() for _ in range(min(count, self._count))]
+        self._offset = self._file.tell()
+        self._count -= len(lines)
+        if not self._count:
+            # Everything has been read, so start again with an empty file
+            self._file.truncate(0)
+            self._offset = 0
+        self._save_offset()
+        items = []
+        for line in lines:
+            try:
+                items.append(self._loads(line))
+            except (ValueError, TypeError) as e:
+                _logger.error("Discarding an invalid item in %s: %s", self.path, e)
+        return items
+
+    def _save_offset(self):
+        self._offset_file.truncate(0)
+        self._offset_file.write(b"%d" % self._offset)
+        self._offset_file.flush()
+
+    def close(self):
+        self._file.close()
+        self._offset_file.close()
+
+
+class _Unkeyed(object):
+    """ Stands in for the key of an item queued without one, so it is never coalesced with another """
+    __slots__ = ()
+
+
+class SinkQueue(object):
+    """ A bounded queue of (key, item) that never blocks the producer
+
+    put() applies the overflow policy when the queue is full. get() blocks
+    the consumer until there is an item (or the queue is closed).
+
+    With the coalesce-latest policy, get() only returns a key's item once it
+    is due: window seconds after the first item for the key was queued, and
+    at least min_interval seconds after the key's last item was returned.
+    Items that arrive in the meantime replace the queued one. Items with a
+    key of None are neither coalesced nor rate limited.
+    """
+
+    # The maximum number of items held in memory
+    capacity = 1000
+
+    def __init__(self, capacity=None, policy=DROP_OLDEST, spill_path=None, dumps=dump_snapshot,
+                 loads=load_snapshot, window=0.0, min_interval=0.0, clock=time.monotonic):
+        """ Initializes an empty queue
+
+        :param capacity: The maximum number of items held in memory
+        :param policy: DROP_OLDEST, COALESCE_LATEST or SPILL
+        :param spill_path: The file to spill to, required by the SPILL policy
+        :param dumps: Encodes a (key, item) as a line of the spill file
+        :param loads: Decodes a line of the spill file
+        :param window: Seconds to hold a key's first item for newer ones to replace (COALESCE_LATEST only)
+        :param min_interval: The minimum seconds between two items of a key (COALESCE_LATEST only)
+        :param clock: The clock to schedule the items with, for testing
+        """
+        if policy not in overflowPolicies:
+            raise ValueError("Unknown overflow policy: %s" % policy)
+        if policy == SPILL and spill_path is None:
+            raise ValueError("The spill policy needs a spill_path")
+        if (window or min_interval) and policy != COALESCE_LATEST:
+            raise ValueError("A window and min_interval need the coalesce-latest policy")
+        if capacity is not None:
+            self.capacity = capacity
+        self.policy = policy
+        self.window = window
+        self.min_interval = min_interval
+        self._clock = clock
+        self._items = OrderedDict() if policy == COALESCE_LATEST else deque()
+        # The (due, sequence, key) of each coalesced item, and the sequence of the current entry for each key
+        self._due = []
+        self._entries = {}
+        self._sequence = 0
+        # The time each key's last item was returned, for min_interval
+        self._last = {}
+        self._spill = _SpillFile(spill_path, dumps, loads) if policy == SPILL else None
+        self._condition = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+        self.coalesced = 0
+        self.spilled = 0
+
+    def __len__(self):
+        return len(self._items) + (len(self._spill) if self._spill is not None else 0)
+
+    def put(self, key, item):
+        """ Adds an item, applying the overflow policy if the queue is full
+
+        :param key: The key to coalesce items by (the WiFi serial of the inverter), or None to not coalesce it
+        :param item: The item
+        :returns: False if an item was dropped to make room, otherwise True
+        """
+        items = self._items
+        with self._condition:
+            if self.policy == COALESCE_LATEST:
+                if key is None:
+                    key = _Unkeyed()
+                if key in items:
+                    # Replace the pending item in place, so a busy inverter does not lose its turn
+                    items[key] = item
+                    self.coalesced += 1
+                    return True
+                dropped = len(items) >= self.capacity
+                if dropped:
+                    del self._entries[items.popitem(last=False)[0]]
+                    self.dropped += 1
+                items[key] = item
+                now = self._clock()
+                due = now + self.window
+                last = self._last.get(key)
+                if last is not None:
+                    if last + self.min_interval <= now:
+                        del self._last[key]
+                    else:
+                        due = max(due, last + self.min_interval)
+                self._schedule(key, due)
+            elif self.policy == SPILL:
+                dropped = False
+                # Once items have spilled, everything after them spills too so the order is kept
+                if len(self._spill) or len(items) >= self.capacity:
+                    self._spill.append(key, item)
+                    self.spilled += 1
+                else:
+                    items.append((key, item))
+            else:
+                dropped = len(items) >= self.capacity
+                if dropped:
+                    items.popleft()
+                    self.dropped += 1
+                items.append((key, item))
+            self._condition.notify()
+        return not dropped
+
+    def requeue(self, key, item):
+        """ Puts an item that could not be published back at the front of the queue
+
+        :param key: The key of the item
+        :param item: The item
+        """
+        items = self._items
+        with self._condition:
+            if self.policy == COALESCE_LATEST:
+                if key is None:
+                    key = _Unkeyed()
+                if key in items:
+                    # A newer item has arrived since, so the failed one is not needed
+                    return
+                items[key] = item
+                items.move_to_end(key, last=False)
+                # Due straight away, ahead of everything else
+                self._schedule(key, float("-inf"))
+            elif self.policy == DROP_OLDEST and len(items) >= self.capacity:
+                self.dropped += 1
+                return
+            else:
+                items.appendleft((key, item))
+            self._condition.notify()
+
+    def _schedule(self, key, due):
+        self._sequence += 1
+        self._entries[key] = self._sequence
+        heapq.heappush(self._due, (due, self._sequence, key))
+
+    def _next_due(self):
+        """ Returns the (due, key) of the next coalesced item, discarding the entries of dropped items """
+        due = self._due
+        while due:
+            when, sequence, key = due[0]
+            if self._entries.get(key) == sequence:
+                return when, key
+            heapq.heappop(due)
+        return None, None
+
+    def get(self, timeout=None):
+        """ Removes the oldest item, waiting for one if the queue is empty
+
+        :param timeout: Seconds to wait, or None to wait until there is an item or the queue is closed
+        :returns: The (key, item), or None if the queue was closed or the timeout expired
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        coalesce = self.policy == COALESCE_LATEST
+        with self._condition:
+            while not self._closed:
+                wait = None
+                if coalesce:
+                    due, key = self._next_due()
+                    if due is not None:
+                        now = self._clock()
+                        if due <= now:
+                            heapq.heappop(self._due)
+                            del self._entries[key]
+                            if isinstance(key, _Unkeyed):
+                                return None, self._items.pop(key)
+                            if self.min_interval:
+                                self._last[key] = now
+                            return key, self._items.pop(key)
+                        wait = due - now
+                elif len(self):
+                    break
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._condition.wait(wait)
+            if self._closed:
+                return None
+            if not self._items:
+                self._items.extend(self._spill.read(self.capacity))
+                if not self._items:
+                    return None
+            return self._items.popleft()
+
+    def wait_closed(self, timeout):
+        """ Sleeps for a time, waking early if the queue is closed
+
+        :param timeout: Seconds to sleep
+        :returns: True if the queue is closed
+        """
+        with self._condition:
+            if not self._closed:
+                self._condition.wait_for(lambda: self._closed, timeout)
+            return self._closed
+
+    def close(self):
+        """ Wakes the consumer, and makes get() return None from now on
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def open(self):
+        with self._condition:
+            self._closed = False
+
+
+class Sink(object):
+    """ A publisher fed from its own bounded queue by its own worker thread
+
+    The publish callable is given each (key, item). If it raises, the item
+    is put back at the front of the queue and retried after
+    retry_interval seconds, while new items keep being queued (and
+    overflowing) behind it.
+
+    With a window, each inverter is published at most once per window, with
+    the latest frame received in it. With a min_interval, each inverter is
+    published at most once every min_interval seconds. Both need the
+    coalesce-latest policy. The latency from each item's received time to
+    it being published is recorded in growatt_sink_latency_seconds.
+
+    Example::
+
+        sink = Sink("mqtt", lambda key, snapshot: publisher.publish(snapshot.values()),
+                    policy=COALESCE_LATEST, window=1.0)
+    """
+
+    # Seconds to wait after the publish callable fails
+    retry_interval = 5.0
+
+    def __init__(self, name, publish, capacity=None, policy=DROP_OLDEST, spill_path=None, retry_interval=None,
+                 window=0.0, min_interval=0.0):
+        """ Initializes a sink
+
+        :param name: The name of the sink, used in logs and metrics
+        :param publish: The callable to publish each (key, item) with
+        :param capacity: The maximum number of items held in memory
+        :param policy: DROP_OLDEST, COALESCE_LATEST or SPILL
+        :param spill_path: The file to spill to, required by the SPILL policy
+        :param retry_interval: Seconds to wait after the publish callable fails
+        :param window: Seconds to wait after an inverter's frame arrives for newer frames to replace it
+        :param min_interval: The minimum seconds between two publishes of an inverter
+        """
+        self.name = name
+        self.publish = publish
+        if retry_interval is not None:
+            self.retry_interval = retry_interval
+        self.queue = SinkQueue(capacity, policy, spill_path, window=window, min_interval=min_interval)
+        self._labels = (name,)
+        self._thread = None
+        self.published = 0
+        self.failures = 0
+        # Seconds from the last published item being received to it being published
+        self.latency = None
+
+    def submit(self, key, item):
+        """ Queues an item for the worker, without waiting
+
+        :param key: The key to coalesce items by (the WiFi serial of the inverter)
+        :param item: The item
+        """
+        if not self.queue.put(key, item) and registry.enabled:
+            sinkDropped.inc(1, self._labels)
+        if registry.enabled:
+            sinkQueueDepth.set(len(self.queue), self._labels)
+
+    def start(self):
+        """ Starts publishing from a background thread
+        """
+        if self._thread is not None:
+            return
+        self.queue.open()
+        self._thread = threading.Thread(target=self._run, name="Sink-%s" % self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Stops the background thread, leaving any unpublished items queued
+
+        :param timeout: Seconds to wait for the thread to finish
+        """
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self.queue.close()
+        thread.join(timeout)
+
+    def _run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+            key, item = entry
+            try:
+                self.publish(key, item)
+            except Exception as e:
+                _logger.error("Unable to publish to %s: %s", self.name, repr(e))
+                self.failures += 1
+                if registry.enabled:
+                    sinkFailures.inc(1, self._labels)
+                self.queue.requeue(key, item)
+                if self.queue.wait_closed(self.retry_interval):
+                    return
+                continue
+            self.published += 1
+            received = getattr(item, "received", None)
+            if received is not None:
+                self.latency = time.time() - received
+                if registry.enabled:
+                    sinkLatencySeconds.observe(self.latency, self._labels)
+            if registry.enabled:
+                sinkQueueDepth.set(len(self.queue), self._labels)
+
+
+class Pipeline(object):
+    """ Fans each energy snapshot out to a set of sinks
+
+    GrowattEnergyRequest.execute submits every snapshot to the pipeline of
+    the datastore (if it has one)::
+
+        pipeline = Pipeline([Sink("mqtt", publish, policy=COALESCE_LATEST)])
+        pipeline.start()
+        store = create_slave_context(pipeline=pipeline)
+    """
+
+    def __init__(self, sinks=()):
+        """ Initializes a pipeline
+
+        :param sinks: The Sinks to feed
+        """
+        self.sinks = list(sinks)
+
+    def add(self, sink):
+        """ Adds a sink
+
+        :param sink: The Sink
+        :returns: The sink
+        """
+        self.sinks.append(sink)
+        return sink
+
+    def submit(self, key, item):
+        """ Queues an item on every sink, without waiting
+
+        :param key: The key to coalesce items by (the WiFi serial of the inverter)
+        :param item: The item
+        """
+        for sink in self.sinks:
+            sink.submit(key, item)
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+
+    def stop(self, timeout=None):
+        for sink in self.sinks:
+            sink.stop(timeout)
@@ -0,0 +1,377 @@
+"""
+PVOutput.org Uploads
+--------------------------------------------------------------------------
+
+Formats energy records as PVOutput statuses and posts them to the PVOutput
+API over a persistent (keep-alive) HTTP connection.
+
+PVOutputUploader spools every status to an append-only file before it is
+sent, so a status that PVOutput does not accept (or that could not be sent
+at all) is retried on the next flush rather than lost. Statuses are sent
+with the add batch status service, which takes up to 30 statuses per
+request, and flushes stop once the hourly request limit has been reached.
+"""
+import http.client
+import os
+import threading
+import time
+from collections import deque
+from urllib.parse import urlencode, urlsplit
+
+from PyGrowatt.growatt_metrics import registry, sinkPublishSeconds, sinkFailures
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+PVOUTPUT_URL = "https://pvoutput.org"
+
+
+class PVOutputError(IOError):
+    """ PVOutput responded with an error """
+
+    def __init__(self, status, reason, body=""):
+        IOError.__init__(self, "{} {}: {}".format(status, reason, body.strip()))
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+def status_line(timestamp, energy, power):
+    """ Formats a PVOutput batch status
+
+    :param timestamp: The time of the status
+    :param energy: The energy generated today in watt hours
+    :param power: The power generated in watts
+    :returns: The "date,time,energy,power" string
+    """
+    local = time.localtime(timestamp)
+    return "{},{},{},{}".format(time.strftime('%Y%m%d', local),     # Output Date
+                                time.strftime('%H:%M', local),      # Output Time
+                                energy,                             # Energy Generation (watt hours)
+                                power)                              # Power Generation (watts)
+
+
+def format_status(record):
+    """ Formats a record as a PVOutput batch status
+
+    :param record: A BackfillRecord (or anything with timestamp, Eac_today and Pac)
+    :returns: The "date,time,energy,power" string
+    """
+    return status_line(record.timestamp, record.Eac_today * 100, round(record.Pac * 0.1, 1))
+
+
+class PVOutputClient(object):
+    """ A keep-alive connection to the PVOutput API
+
+    The connection is opened on the first request and reused until the
+    server closes it, so a flush of several batches only pays for one TCP
+    (and TLS) handshake.
+    """
+
+    def __init__(self, api_key, system_id, url=PVOUTPUT_URL, timeout=30):
+        """ Initializes the client
+
+        :param api_key: The PVOutput API key
+        :param system_id: The PVOutput system id
+        :param url: The base URL of the PVOutput API
+        :param timeout: Seconds to wait for a response
+        """
+        url = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.path = url.path.rstrip("/")
+        self.headers = {
+            'X-Pvoutput-Apikey': api_key,
+            'X-Pvoutput-SystemId': str(system_id),
+            'Content-Type': 'application/x-www-form-urlencoded',
+        }
+        self.timeout = timeout
+        self.connections = 0
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = self.connection_class(self.netloc, timeout=self.timeout)
+            self.connections += 1
+        return self._connection
+
+    def close(self):
+        """ Closes the connection
+        """
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def post(self, service, fields):
+        """ Posts to a PVOutput service
+
+        :param service: The service name, e.g. "addstatus.jsp"
+        :param fields: A dict of the form fields
+        :returns: The response body
+        :raises PVOutputError: If PVOutput responds with an error
+        """
+        if not registry.enabled:
+            return self._post(service, fields)
+        start = time.perf_counter()
+        try:
+            return self._post(service, fields)
+        except Exception:
+            sinkFailures.inc(1, ("pvoutput",))
+            raise
+        finally:
+            sinkPublishSeconds.observe(time.perf_counter() - start, ("pvoutput",))
+
+    def _post(self, service, fields):
+        body = urlencode(fields)
+        path = self.path + "/service/r2/" + service
+        with self._lock:
+            for attempt in (1, 2):
+                connection = self._connect()
+                try:
+                    connection.request("POST", path, body=body, headers=self.headers)
+                    response = connection.getresponse()
+                    data = response.read().decode("utf-8", "replace")
+                    break
+                except (http.client.HTTPException, OSError):
+                    # The server may have closed an idle keep-alive connection, so retry once on a new one
+                    connection.close()
+                    self._connection = None
+                    if attempt == 2:
+                        raise
+            if response.will_close:
+                connection.close()
+                self._connection = None
+        if response.status != 200:
+            raise PVOutputError(response.status, response.reason, data)
+        return data
+
+    def add_batch_status(self, statuses):
+        """ Uploads up to 30 statuses (100 with donation mode)
+
+        :param statuses: A list of status strings from status_line
+        :returns: The response body
+        """
+        return self.post("addbatchstatus.jsp", {'data': ";".join(statuses)})
+
+
+class PVOutputBatchSink(object):
+    """ A BackfillQueue sink that posts each batch to the add batch status service
+    """
+
+    def __init__(self, api_key, system_id, url=PVOUTPUT_URL, timeout=30):
+        """ Initializes the sink
+
+        :param api_key: The PVOutput API key
+        :param system_id: The PVOutput system id
+        :param url: The base URL of the PVOutput API
+        :param timeout: Seconds to wait for a response
+        """
+        self.client = PVOutputClient(api_key, system_id, url, timeout)
+
+    def __call__(self, records):
+        """ Uploads a batch of records
+
+        :param records: A list of records, oldest first
+        :raises IOError: If PVOutput rejects the batch
+        """
+        body = self.client.add_batch_status([format_status(record) for record in records])
+        _logger.info("Uploaded %d buffered statuses to PVOutput.org", len(records))
+        return body
+
+
+class StatusSpool(object):
+    """ An append-only file of the statuses waiting to be uploaded
+
+    Statuses are appended one per line. The offset of the first unsent
+    status is kept in a second file (replaced atomically), and both are
+    emptied once everything has been sent.
+    """
+
+    def __init__(self, path):
+        """ Opens (or creates) a spool
+
+        :param path: The path of the spool file
+        """
+        self.path = path
+        self.offset_path = path + ".offset"
+        self._offset = 0
+        if os.path.exists(self.offset_path):
+            with open(self.offset_path) as f:
+                self._offset = int(f.read() or 0)
+        self._file = open(self.path, "ab")
+        # Discard a partial line left by a crash part way through an append
+        with open(self.path, "rb") as f:
+            data = f.read()
+        if data and not data.endswith(b"\n"):
+            self._file.truncate(data.rfind(b"\n") + 1)
+            self._file.seek(0, os.SEEK_END)
+        if self._offset > self._size():
+            self._offset = 0
+        # The number of unsent statuses, so len() does not have to read the file
+        self._count = data.count(b"\n", self._offset)
+
+    def _size(self):
+        return os.fstat(self._file.fileno()).st_size
+
+    def __len__(self):
+        return self._count
+
+    def append(self, statuses):
+        """ Adds statuses to the end of the spool
+
+        :param statuses: A list of status strings
+        """
+        if not statuses:
+            return
+        self._file.write("".join(status + "\n" for status in statuses).encode("ascii"))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._count += len(statuses)
+
+    def pending(self, count=None):
+        """ Reads the statuses that have not been sent
+
+        :param count: The maximum number of statuses to read
+        :returns: A list of status strings, oldest first
+        """
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            statuses = []
+            for line in f:
+                if count is not None and len(statuses) >= count:
+                    break
+                statuses.append(line.decode("ascii").rstrip("\n"))
+        return statuses
+
+    def consume(self, statuses):
+        """ Marks the oldest statuses as sent
+
+        :param statuses: The statuses returned by pending() that were sent
+        """
+        self._offset += sum(len(status) + 1 for status in statuses)
+        self._count -= len(statuses)
+        if self._offset >= self._size():
+            # Everything has been sent, so start again with an empty file
+            self._file.truncate(0)
+            self._file.seek(0)
+            self._offset = 0
+            self._count = 0
+        tmp = self.offset_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(self._offset))
+        os.replace(tmp, self.offset_path)
+
+    def close(self):
+        self._file.close()
+
+
+class PVOutputUploader(object):
+    """ Uploads statuses to PVOutput through a disk spool
+
+    Example::
+
+        uploader = PVOutputUploader(PVOutputClient(api_key, system_id), "pvoutput.spool")
+        uploader.add(time.time(), energy, power)
+        uploader.flush()
+    """
+
+    # PVOutput accepts 30 statuses per batch and 60 requests per hour (100 and 300 in donation mode)
+    batch_size = 30
+    requests_per_hour = 60
+
+    def __init__(self, client, spool_path, batch_size=None, requests_per_hour=None):
+        """ Initializes the uploader
+
+        :param client: The PVOutputClient
+        :param spool_path: The path of the spool file
+        :param batch_size: The maximum number of statuses per request
+        :param requests_per_hour: The maximum number of requests per hour
+        """
+        self.client = client
+        self.spool = StatusSpool(spool_path)
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if requests_per_hour is not None:
+            self.requests_per_hour = requests_per_hour
+        self._requests = deque()
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.spool)
+
+    def add(self, timestamp, energy, power):
+        """ Spools a live status
+
+        :param timestamp: The time of the status
+        :param energy: The energy generated today in watt hours
+        :param power: The power generated in watts
+        """
+        with self._lock:
+            self.spool.append([status_line(timestamp, energy, power)])
+
+    def add_records(self, records):
+        """ Spools a batch of records, e.g. as a BackfillQueue sink
+
+        :param records: A list of BackfillRecord
+        """
+        with self._lock:
+            self.spool.append([format_status(record) for record in records])
+
+    def _allowed(self, now):
+        """ Returns True if another request fits in the hourly limit """
+        while self._requests and self._requests[0] <= now - 3600:
+            self._requests.popleft()
+        return len(self._requests) < self.requests_per_hour
+
+    def flush(self, now=None):
+        """ Uploads the spooled statuses in batches
+
+        Stops at the first failed request (leaving it and everything after it
+        spooled) or when the hourly request limit is reached.
+
+        :param now: The current time.monotonic(), for testing
+        :returns: The number of statuses uploaded
+        """
+        sent = 0
+        with self._lock:
+            while True:
+                now_ = time.monotonic() if now is None else now
+                batch = self.spool.pending(self.batch_size)
+                if not batch:
+                    break
+                if not self._allowed(now_):
+                    _logger.warning("PVOutput.org hourly request limit reached, %d statuses spooled",
+                                    len(self.spool))
+                    break
+                self._requests.append(now_)
+                try:
+                    self.client.add_batch_status(batch)
+                except PVOutputError as e:
+                    if e.status == 400:
+                        # PVOutput will never accept these (e.g. they are too old), so don't retry them
+                        _logger.error("PVOutput.org rejected %d statuses: %s", len(batch), e)
+                        self.rejected += len(batch)
+                        self.spool.consume(batch)
+                        continue
+                    _logger.error("Upload to PVOutput.org failed, %d statuses spooled: %s", len(self.spool), e)
+                    break
+                except (http.client.HTTPException, OSError) as e:
+                    _logger.error("Upload to PVOutput.org failed, %d statuses spooled: %s", len(self.spool), e)
+                    break
+                self.spool.consume(batch)
+                sent += len(batch)
+        self.sent += sent
+        if sent:
+            _logger.info("Upload to PVOutput.org success! (%d statuses)", sent)
+        return sent
+
+    def close(self):
+        self.client.close()
+        self.spool.close()
@@ -0,0 +1,244 @@
+"""
+Growatt pcap Replay
+--------------------------------------------------------------------------
+
+Reads the TCP payloads sent by ShineWiFi-X modules from a pcap capture (e.g.
+one taken with tcpdump or Wireshark) and streams them through a
+GrowattV6Framer and the Growatt request classes as fast as possible,
+recording the decode and execute time of every frame by function code.
+
+It is used by the replay benchmark, and by the test suite to replay the
+captures in test/captures.
+"""
+import math
+import time
+from collections import OrderedDict
+
+try:
+    import dpkt
+except ImportError:  # pragma: no cover
+    dpkt = None
+
+from pymodbus.factory import ServerDecoder
+
+from PyGrowatt.growatt_datastore import GrowattServerContext
+from PyGrowatt.growatt_framer import GrowattV6Framer
+from PyGrowatt.growatt_server import growattFunctions, execute_request
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+
+def _ip_packet(link_type, buf):
+    """ Returns the IP packet of a captured frame, or None """
+    if link_type == dpkt.pcap.DLT_EN10MB:
+        packet = dpkt.ethernet.Ethernet(buf).data
+    elif link_type == dpkt.pcap.DLT_LINUX_SLL:
+        packet = dpkt.sll.SLL(buf).data
+    elif link_type == dpkt.pcap.DLT_RAW or link_type == 101:
+        packet = dpkt.ip.IP(buf) if buf[0] >> 4 == 4 else dpkt.ip6.IP6(buf)
+    elif link_type == dpkt.pcap.DLT_NULL:
+        packet = dpkt.loopback.Loopback(buf).data
+    else:
+        raise ValueError("Unsupported link type %d" % link_type)
+    if isinstance(packet, (dpkt.ip.IP, dpkt.ip6.IP6)):
+        return packet
+    return None
+
+
+def read_pcap(path, port=5279):
+    """ Reads the TCP payloads sent to a Growatt server from a capture
+
+    Retransmitted segments are dropped, so each byte of a stream is only
+    returned once.
+
+    :param path: The path of the pcap or pcapng file
+    :param port: The TCP port of the server
+    :returns: A list of (connection, payload), in capture order. The connection is the (address, port) of the client
+    """
+    if dpkt is None:
+        raise ImportError("Reading captures requires dpkt")
+    segments = []
+    next_seq = {}
+    with open(path, "rb") as f:
+        try:
+            reader = dpkt.pcap.Reader(f)
+        except ValueError:
+            f.seek(0)
+            reader = dpkt.pcapng.Reader(f)
+        link_type = reader.datalink()
+        for _, buf in reader:
+            packet = _ip_packet(link_type, buf)
+            if packet is None or not isinstance(packet.data, dpkt.tcp.TCP):
+                continue
+            segment = packet.data
+            if segment.dport != port or not segment.data:
+                continue
+            connection = (packet.src, segment.sport)
+            expected = next_seq.get(connection)
+            end = (segment.seq + len(segment.data)) & 0xffffffff
+            if expected is not None and (end - expected) & 0xffffffff > 0x7fffffff:
+                # The whole segment has been seen before
+                continue
+            data = bytes(segment.data)
+            if expected is not None and (expected - segment.seq) & 0xffffffff < len(data):
+                # Only part of the segment is new
+                data = data[(expected - segment.seq) & 0xffffffff:]
+            next_seq[connection] = end
+            segments.append((connection, data))
+    return segments
+
+
+def percentile(values, percent):
+    """ Returns a percentile of a list of values (nearest rank)
+
+    :param values: The values, which need not be sorted
+    :param percent: The percentile, from 0 to 100
+    :returns: The value, or None if there are no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(math.ceil(percent / 100.0 * len(values))), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+class _TimingDecoder(object):
+    """ Wraps a ServerDecoder to time every decode """
+
+    def __init__(self, decoder, stats):
+        self.decoder = decoder
+        self.stats = stats
+
+    def decode(self, message):
+        start = time.perf_counter()
+        request = self.decoder.decode(message)
+        self.stats._decoded(message[0], time.perf_counter() - start)
+        return request
+
+    def __getattr__(self, name):
+        return getattr(self.decoder, name)
+
+
+class ReplayStats(object):
+    """ The results of a replay
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.errors = 0
+        self.elapsed = 0.0
+        self.decode = OrderedDict()
+        self.execute = OrderedDict()
+
+    def _decoded(self, function_code, seconds):
+        self.decode.setdefault(function_code, []).append(seconds)
+
+    def _executed(self, function_code, seconds):
+        self.frames += 1
+        self.execute.setdefault(function_code, []).append(seconds)
+
+    @property
+    def frames_per_second(self):
+        return self.frames / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def counts(self):
+        """ Returns the number of frames executed, by function code """
+        return {function_code: len(times) for function_code, times in self.execute.items()}
+
+    def percentiles(self, percents=(50, 90, 99)):
+        """ Returns the decode and execute latency percentiles in seconds
+
+        :param percents: The percentiles to calculate
+        :returns: A dict of {function_code: {"decode": [...], "execute": [...]}}
+        """
+        return {function_code: {"decode": [percentile(self.decode.get(function_code, []), p) for p in percents],
+                                "execute": [percentile(self.execute[function_code], p) for p in percents]}
+                for function_code in sorted(self.execute)}
+
+    def report(self, percents=(50, 90, 99)):
+        """ Formats the results as a table
+
+        :param percents: The percentiles to include
+        :returns: The report as a string
+        """
+        lines = ["{} frames, {} bytes in {:.3f}s: {:.0f} frames/s, {:.2f} MB/s, {} errors".format(
+            self.frames, self.bytes, self.elapsed, self.frames_per_second, self.bytes_per_second / 1e6, self.errors)]
+        columns = ["p{}".format(p) for p in percents]
+        lines.append("{:<6}{:>8}  {:<30}{:<30}".format("fc", "frames", "decode us (" + "/".join(columns) + ")",
+                                                       "execute us (" + "/".join(columns) + ")"))
+        for function_code, latency in self.percentiles(percents).items():
+            lines.append("0x{:02x}  {:>8}  {:<30}{:<30}".format(
+                function_code, len(self.execute[function_code]),
+                "/".join("{:.1f}".format(t * 1e6) if t is not None else "-" for t in latency["decode"]),
+                "/".join("{:.1f}".format(t * 1e6) for t in latency["execute"])))
+        return "\n".join(lines)
+
+
+class GrowattReplay(object):
+    """ Replays captured client traffic through a framer per connection
+
+    Example::
+
+        replay = GrowattReplay()
+        stats = replay.run(read_pcap("capture.pcap"))
+        print(stats.report())
+    """
+
+    def __init__(self, context=None, custom_functions=None, framer=GrowattV6Framer, key=b'Growatt'):
+        """ Initializes the replay
+
+        :param context: The datastore to execute the requests against, defaults to a new GrowattServerContext
+        :param custom_functions: The request classes to decode, defaults to all Growatt requests
+        :param framer: The framer class to create for each connection
+        :param key: The key used to XOR the payload
+        """
+        self.context = context if context is not None else GrowattServerContext()
+        self.decoder = ServerDecoder()
+        for f in growattFunctions if custom_functions is None else custom_functions:
+            self.decoder.register(f)
+        self.framer = framer
+        self.key = key
+
+    def run(self, segments, repeat=1):
+        """ Replays the segments
+
+        :param segments: A list of (connection, payload) from read_pcap
+        :param repeat: The number of times to replay the segments
+        :returns: The ReplayStats
+        """
+        stats = ReplayStats()
+        decoder = _TimingDecoder(self.decoder, stats)
+        units = self.context.slaves()
+        if not isinstance(units, (list, tuple)):
+            units = [units]
+        perf_counter = time.perf_counter
+
+        def execute(request):
+            start = perf_counter()
+            try:
+                execute_request(self.context, request)
+            except Exception as e:
+                stats.errors += 1
+                _logger.debug("Unable to execute %r: %s", request, e)
+            stats._executed(request.function_code, perf_counter() - start)
+
+        start = perf_counter()
+        for _ in range(repeat):
+            framers = {}
+            for connection, payload in segments:
+                framer = framers.get(connection)
+                if framer is None:
+                    framer = framers[connection] = self.framer(decoder, key=self.key)
+                framer.processIncomingPacket(payload, execute, units, single=True)
+                stats.bytes += len(payload)
+        stats.elapsed = perf_counter() - start
+        return stats
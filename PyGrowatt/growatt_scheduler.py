@@ -0,0 +1,183 @@
+"""
+Growatt Scheduler
+--------------------------------------------------------------------------
+
+Runs periodic jobs (e.g. publishing or uploading the energy data) from a
+single thread. Re-arming a threading.Timer at the end of every run starts a
+new thread per tick and lets the period drift by however long the run took.
+GrowattScheduler instead works out every tick from the first one, using the
+monotonic clock, so the ticks stay on (for example) 5 minute boundaries of
+the wall clock, as PVOutput expects. A run that overruns skips the ticks it
+missed rather than running them back to back.
+"""
+import random
+import threading
+import time
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+
+class GrowattJob(object):
+    """ A periodic job
+    """
+
+    def __init__(self, callback, interval, args=(), align=True, jitter=0, name=None):
+        """ Initializes a new job
+
+        :param callback: The callable to run
+        :param interval: The period in seconds
+        :param args: The arguments to call the callback with
+        :param align: Whether the ticks are aligned to multiples of interval on the wall clock
+        :param jitter: The maximum random delay in seconds added to each tick
+        :param name: The name of the job, for logging
+        """
+        if interval <= 0:
+            raise ValueError("The interval must be positive")
+        self.callback = callback
+        self.interval = interval
+        self.args = args
+        self.align = align
+        self.jitter = jitter
+        self.name = name or getattr(callback, "__name__", repr(callback))
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        # The monotonic time of the next tick (without jitter), and when it will actually run
+        self.tick = None
+        self.due = None
+
+    def _schedule(self, tick, random=random):
+        self.tick = tick
+        self.due = tick + (random.uniform(0, self.jitter) if self.jitter else 0)
+
+
+class GrowattScheduler(object):
+    """ Runs periodic jobs from a single thread
+
+    Example::
+
+        scheduler = GrowattScheduler()
+        scheduler.add(publish, 300, args=(store,))
+        scheduler.run()
+    """
+
+    def __init__(self, clock=time.monotonic, wall_clock=time.time, random=random):
+        """ Initializes the scheduler
+
+        :param clock: The monotonic clock, for testing
+        :param wall_clock: The wall clock that ticks are aligned to, for testing
+        :param random: The source of jitter, for testing
+        """
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.random = random
+        self.jobs = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def add(self, callback, interval, args=(), align=True, jitter=0, name=None):
+        """ Adds a periodic job
+
+        An aligned job first runs at the next multiple of interval on the wall
+        clock (e.g. hh:00, hh:05, ... for 300 seconds), an unaligned job runs
+        straight away.
+
+        :param callback: The callable to run
+        :param interval: The period in seconds
+        :param args: The arguments to call the callback with
+        :param align: Whether the ticks are aligned to multiples of interval on the wall clock
+        :param jitter: The maximum random delay in seconds added to each tick
+        :param name: The name of the job, for logging
+        :returns: The GrowattJob
+        """
+        job = GrowattJob(callback, interval, args, align, jitter, name)
+        now = self.clock()
+        if align:
+            wall = self.wall_clock()
+            now += (wall // interval + 1) * interval - wall
+        job._schedule(now, self.random)
+        with self._lock:
+            self.jobs.append(job)
+        self._wakeup.set()
+        return job
+
+    def remove(self, job):
+        """ Removes a job
+
+        :param job: The GrowattJob returned by add
+        """
+        with self._lock:
+            self.jobs.remove(job)
+
+    def next_due(self):
+        """ Returns the monotonic time the next job is due, or None if there are no jobs """
+        with self._lock:
+            return min((job.due for job in self.jobs), default=None)
+
+    def run_pending(self):
+        """ Runs every job that is due
+
+        :returns: The number of jobs run
+        """
+        with self._lock:
+            due = sorted((job for job in self.jobs if job.due <= self.clock()), key=lambda job: job.due)
+        for job in due:
+            self._run(job)
+        return len(due)
+
+    def _run(self, job):
+        try:
+            job.callback(*job.args)
+        except Exception as e:
+            job.failures += 1
+            _logger.error("Scheduled job %s failed: %s", job.name, repr(e))
+        job.runs += 1
+
+        # The next tick follows on from the last one, not from when the run finished, so it never drifts
+        now = self.clock()
+        tick = job.tick + job.interval
+        if tick <= now:
+            missed = int((now - tick) // job.interval) + 1
+            job.skipped += missed
+            tick += missed * job.interval
+            _logger.warning("Scheduled job %s overran, skipped %d tick(s)", job.name, missed)
+        job._schedule(tick, self.random)
+
+    def run(self):
+        """ Runs the jobs from the calling thread until stop() is called
+        """
+        while not self._stopping:
+            self._wakeup.clear()
+            due = self.next_due()
+            timeout = None if due is None else max(due - self.clock(), 0)
+            if timeout is None or timeout > 0:
+                self._wakeup.wait(timeout)
+                continue
+            self.run_pending()
+
+    def start(self):
+        """ Runs the jobs from a background thread
+        """
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self.run, name="SchedulerThread")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Stops running jobs
+
+        :param timeout: Seconds to wait for the background thread to finish
+        """
+        self._stopping = True
+        self._wakeup.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout)
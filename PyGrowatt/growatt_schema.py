@@ -0,0 +1,220 @@
+"""
+Growatt Message Schema
+--------------------------------------------------------------------------
+
+Each Growatt message is declared once as a list of fields (name, byte
+offset, struct format, scale and register address). A MessageSchema
+compiles the fields into a single precompiled struct.Struct so a frame is
+decoded with one C-level unpack, and generates the register map that the
+request's execute() writes to the datastore. A LazySchema defers unpacking
+all but a message's header fields until they are first read.
+"""
+import struct
+from collections import namedtuple
+from operator import attrgetter
+
+
+class Field(namedtuple('Field', ['name', 'offset', 'format', 'scale', 'register'])):
+    """ A single value within a Growatt message
+
+    :param name: The attribute name on the request/response
+    :param offset: The byte offset of the value within the (decrypted) payload
+    :param format: The big-endian struct format of the value (e.g. 'H', 'I', '10s')
+    :param scale: The divisor that converts the raw value to engineering units
+    :param register: The datastore address to store the value at, or None
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, offset, format, scale=1, register=None):
+        return super(Field, cls).__new__(cls, name, offset, format, scale, register)
+
+    @property
+    def size(self):
+        return struct.calcsize('>' + self.format)
+
+
+class MessageSchema(object):
+    """ A compiled set of fields for one message type
+
+    Use schema.decode_into(message, data, offset=0) to unpack a decrypted
+    payload onto the attributes of a request/response.
+    """
+
+    def __init__(self, fields):
+        """ Compiles the fields into a single struct
+
+        :param fields: A list of Field objects, in any order
+        """
+        self.fields = sorted(fields, key=lambda f: f.offset)
+        self.names = tuple(f.name for f in self.fields)
+
+        # Build one format string, padding the gaps between fields
+        fmt = '>'
+        position = 0
+        for field in self.fields:
+            if field.offset < position:
+                raise ValueError("Field '{}' at offset {} overlaps the previous field".format(field.name,
+                                                                                               field.offset))
+            if field.offset > position:
+                fmt += '{}x'.format(field.offset - position)
+            fmt += field.format
+            position = field.offset + field.size
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+        # Group the registers into contiguous runs so each run is a single setValues call
+        self.register_runs = []
+        registered = sorted((f for f in self.fields if f.register is not None), key=lambda f: f.register)
+        for field in registered:
+            if self.register_runs:
+                address, names = self.register_runs[-1]
+                if address + len(names) == field.register:
+                    names.append(field.name)
+                    continue
+            self.register_runs.append((field.register, [field.name]))
+        self.register_runs = [(address, tuple(names)) for address, names in self.register_runs]
+        self._run_getters = [(address, attrgetter(*names), len(names) == 1)
+                             for address, names in self.register_runs]
+
+        self._scales = tuple((f.name, f.scale) for f in self.fields if f.scale != 1)
+        self.decode_into = self._compile_decoder()
+
+    def _compile_decoder(self):
+        """ Generates decode_into(message, data, offset=0)
+
+        The generated function unpacks the fields from a decrypted payload
+        straight onto the message's attributes. Assigning the unpacked tuple
+        in a single statement is considerably cheaper than a setattr (or
+        __dict__.update) per field.
+        """
+        targets = ", ".join("message." + name for name in self.names)
+        source = "def decode_into(message, data, offset=0):\n    {}, = unpack_from(data, offset)\n".format(targets)
+        namespace = {"unpack_from": self.struct.unpack_from}
+        exec(source, namespace)
+        return namespace["decode_into"]
+
+    def registers(self):
+        """ Returns the register map for the schema
+
+        :returns: A dict of field name to register address
+        """
+        return dict((f.name, f.register) for f in self.fields if f.register is not None)
+
+    def unpack(self, data, offset=0):
+        """ Unpacks the fields from a payload
+
+        :param data: The decrypted payload
+        :param offset: The position of the payload within data
+        :returns: A dict of field name to raw value
+        """
+        return dict(zip(self.names, self.struct.unpack_from(data, offset)))
+
+    def pack(self, message):
+        """ Packs the fields from a message's attributes
+
+        :param message: The request/response to encode
+        :returns: The encoded payload
+        """
+        return self.struct.pack(*[getattr(message, name) for name in self.names])
+
+    def execute(self, message, context, function_code):
+        """ Stores the registered fields of a message in the datastore
+
+        :param message: The decoded request
+        :param context: The IModbusSlaveContext to store the data
+        :param function_code: The function code used to select the register block
+        """
+        for address, getter, single in self._run_getters:
+            values = getter(message)
+            context.setValues(function_code, address, [values] if single else list(values))
+
+    def scaled(self, message):
+        """ Converts the raw values of a message to engineering units
+
+        :param message: The decoded request
+        :returns: A dict of field name to value, with scaled fields as floats
+        """
+        result = dict((name, getattr(message, name)) for name in self.names)
+        for name, scale in self._scales:
+            result[name] = float(result[name]) / scale
+        return result
+
+
+class LazyField(object):
+    """ A field that is unpacked from the retained payload on first access
+
+    This is a non-data descriptor, so once the fields have been unpacked onto
+    the message they are read from its __dict__ without calling back in here.
+    """
+    __slots__ = ('name', 'schema', 'default')
+
+    def __init__(self, name, schema, default=0):
+        """ Initializes the field
+
+        :param name: The attribute name
+        :param schema: The MessageSchema of the fields unpacked on first access
+        :param default: The value before a payload has been decoded
+        """
+        self.name = name
+        self.schema = schema
+        self.default = default
+
+    def __get__(self, message, owner=None):
+        if message is None:
+            return self
+        fields = message.__dict__
+        payload = fields.pop('_payload', None)
+        if payload is None:
+            return self.default
+        self.schema.decode_into(message, *payload)
+        fields['_unpacked'] = True
+        return fields[self.name]
+
+
+class LazySchema(object):
+    """ Decodes the header fields of a message up front, and the rest on first access
+
+    Creating a LazySchema installs a LazyField on the message class for
+    every field that is not in the header, so the class must not set those
+    attributes in __init__ (unless they were passed in). decode_into then
+    only unpacks the header and keeps a reference to the payload (copying it
+    first if it is writable).
+    """
+
+    def __init__(self, schema, cls, header, default=0):
+        """ Splits a schema into header and lazy fields
+
+        :param schema: The MessageSchema of the whole message
+        :param cls: The message class to install the LazyFields on
+        :param header: The names of the fields to decode up front
+        :param default: The value of a lazy field before a payload has been decoded
+        """
+        self.schema = schema
+        self.header = MessageSchema([f for f in schema.fields if f.name in header])
+        self.rest = MessageSchema([f for f in schema.fields if f.name not in header])
+        self.lazy_names = self.rest.names
+        self.size = schema.size
+        self._decode_header = self.header.decode_into
+        for name in self.lazy_names:
+            setattr(cls, name, LazyField(name, self.rest, default))
+
+    def decode_into(self, message, data, offset=0):
+        """ Unpacks the header fields and keeps the payload for the rest
+
+        :param message: The request/response to decode onto
+        :param data: The decrypted payload
+        :param offset: The position of the payload within data
+        :raises struct.error: If the payload is too short for the whole message
+        """
+        if type(data) is not bytes and not (type(data) is memoryview and data.readonly):
+            data = bytes(data)
+        if len(data) - offset < self.size:
+            raise struct.error("unpack_from requires a buffer of at least {} bytes".format(self.size + offset))
+        fields = message.__dict__
+        if '_unpacked' in fields:
+            # Decoding into a message again, drop the fields unpacked from the last payload
+            del fields['_unpacked']
+            for name in self.lazy_names:
+                fields.pop(name, None)
+        self._decode_header(message, data, offset)
+        fields['_payload'] = (data, offset)
@@ -0,0 +1,266 @@
+"""
+Growatt asyncio Server
+--------------------------------------------------------------------------
+
+An alternative to pymodbus' StartTcpServer, which spawns a thread for every
+connected ShineWiFi-X module. All connections are served from a single
+asyncio event loop, each with its own GrowattV6Framer and connection state.
+"""
+import asyncio
+import time
+from time import perf_counter
+
+from pymodbus.factory import ServerDecoder
+from pymodbus.exceptions import ModbusException, NoSuchSlaveException
+from pymodbus.pdu import ModbusExceptions as merror
+from pymodbus.server.sync import ModbusConnectedRequestHandler
+
+from PyGrowatt.Growatt import GrowattAnnounceRequest, GrowattEnergyRequest, GrowattPingRequest, \
+    GrowattConfigRequest, GrowattQueryRequest, GrowattBufferedEnergyRequest
+from PyGrowatt.growatt_framer import GrowattV6Framer
+from PyGrowatt.growatt_metrics import registry, functionCodeLabels, executeSeconds, activeConnections
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+growattFunctions = [GrowattAnnounceRequest,
+                    GrowattEnergyRequest,
+                    GrowattPingRequest,
+                    GrowattConfigRequest,
+                    GrowattQueryRequest,
+                    GrowattBufferedEnergyRequest,
+                    ]
+
+
+def execute_request(context, request):
+    """ Executes a request against the datastore of the inverter that sent it
+
+    :param context: A ModbusServerContext or GrowattServerContext
+    :param request: The decoded request message
+    :returns: The response to send, or None
+    """
+    if registry.enabled:
+        start = perf_counter()
+        try:
+            return _execute(context, request)
+        finally:
+            executeSeconds.observe(perf_counter() - start, functionCodeLabels[request.function_code])
+    return _execute(context, request)
+
+
+def _execute(context, request):
+    route = getattr(context, 'route', None)
+    slave = route(request) if route is not None else context[request.unit_id]
+    return request.execute(slave)
+
+
+class GrowattRequestHandler(ModbusConnectedRequestHandler):
+    """ A pymodbus request handler for StartTcpServer that routes each
+    request to the datastore of the inverter that sent it
+
+    Pass handler=GrowattRequestHandler to StartTcpServer.
+    """
+
+    def setup(self):
+        ModbusConnectedRequestHandler.setup(self)
+        if registry.enabled:
+            activeConnections.inc()
+
+    def finish(self):
+        if registry.enabled:
+            activeConnections.dec()
+        ModbusConnectedRequestHandler.finish(self)
+
+    def execute(self, request):
+        try:
+            response = execute_request(self.server.context, request)
+        except NoSuchSlaveException:
+            _logger.debug("requested slave does not exist: %s", request.unit_id)
+            return
+        except Exception as e:
+            _logger.error("Datastore unable to fulfill request: %s", repr(e))
+            response = request.doException(merror.SlaveFailure)
+
+        # Some requests (e.g. an ACK to a config change) do not need a reply
+        if response is None or not response.should_respond:
+            return
+        response.transaction_id = request.transaction_id
+        response.unit_id = request.unit_id
+        self.send(response)
+
+
+class GrowattConnection(asyncio.Protocol):
+    """ The state of a single ShineWiFi-X connection
+    """
+
+    def __init__(self, server):
+        """ Initializes a new connection
+
+        :param server: The GrowattServer that accepted the connection
+        """
+        self.server = server
+        self.framer = server.framer(server.decoder, key=server.key)
+        self.transport = None
+        self.peer = None
+        self.wifi_serial = None
+        self.connected_at = None
+        self.last_frame_at = None
+        self.frames_received = 0
+        self.frames_sent = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+        self.connected_at = time.time()
+        self.server.connections.add(self)
+        if registry.enabled:
+            activeConnections.inc()
+        _logger.debug("Client Connected [%s]", self.peer)
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        if registry.enabled:
+            activeConnections.dec()
+        self.framer.resetFrame()
+        _logger.debug("Client Disconnected [%s] after %d frames", self.peer, self.frames_received)
+
+    def data_received(self, data):
+        try:
+            self.framer.processIncomingPacket(data, self.execute, self.server.units,
+                                              single=self.server.context.single)
+        except ModbusException as e:
+            _logger.warning("Unable to process frame from [%s]: %s", self.peer, e)
+            self.framer.resetFrame()
+
+    def execute(self, request):
+        """ The callback to call with the decoded request
+
+        :param request: The decoded request message
+        """
+        self.frames_received += 1
+        self.last_frame_at = time.time()
+        self.wifi_serial = getattr(request, 'wifi_serial', None) or self.wifi_serial
+        try:
+            response = execute_request(self.server.context, request)
+        except NoSuchSlaveException:
+            _logger.debug("requested slave does not exist: %s", request.unit_id)
+            return
+        except Exception as e:
+            _logger.error("Datastore unable to fulfill request: %s", repr(e))
+            response = request.doException(merror.SlaveFailure)
+
+        # Some requests (e.g. an ACK to a config change) do not need a reply
+        if response is None or not response.should_respond:
+            return
+        response.transaction_id = request.transaction_id
+        response.unit_id = request.unit_id
+        self.send(response)
+
+    def send(self, message):
+        """ Sends a response to the ShineWiFi-X module
+
+        :param message: The unencoded response
+        """
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.transport.write(self.framer.buildPacket(message))
+        self.frames_sent += 1
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class GrowattServer(object):
+    """ A single threaded, asyncio based Growatt server
+
+    Example::
+
+        server = GrowattServer(context, address=("", 5279))
+        asyncio.run(server.serve_forever())
+    """
+
+    def __init__(self, context, address=("", 5279), custom_functions=None, framer=GrowattV6Framer,
+                 key=b'Growatt'):
+        """ Initializes a new server
+
+        :param context: The ModbusServerContext datastore
+        :param address: The (interface, port) to bind to
+        :param custom_functions: The request classes to decode, defaults to all Growatt requests
+        :param framer: The framer class to create for each connection
+        :param key: The key used to XOR the payload
+        """
+        self.context = context
+        self.address = address
+        self.framer = framer
+        self.key = key
+        self.decoder = ServerDecoder()
+        for f in growattFunctions if custom_functions is None else custom_functions:
+            self.decoder.register(f)
+        self.connections = set()
+        self._server = None
+
+    @property
+    def units(self):
+        units = self.context.slaves()
+        if not isinstance(units, (list, tuple)):
+            units = [units]
+        return units
+
+    @property
+    def sockets(self):
+        return self._server.sockets if self._server is not None else []
+
+    async def start(self):
+        """ Starts listening for connections
+        """
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(lambda: GrowattConnection(self), *self.address,
+                                                reuse_address=True)
+        _logger.info("Listening on %s", ", ".join(str(s.getsockname()) for s in self._server.sockets))
+
+    async def serve_forever(self):
+        """ Starts the server (if required) and serves until stopped
+        """
+        if self._server is None:
+            await self.start()
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        """ Stops listening and closes every open connection
+        """
+        if self._server is None:
+            return
+        server, self._server = self._server, None
+        server.close()
+        for connection in list(self.connections):
+            connection.close()
+        await server.wait_closed()
+        # Let the transports deliver connection_lost before returning
+        await asyncio.sleep(0)
+        _logger.info("Server stopped")
+
+
+def StartAsyncServer(context=None, identity=None, address=None, custom_functions=None, **kwargs):
+    """ A factory to start and run an asyncio Growatt server
+
+    This blocks until the server is stopped, so is a drop-in replacement for
+    pymodbus' StartTcpServer as the target of a server thread.
+
+    :param context: The ModbusServerContext datastore
+    :param identity: Unused, accepted for compatibility with StartTcpServer
+    :param address: An optional (interface, port) to bind to.
+    :param custom_functions: An optional list of custom function classes
+    """
+    kwargs.pop("allow_reuse_address", None)
+    kwargs.pop("handler", None)
+    server = GrowattServer(context, address=address or ("", 5279), custom_functions=custom_functions, **kwargs)
+    asyncio.run(server.serve_forever())
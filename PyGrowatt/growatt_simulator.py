@@ -0,0 +1,304 @@
+"""
+Growatt Inverter Simulator
+--------------------------------------------------------------------------
+
+Simulates ShineWiFi-X modules for load testing a server. Every simulated
+module opens its own connection and runs the same handshake as a real one:
+the announce (0x03), its config values (0x19) and a ping (0x16), and if the
+server answers the ping with a query it sends every config value (0x01 to
+0x1F) one frame at a time. It then sends energy (0x04) frames at a fixed rate, waiting for each frame to be
+acknowledged before sending the next. Each acknowledgement is checked
+(protocol id, transaction id, function code and CRC) and timed.
+"""
+import asyncio
+import struct
+import time
+
+from pymodbus.factory import ServerDecoder
+from pymodbus.utilities import checkCRC
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_framer import GrowattV6Framer
+from PyGrowatt.growatt_replay import percentile
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+
+# The size of the announce and energy payloads sent by a ShineWiFi-X module
+PAYLOAD_SIZE = 575
+
+# The function codes the server may answer each request with. A config request (0x18) replaces an ACK when the
+# server wants to change a setting, and a ping is answered with a query (0x19) until the server knows the date
+RESPONSE_CODES = {0x03: (0x03, 0x18), 0x19: (0x19, 0x18), 0x16: (0x16, 0x19), 0x04: (0x04,), 0x50: (0x50,)}
+
+
+class _RequestFrame(object):
+    """ The minimum of a message for GrowattV6Framer.buildPacket """
+    protocol_id = 6
+    unit_id = 1
+
+    def __init__(self, function_code, transaction_id, data):
+        self.function_code = function_code
+        self.transaction_id = transaction_id
+        self._data = data
+
+    def encode(self):
+        return self._data
+
+
+class _Values(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class SimulatedInverter(object):
+    """ Builds the frames sent by a ShineWiFi-X module
+    """
+
+    def __init__(self, wifi_serial, inverter_serial, key=b'Growatt'):
+        """ Initializes a new module
+
+        :param wifi_serial: The 10 byte serial number of the ShineWiFi-X module
+        :param inverter_serial: The 10 byte serial number of the inverter
+        :param key: The key used to XOR the payload
+        """
+        self.wifi_serial = wifi_serial
+        self.inverter_serial = inverter_serial
+        self.framer = GrowattV6Framer(ServerDecoder(), key=key)
+        self.transaction_id = 0
+        # The (config id, value) sent during the handshake, None is the WiFi serial
+        self.config_values = [(0x05, b'1'), (0x08, None), (0x0e, b'192.0.2.1'), (0x12, b'5279')]
+
+    def frame(self, function_code, data):
+        """ Builds a request frame
+
+        :param function_code: The function code
+        :param data: The unencrypted payload
+        :returns: The frame, ready to send
+        """
+        self.transaction_id = (self.transaction_id + 1) & 0xffff
+        return self.framer.buildPacket(_RequestFrame(function_code, self.transaction_id, data))
+
+    def announce(self, now=None):
+        """ Builds an announce (0x03) frame, with the module's clock set to now """
+        now = time.localtime(now)
+        values = _Values(wifi_serial=self.wifi_serial, device_serial=self.inverter_serial, active_rate=100,
+                         reactive_rate=0, power_factor=10000, p_max=5000, v_normal=2300, fw_version=b'GH1.0 ',
+                         control_fw_version=b'ZAAA  ', device_type=b'   PV Inverter  ', year=now.tm_year,
+                         month=now.tm_mon, day=now.tm_mday, hour=now.tm_hour, min=now.tm_min, sec=now.tm_sec)
+        return self.frame(0x03, Growatt.announceSchema.pack(values).ljust(PAYLOAD_SIZE, b'\x00'))
+
+    def config(self, config_id, value):
+        """ Builds a config value (0x19) frame """
+        value = self.wifi_serial if value is None else value
+        return self.frame(0x19, self.wifi_serial.ljust(30, b'\x00') + struct.pack(">HH", config_id, len(value)) + value)
+
+    def ping(self):
+        """ Builds a ping (0x16) frame """
+        return self.frame(0x16, self.wifi_serial.ljust(30, b'\x00'))
+
+    def energy(self, pac=14648, now=None, function_code=0x04):
+        """ Builds a live (0x04) or buffered (0x50) energy frame
+
+        :param pac: The output power in 0.1 W
+        :param now: The time of the reading, defaults to now
+        :param function_code: 0x04 or 0x50
+        """
+        now = time.localtime(now)
+        values = _Values(wifi_serial=self.wifi_serial, inverter_serial=self.inverter_serial, year=now.tm_year % 100,
+                         month=now.tm_mon, day=now.tm_mday, hour=now.tm_hour, min=now.tm_min, sec=now.tm_sec,
+                         inverter_status=1, Ppv=pac + 300, Vpv1=3100, Ipv1=pac // 620, Ppv1=pac // 2, Vpv2=3050,
+                         Ipv2=pac // 610, Ppv2=pac // 2, Pac=pac, Fac=5001, Vac1=2400, Iac1=pac // 240, Pac1=pac,
+                         Vac_RS=2400, Eac_today=43, Eac_total=290380, Epv_total=300000, Epv1_today=17,
+                         Epv1_total=150000, Epv2_today=28, Epv2_total=150000)
+        schema = Growatt.energySchema if function_code == 0x04 else Growatt.bufferedEnergySchema
+        return self.frame(function_code, schema.pack(values).ljust(PAYLOAD_SIZE, b'\x00'))
+
+    def handshake(self):
+        """ Returns the frames a module sends after connecting """
+        return [self.announce()] + [self.config(*value) for value in self.config_values] + [self.ping()]
+
+    def query(self, now=None):
+        """ Returns the config (0x19) frames a module sends when the server queries every value
+
+        :param now: The module's clock, for the date and time (0x1F)
+        """
+        values = dict(self.config_values)
+        values[0x1F] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)).encode('ascii')
+        return [self.config(config_id, values.get(config_id, b'0')) for config_id in range(0x01, 0x20)]
+
+
+class MalformedResponse(Exception):
+    """ The server sent a response that does not match the request """
+
+
+async def read_response(reader):
+    """ Reads one response frame
+
+    :param reader: The asyncio StreamReader
+    :returns: The (transaction id, function code) of the response
+    :raises MalformedResponse: If the frame is not a valid Growatt frame
+    """
+    header = await reader.readexactly(6)
+    transaction_id, protocol_id, length = struct.unpack(">HHH", header)
+    if protocol_id != 6 or not 2 <= length <= GrowattV6Framer.max_length:
+        raise MalformedResponse("Invalid header %s" % header.hex())
+    body = await reader.readexactly(length + 2)
+    if not checkCRC(header + body[:-2], struct.unpack("<H", body[-2:])[0]):
+        raise MalformedResponse("Invalid CRC")
+    return transaction_id, body[1]
+
+
+class LoadStats(object):
+    """ The results of a load test
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.connect_failures = 0
+        self.handshakes = 0
+        self.queries = 0
+        self.sent = 0
+        self.acknowledged = 0
+        self.dropped = 0
+        self.malformed = 0
+        self.latencies = []
+        # Seconds from connecting to the first energy frame being acknowledged
+        self.first_energy = []
+        self.elapsed = 0.0
+
+    def _merge(self, other):
+        for name in ("connections", "connect_failures", "handshakes", "queries", "sent", "acknowledged", "dropped",
+                     "malformed"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.latencies.extend(other.latencies)
+        self.first_energy.extend(other.first_energy)
+
+    @property
+    def acknowledged_per_second(self):
+        return self.acknowledged / self.elapsed if self.elapsed else 0.0
+
+    def report(self, percents=(50, 90, 99)):
+        """ Formats the results
+
+        :param percents: The latency percentiles to include
+        :returns: The report as a string
+        """
+        def percentiles(values):
+            return "/".join("{:.2f}".format(percentile(values, p) * 1e3) if values else "-" for p in percents)
+
+        names = "/p".join(str(p) for p in percents)
+        return ("{} connections ({} failed), {} handshakes ({} queried), {} frames sent, {} acknowledged ({:.0f}/s), "
+                "{} dropped, {} malformed\nACK latency ms (p{}): {}\nTime to first energy frame ms (p{}): {}").format(
+            self.connections, self.connect_failures, self.handshakes, self.queries, self.sent, self.acknowledged,
+            self.acknowledged_per_second, self.dropped, self.malformed, names, percentiles(self.latencies), names,
+            percentiles(self.first_energy))
+
+
+async def simulate(inverter, host, port, rate, duration, timeout=5.0, latency=0.0):
+    """ Connects one simulated module, runs the handshake and sends energy frames
+
+    :param inverter: The SimulatedInverter
+    :param host: The server host
+    :param port: The server port
+    :param rate: Energy frames per second
+    :param duration: Seconds to send energy frames for
+    :param timeout: Seconds to wait for each acknowledgement
+    :param latency: Seconds to add to every round trip, to emulate a slow link
+    :returns: The LoadStats of this connection
+    """
+    stats = LoadStats()
+    loop = asyncio.get_running_loop()
+    connecting = loop.time()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        _logger.debug("Unable to connect %s: %s", inverter.wifi_serial, e)
+        stats.connect_failures += 1
+        return stats
+    stats.connections += 1
+
+    async def exchange(frame):
+        request_id, function_code = struct.unpack_from(">H", frame)[0], frame[7]
+        stats.sent += 1
+        start = loop.time()
+        if latency:
+            await asyncio.sleep(latency)
+        writer.write(frame)
+        try:
+            transaction_id, response_code = await asyncio.wait_for(read_response(reader), timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError):
+            stats.dropped += 1
+            return None
+        except MalformedResponse as e:
+            _logger.debug("Malformed response to %s: %s", inverter.wifi_serial, e)
+            stats.malformed += 1
+            return None
+        if transaction_id != request_id or response_code not in RESPONSE_CODES[function_code]:
+            _logger.debug("Unexpected response 0x%02x (%d) to 0x%02x (%d) from %s", response_code, transaction_id,
+                          function_code, request_id, inverter.wifi_serial)
+            stats.malformed += 1
+            return None
+        stats.latencies.append(loop.time() - start)
+        stats.acknowledged += 1
+        return response_code
+
+    try:
+        for frame in inverter.handshake():
+            response_code = await exchange(frame)
+            if response_code is None:
+                return stats
+        # The last frame is the ping, which the server answers with a query until it knows the module's config
+        if response_code == 0x19:
+            stats.queries += 1
+            for frame in inverter.query():
+                if await exchange(frame) is None:
+                    return stats
+        stats.handshakes += 1
+
+        # Ticks are on a fixed schedule, so a slow ACK does not lower the rate of the next frames
+        start = loop.time()
+        interval = 1.0 / rate
+        tick = 0
+        while tick * interval < duration:
+            delay = start + tick * interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if await exchange(inverter.energy()) is None:
+                return stats
+            if tick == 0:
+                stats.first_energy.append(loop.time() - connecting)
+            tick += 1
+    finally:
+        writer.close()
+    return stats
+
+
+async def run_fleet(host, port, connections, rate=1.0, duration=10.0, timeout=5.0, ramp=0.0, latency=0.0):
+    """ Simulates a fleet of modules
+
+    :param host: The server host
+    :param port: The server port
+    :param connections: The number of simulated modules
+    :param rate: Energy frames per second from each module
+    :param duration: Seconds for each module to send energy frames for
+    :param timeout: Seconds to wait for each acknowledgement
+    :param ramp: Seconds over which to spread the connections
+    :param latency: Seconds to add to every round trip, to emulate a slow link
+    :returns: The combined LoadStats
+    """
+    async def start(index):
+        if ramp:
+            await asyncio.sleep(ramp * index / connections)
+        inverter = SimulatedInverter(b'SIM%07d' % index, b'INV%07d' % index)
+        return await simulate(inverter, host, port, rate, duration, timeout, latency)
+
+    stats = LoadStats()
+    begin = time.perf_counter()
+    for result in await asyncio.gather(*[start(index) for index in range(connections)]):
+        stats._merge(result)
+    stats.elapsed = time.perf_counter() - begin
+    return stats
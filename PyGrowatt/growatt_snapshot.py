@@ -0,0 +1,133 @@
+"""
+Growatt Energy Snapshots
+--------------------------------------------------------------------------
+
+GrowattEnergyRequest.execute used to write the input registers one run at
+a time, while the publisher thread read and reset them, so a publish could
+mix the fields of two different frames. Instead, each energy frame now
+produces an immutable EnergySnapshot, which is swapped into the
+inverter's SnapshotStore with a single reference assignment. A reader
+always gets a whole snapshot, the old one or the new one, without taking
+a lock.
+"""
+import itertools
+import threading
+import time
+from collections import namedtuple
+from operator import attrgetter
+
+from PyGrowatt.Growatt import energySchema, inputRegisters
+
+# The register fields, in address order
+registerFields = tuple(sorted(inputRegisters, key=inputRegisters.get))
+
+# The number of input registers a snapshot covers
+registerCount = max(inputRegisters.values()) + 1
+
+snapshotFields = ("sequence", "received") + registerFields
+
+# The divisor of each register field, to convert it to engineering units
+registerScales = dict((field.name, field.scale) for field in energySchema.fields if field.name in inputRegisters)
+
+
+class EnergySnapshot(namedtuple("EnergySnapshot", snapshotFields)):
+    """ The energy input registers of one frame
+
+    :param sequence: The position of the frame in the store, starting at 0
+    :param received: When the frame was executed, as a Unix timestamp
+    """
+    __slots__ = ()
+
+    def values(self):
+        """ Returns the raw register values
+
+        :returns: A dict of field name to raw value
+        """
+        return dict(zip(registerFields, self[2:]))
+
+    def registers(self):
+        """ Returns the input registers, as getValues(4, 0, registerCount) would
+
+        :returns: A list of registerCount values, 0 for the unused addresses
+        """
+        registers = [0] * registerCount
+        for address, value in zip(_registerAddresses, self[2:]):
+            registers[address] = value
+        return registers
+
+
+_registerAddresses = tuple(inputRegisters[name] for name in registerFields)
+
+
+class SnapshotStore(object):
+    """ The latest EnergySnapshot of an inverter
+
+    The server thread calls update() for every energy frame. Readers call
+    latest() for the current snapshot, or since(sequence) for one they have
+    not seen yet. A single consumer can call take(), which returns each
+    snapshot at most once without ever losing a newer one::
+
+        snapshot = store.take()
+        if snapshot is not None:
+            publish(snapshot.values())
+    """
+
+    def __init__(self):
+        self.current = None
+        self._getter = attrgetter(*registerFields)
+        self._sequence = itertools.count()
+        # Only held by writers, so a slower writer cannot replace a newer snapshot with an older one
+        self._lock = threading.Lock()
+        self._taken = 0
+
+    def update(self, message, now=None):
+        """ Replaces the current snapshot with the fields of a decoded frame
+
+        :param message: The decoded GrowattEnergyRequest
+        :param now: The time the frame was received, for testing
+        :returns: The new EnergySnapshot
+        """
+        values = (time.time() if now is None else now,) + self._getter(message)
+        with self._lock:
+            snapshot = EnergySnapshot._make((next(self._sequence),) + values)
+            # The snapshot is complete before it is published, so this assignment is the only write a reader can see
+            self.current = snapshot
+        return snapshot
+
+    def latest(self):
+        """ Returns the current snapshot
+
+        :returns: The EnergySnapshot, or None if there has not been a frame since the store was cleared
+        """
+        return self.current
+
+    def since(self, sequence):
+        """ Returns the current snapshot if it is at least as new as a sequence number
+
+        :param sequence: The sequence number of the first snapshot the reader has not seen
+        :returns: The EnergySnapshot, or None if there is nothing new
+        """
+        snapshot = self.current
+        if snapshot is None or snapshot.sequence < sequence:
+            return None
+        return snapshot
+
+    def take(self):
+        """ Returns the current snapshot unless it has already been taken
+
+        Only the consumer writes the cursor and only the server thread
+        writes the snapshot, so a frame that arrives after the read is
+        returned by the next call rather than being cleared away.
+
+        :returns: The EnergySnapshot, or None if there is nothing new
+        """
+        snapshot = self.since(self._taken)
+        if snapshot is not None:
+            self._taken = snapshot.sequence + 1
+        return snapshot
+
+    def clear(self):
+        """ Forgets the current snapshot
+        """
+        with self._lock:
+            self.current = None
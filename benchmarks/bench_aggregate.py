@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Growatt Fleet Aggregate Benchmark
+--------------------------------------------------------------------------
+
+Compares reading the fleet's total Pac, total Eac_today and count of
+inverters in Fault status by scanning the latest snapshot of every
+inverter against reading the running totals of FleetAggregates, for fleets
+of increasing size, and measures the cost of updating the aggregates with
+a frame (in 10 groups, with new values for a random inverter each time).
+Run from the root of the repository::
+
+    python -m benchmarks.bench_aggregate
+"""
+import random
+import timeit
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_aggregate import FleetAggregates, FAULT_STATUS
+from PyGrowatt.growatt_snapshot import SnapshotStore
+
+
+def frame(store):
+    request = Growatt.GrowattEnergyRequest()
+    request.Pac = random.randrange(50000)
+    request.Ppv = random.randrange(50000)
+    request.Eac_today = random.randrange(500)
+    request.Eac_total = random.randrange(500000)
+    request.inverter_status = random.choice((0, 1, 1, 1, FAULT_STATUS))
+    return store.update(request)
+
+
+def fleet(inverters):
+    """ Returns the SnapshotStore of every inverter and the aggregates of their snapshots """
+    aggregates = FleetAggregates(groups=dict((index, ("site%d" % (index % 10),)) for index in range(inverters)))
+    stores = [SnapshotStore() for _ in range(inverters)]
+    for index, store in enumerate(stores):
+        aggregates.update(index, frame(store))
+    return stores, aggregates
+
+
+def scan(stores):
+    pac = eac_today = faults = 0
+    for store in stores:
+        snapshot = store.current
+        pac += snapshot.Pac
+        eac_today += snapshot.Eac_today
+        faults += snapshot.inverter_status == FAULT_STATUS
+    return pac, eac_today, faults
+
+
+def read(aggregates):
+    fleet = aggregates.fleet
+    return fleet.sums["Pac"], fleet.sums["Eac_today"], fleet.faults
+
+
+def main(number=10000):
+    print("{:>10}{:>14}{:>14}{:>14}{:>14}".format("inverters", "scan (us)", "read (us)", "min (us)", "update (us)"))
+    for inverters in (10, 100, 1000, 10000, 100000):
+        stores, aggregates = fleet(inverters)
+        assert scan(stores) == read(aggregates)
+        scans = max(number // inverters, 1)
+        scanned = min(timeit.repeat(lambda: scan(stores), number=scans, repeat=5)) / scans
+        reads = min(timeit.repeat(lambda: read(aggregates), number=number, repeat=5)) / number
+
+        # New values for a random inverter, so the heaps gain invalid entries as they would in a live fleet
+        updates = [(index, frame(stores[index])) for index in (random.randrange(inverters) for _ in range(number))]
+        updated = min(timeit.repeat(lambda: [aggregates.update(key, snapshot) for key, snapshot in updates],
+                                    number=1, repeat=5)) / number
+        minimum = min(timeit.repeat(lambda: aggregates.fleet.minimum("Pac"), number=number, repeat=5)) / number
+        print("{:>10,}{:>14.2f}{:>14.2f}{:>14.2f}{:>14.2f}".format(inverters, scanned * 1e6, reads * 1e6,
+                                                                   minimum * 1e6, updated * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Growatt Snapshot API Benchmark
+--------------------------------------------------------------------------
+
+Measures the requests/s of the snapshot API (growatt_api.py) for a fleet of
+inverters, polled by a number of concurrent clients over keep-alive
+connections. Compares serialising every response, serving the cached
+document of each inverter, and answering clients that send If-None-Match
+with a 304. The clients run in the same process as the server, so the
+numbers are a lower bound. Run from the root of the repository::
+
+    python -m benchmarks.bench_api
+"""
+import argparse
+import http.client
+import random
+import threading
+import time
+import timeit
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_api import ApiServer, SnapshotApi
+from PyGrowatt.growatt_datastore import GrowattServerContext
+
+
+class UncachedApi(SnapshotApi):
+    """ Serialises every response, as an API without the cache would """
+
+    def inverter(self, serial):
+        inverter = self.context.get(serial)
+        if inverter is None:
+            return None
+        body = self._render(inverter.wifi_serial, inverter.inverter_serial, inverter.context,
+                            inverter.context.snapshots.current)
+        return body, None
+
+
+def fleet(inverters):
+    context = GrowattServerContext()
+    serials = []
+    for index in range(inverters):
+        request = Growatt.GrowattEnergyRequest()
+        request.wifi_serial = b'BENCH%05d' % index
+        request.Pac = index
+        request.execute(context.route(request))
+        serials.append(request.wifi_serial.decode())
+    return context, serials
+
+
+def poll(port, serials, duration, conditional):
+    """ Polls random inverters for a time, returns the number of requests """
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    etags = {}
+    requests = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        serial = random.choice(serials)
+        headers = {"If-None-Match": etags[serial]} if conditional and serial in etags else {}
+        connection.request("GET", "/inverters/" + serial, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        etags[serial] = response.getheader("ETag")
+        requests += 1
+    connection.close()
+    return requests
+
+
+def serve(context, serials, api, clients, duration, conditional):
+    server = ApiServer(context, address=("127.0.0.1", 0))
+    if api is not None:
+        server.api = api
+    server.start()
+    counts = [0] * clients
+
+    def run(index):
+        counts[index] = poll(server.port, serials, duration, conditional)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.stop()
+    return sum(counts) / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--inverters", type=int, default=100)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=3.0)
+    args = parser.parse_args()
+
+    context, serials = fleet(args.inverters)
+    api = SnapshotApi(context)
+    uncached = UncachedApi(context)
+    serial = serials[0].encode()
+    number = 20000
+    print("{:<24}{:>14}".format("document", "build (us)"))
+    for name, build in (("serialised", lambda: uncached.inverter(serial)), ("cached", lambda: api.inverter(serial))):
+        build()
+        print("{:<24}{:>14.2f}".format(name, min(timeit.repeat(build, number=number, repeat=5)) / number * 1e6))
+
+    print()
+    print("{:<24}{:>14}".format("%d clients" % args.clients, "requests/s"))
+    for name, api, conditional in (("serialised 200", UncachedApi(context), False),
+                                   ("cached 200", None, False),
+                                   ("cached 304", None, True)):
+        rate = serve(context, serials, api, args.clients, args.duration, conditional)
+        print("{:<24}{:>14,.0f}".format(name, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Growatt XOR Cipher Benchmark
+--------------------------------------------------------------------------
+
+Compares the cached key stream cipher against the original byte-by-byte
+implementation on full size 0x04 (Energy) and 0x50 (Buffered Energy)
+payloads. Run from the root of the repository::
+
+    python -m benchmarks.bench_cipher
+"""
+import os
+import timeit
+
+from PyGrowatt.growatt_cipher import GrowattCipher
+
+# 0x04 and 0x50 frames carry 575 bytes of payload after the function code
+PAYLOADS = {
+    0x04: os.urandom(575),
+    0x50: os.urandom(575),
+}
+
+
+def legacy_xor(data, key=b'Growatt'):
+    decrypted = b''
+    for i in range(0, len(data)):
+        decrypted += bytes([data[i] ^ key[i % len(key)]])
+    return decrypted
+
+
+def bench(func, data, number):
+    return min(timeit.repeat(lambda: func(data), number=number, repeat=5)) / number
+
+
+def main(number=2000):
+    cipher = GrowattCipher()
+    print("{:<6}{:>8}{:>14}{:>14}{:>10}".format("fc", "bytes", "legacy (us)", "xor (us)", "speedup"))
+    for function_code, data in sorted(PAYLOADS.items()):
+        assert cipher.xor(data) == legacy_xor(data)
+        legacy = bench(legacy_xor, data, number // 10)
+        cached = bench(cipher.xor, data, number)
+        print("0x{:02x}{:>10}{:>14.2f}{:>14.2f}{:>9.1f}x".format(function_code, len(data), legacy * 1e6,
+                                                               cached * 1e6, legacy / cached))
+
+
+if __name__ == "__main__":
+    main()
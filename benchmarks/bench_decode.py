@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Growatt Decode Benchmark
+--------------------------------------------------------------------------
+
+Compares decoding a 0x04 (Energy) and 0x03 (Announce) payload with the
+compiled message schemas against the original per-field struct.unpack_from
+calls, then times GrowattEnergyRequest.decode with and without lazy field
+decoding. Run from the root of the repository::
+
+    python -m benchmarks.bench_decode
+"""
+import os
+import struct
+import timeit
+
+from PyGrowatt import Growatt
+
+
+class _Legacy(object):
+    pass
+
+
+def legacy_energy_decode(data):
+    self = _Legacy()
+    self.wifi_serial = struct.unpack_from(">10s", data, 0)[0]
+    self.inverter_serial = struct.unpack_from(">10s", data, 30)[0]
+    self.year, self.month, self.day = struct.unpack_from(">3B", data, 60)
+    self.hour, self.min, self.sec = struct.unpack_from(">3B", data, 63)
+    self.inverter_status = struct.unpack_from(">H", data, 71)[0]
+    self.Ppv = struct.unpack_from(">I", data, 73)[0]
+    self.Vpv1, self.Ipv1, self.Ppv1 = struct.unpack_from(">HHI", data, 77)
+    self.Vpv2, self.Ipv2, self.Ppv2 = struct.unpack_from(">HHI", data, 85)
+    self.Pac, self.Fac = struct.unpack_from(">IH", data, 117)
+    self.Vac1, self.Iac1, self.Pac1 = struct.unpack_from(">HHI", data, 123)
+    self.Vac_RS = struct.unpack_from(">H", data, 147)[0]
+    self.Eac_today, self.Eac_total, self.Epv_total = struct.unpack_from(">3I", data, 169)
+    self.Epv1_today, self.Epv1_total = struct.unpack_from(">II", data, 181)
+    self.Epv2_today, self.Epv2_total = struct.unpack_from(">II", data, 189)
+    return self
+
+
+def legacy_announce_decode(data):
+    self = _Legacy()
+    self.wifi_serial = struct.unpack_from('>10s', data, 0)[0]
+    self.device_serial = struct.unpack_from('>10s', data, 30)[0]
+    self.active_rate, self.reactive_rate, self.power_factor = struct.unpack_from('>3H', data, 77)
+    self.p_max, self.v_normal = struct.unpack_from('>IH', data, 83)
+    self.fw_version, self.control_fw_version = struct.unpack_from('>6s6s', data, 89)
+    self.device_type = struct.unpack_from('>16s', data, 139)[0]
+    self.year, self.month, self.day, self.hour, self.min, self.sec = struct.unpack_from(">6H", data, 161)
+    return self
+
+
+def schema_decode(schema):
+    def decode(data):
+        message = _Legacy()
+        schema.decode_into(message, data)
+        return message
+    return decode
+
+
+def request_decode(lazy, read=()):
+    def decode(data):
+        request = Growatt.GrowattEnergyRequest()
+        request.lazy = lazy
+        request.decode(data)
+        for name in read:
+            getattr(request, name)
+        return request
+    return decode
+
+
+def bench(func, data, number):
+    return min(timeit.repeat(lambda: func(data), number=number, repeat=5)) / number
+
+
+def main(number=20000):
+    data = os.urandom(575)
+    cases = [
+        ("0x03", legacy_announce_decode, schema_decode(Growatt.announceSchema)),
+        ("0x04", legacy_energy_decode, schema_decode(Growatt.energySchema)),
+    ]
+    print("{:<6}{:>14}{:>14}{:>10}".format("fc", "legacy (us)", "schema (us)", "speedup"))
+    for name, legacy, compiled in cases:
+        assert vars(legacy(data)) == vars(compiled(data))
+        legacy_time = bench(legacy, data, number)
+        compiled_time = bench(compiled, data, number)
+        print("{:<6}{:>14.2f}{:>14.2f}{:>9.1f}x".format(name, legacy_time * 1e6, compiled_time * 1e6,
+                                                       legacy_time / compiled_time))
+
+    # Decoding only the header is enough to route and de-duplicate a frame, the rest is decoded when first read
+    data = memoryview(Growatt.energySchema.pack(legacy_energy_decode(data)).ljust(575, b'\x00'))
+    print()
+    print("{:<34}{:>10}".format("GrowattEnergyRequest.decode", "us"))
+    for name, func in [("eager", request_decode(False)),
+                       ("lazy, header only", request_decode(True, ("wifi_serial", "year"))),
+                       ("lazy, every field", request_decode(True, ("wifi_serial", "Pac")))]:
+        print("{:<34}{:>10.2f}".format(name, bench(func, data, number) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Growatt Framer Throughput Benchmark
+--------------------------------------------------------------------------
+
+Streams 0x04 (Energy) frames through GrowattV6Framer.processIncomingPacket
+in a range of TCP segment sizes: one frame per read, partial frames, and
+many frames coalesced into a single read. Run from the root of the
+repository::
+
+    python -m benchmarks.bench_framer
+"""
+import os
+import time
+
+from pymodbus.factory import ServerDecoder
+
+from PyGrowatt.Growatt import GrowattEnergyRequest, GrowattBufferedEnergyRequest
+from PyGrowatt.growatt_framer import GrowattV6Framer
+
+
+class _Payload(object):
+    """ A stand-in message so buildPacket can build request frames """
+    protocol_id = 6
+    unit_id = 1
+
+    def __init__(self, function_code, transaction_id, data):
+        self.function_code = function_code
+        self.transaction_id = transaction_id
+        self._data = data
+
+    def encode(self):
+        return self._data
+
+
+def energy_frames(count, function_code=0x04):
+    framer = GrowattV6Framer(ServerDecoder())
+    return b''.join(framer.buildPacket(_Payload(function_code, tid & 0xffff, os.urandom(575)))
+                    for tid in range(count))
+
+
+def segments(stream, size):
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+def run(stream, size):
+    decoder = ServerDecoder()
+    decoder.register(GrowattEnergyRequest)
+    decoder.register(GrowattBufferedEnergyRequest)
+    framer = GrowattV6Framer(decoder)
+    results = []
+    reads = segments(stream, size)
+    start = time.perf_counter()
+    for data in reads:
+        framer.processIncomingPacket(data, results.append, 1, single=True)
+    return len(results), time.perf_counter() - start
+
+
+def main(count=2000):
+    stream = energy_frames(count)
+    frame_size = len(stream) // count
+    print("{:<22}{:>10}{:>14}{:>12}".format("segment", "frames", "frames/s", "MB/s"))
+    for name, size in (("1 frame per read", frame_size),
+                       ("100 byte reads", 100),
+                       ("1024 byte reads", 1024),
+                       ("64 frames per read", frame_size * 64)):
+        frames, elapsed = run(stream, size)
+        assert frames == count
+        print("{:<22}{:>10}{:>14.0f}{:>12.2f}".format(name, frames, frames / elapsed,
+                                                      len(stream) / elapsed / 1e6))
+
+    # A burst of buffered 0x50 records delivered in one read should cost the same per frame regardless of its size
+    print()
+    print("{:<22}{:>10}{:>14}".format("0x50 burst", "frames", "us/frame"))
+    for burst in (10, 100, 1000, 5000):
+        stream = energy_frames(burst, 0x50)
+        frames, elapsed = run(stream, len(stream))
+        assert frames == burst
+        print("{:<22}{:>10}{:>14.1f}".format("single read", frames, elapsed / frames * 1e6))
+
+    # Resynchronising after garbage should cost time proportional to the bytes skipped
+    print()
+    print("{:<22}{:>10}{:>14}".format("garbage", "bytes", "MB/s"))
+    for size in (10 ** 4, 10 ** 5, 10 ** 6):
+        stream = os.urandom(size) + energy_frames(1)
+        frames, elapsed = run(stream, 1024)
+        print("{:<22}{:>10}{:>14.2f}".format("1024 byte reads", size, size / elapsed / 1e6))
+
+
+if __name__ == "__main__":
+    main()
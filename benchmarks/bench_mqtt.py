@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Growatt MQTT Benchmark
+--------------------------------------------------------------------------
+
+Measures the latency of one publish cycle against a minimal local broker:
+the original connect, publish every register, disconnect cycle of the
+example script against the persistent GrowattMqttPublisher (per-field
+topics and JSON). Messages are QoS 1 so each cycle ends when the broker has
+acknowledged everything. Run from the root of the repository::
+
+    python -m benchmarks.bench_mqtt
+"""
+import socketserver
+import statistics
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from PyGrowatt.Growatt import inputRegisters
+from PyGrowatt.growatt_datastore import create_slave_context
+from PyGrowatt.growatt_mqtt import GrowattMqttPublisher, mqttTopics
+
+
+class _BrokerHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        try:
+            while True:
+                header = self.rfile.read(1)
+                if not header:
+                    return
+                length, shift = 0, 0
+                while True:
+                    byte = self.rfile.read(1)[0]
+                    length += (byte & 0x7f) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = self.rfile.read(length)
+                kind, qos = header[0] >> 4, (header[0] >> 1) & 3
+                if kind == 1:
+                    self.wfile.write(b'\x20\x02\x00\x00')
+                elif kind == 3 and qos:
+                    offset = 2 + int.from_bytes(body[:2], "big")
+                    self.wfile.write(b'\x40\x02' + body[offset:offset + 2])
+                elif kind == 12:
+                    self.wfile.write(b'\xd0\x00')
+                elif kind == 14:
+                    return
+        except ConnectionError:
+            return
+
+
+class _Broker(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _client():
+    try:
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="Growatt MQTT")
+    except AttributeError:
+        return mqtt.Client(client_id="Growatt MQTT")
+
+
+def legacy_cycle(port, datastore):
+    """ The connect-per-interval cycle of the original growatt_mqtt.py """
+    client = _client()
+    client.connect(host="127.0.0.1", port=port)
+    client.loop_start()
+    infos = [client.publish("home/solar/" + topic, datastore.getValues(4, inputRegisters[name], 1)[0], qos=1,
+                            retain=True)
+             for topic, name, _ in mqttTopics]
+    for info in infos:
+        info.wait_for_publish(5)
+    client.disconnect()
+    client.loop_stop()
+
+
+def measure(cycle, cycles):
+    latencies = []
+    for _ in range(cycles):
+        start = time.perf_counter()
+        cycle()
+        latencies.append(time.perf_counter() - start)
+    return statistics.median(latencies), max(latencies)
+
+
+def main(cycles=50):
+    broker = _Broker(("127.0.0.1", 0), _BrokerHandler)
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+    port = broker.server_address[1]
+    datastore = create_slave_context()
+
+    results = [("connect per cycle", measure(lambda: legacy_cycle(port, datastore), cycles))]
+    for payload in ("topics", "json"):
+        publisher = GrowattMqttPublisher("127.0.0.1", port, payload=payload, qos=1)
+        publisher.start()
+        while not publisher.connected:
+            time.sleep(0.01)
+        results.append(("persistent " + payload,
+                        measure(lambda: publisher.publish_datastore(datastore, timeout=5), cycles)))
+        publisher.stop()
+
+    print("{:<22}{:>14}{:>14}".format("publisher", "median (ms)", "max (ms)"))
+    for name, (median, worst) in results:
+        print("{:<22}{:>14.2f}{:>14.2f}".format(name, median * 1000, worst * 1000))
+    broker.shutdown()
+
+
+if __name__ == "__main__":
+    main()
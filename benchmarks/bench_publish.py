@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Growatt Publish Latency Benchmark
+--------------------------------------------------------------------------
+
+Measures the end-to-end latency from an energy frame being executed to it
+being published, for a fleet of inverters that each send a frame every
+--period seconds. Compares a publisher that polls the datastore every
+--interval seconds (as the example scripts used to, on UpdateInterval)
+against a Sink that is pushed each frame as it arrives, with and without a
+coalescing window. The times are scaled down: a 1 second period and
+interval stand for the 5 minutes of a real module. Run from the root of
+the repository::
+
+    python -m benchmarks.bench_publish
+"""
+import argparse
+import random
+import threading
+import time
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_datastore import create_slave_context
+from PyGrowatt.growatt_pipeline import Pipeline, Sink, COALESCE_LATEST
+from PyGrowatt.growatt_replay import percentile
+
+
+def send_frames(stores, period, duration):
+    """ Executes an energy frame for each store every period seconds, at random phases """
+    due = [(random.uniform(0, period), index) for index in range(len(stores))]
+    start = time.monotonic()
+    sent = 0
+    while True:
+        due.sort()
+        when, index = due[0]
+        if when > duration:
+            return sent
+        delay = start + when - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        request = Growatt.GrowattEnergyRequest()
+        request.wifi_serial = b'BENCH%05d' % index
+        request.Pac = sent
+        request.execute(stores[index])
+        sent += 1
+        due[0] = (when + period, index)
+
+
+def poll(inverters, period, interval, duration):
+    stores = [create_slave_context() for _ in range(inverters)]
+    latencies = []
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            for store in stores:
+                snapshot = store.snapshots.take()
+                if snapshot is not None:
+                    latencies.append(time.time() - snapshot.received)
+
+    poller = threading.Thread(target=run)
+    poller.start()
+    send_frames(stores, period, duration)
+    time.sleep(interval)
+    stop.set()
+    poller.join()
+    return latencies
+
+
+def push(inverters, period, duration, window):
+    latencies = []
+    sink = Sink("bench", lambda key, snapshot: latencies.append(time.time() - snapshot.received),
+                policy=COALESCE_LATEST, window=window)
+    pipeline = Pipeline([sink])
+    pipeline.start()
+    stores = [create_slave_context(pipeline=pipeline) for _ in range(inverters)]
+    send_frames(stores, period, duration)
+    time.sleep(window + 0.1)
+    pipeline.stop(timeout=5)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--inverters", type=int, default=50)
+    parser.add_argument("--period", type=float, default=1.0, help="seconds between the frames of an inverter")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between polls of the datastore")
+    parser.add_argument("--window", type=float, default=0.05, help="the coalescing window of the pushed sink")
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    runs = [("poll %gs" % args.interval, lambda: poll(args.inverters, args.period, args.interval, args.duration)),
+            ("push", lambda: push(args.inverters, args.period, args.duration, 0.0)),
+            ("push %gs window" % args.window, lambda: push(args.inverters, args.period, args.duration, args.window))]
+    print("{:<20}{:>10}{:>12}{:>12}{:>12}{:>12}".format("publisher", "published", "p50 (ms)", "p90 (ms)",
+                                                         "p99 (ms)", "max (ms)"))
+    for name, run in runs:
+        latencies = run()
+        print("{:<20}{:>10,}{:>12.1f}{:>12.1f}{:>12.1f}{:>12.1f}".format(
+            name, len(latencies), *(percentile(latencies, p) * 1e3 for p in (50, 90, 99, 100))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+"""
+Growatt pcap Replay Benchmark
+--------------------------------------------------------------------------
+
+Replays the client traffic of pcap captures through GrowattV6Framer and the
+Growatt request classes, and reports frames/s, bytes/s and the decode and
+execute latency percentiles by function code. Defaults to the anonymised
+captures in test/captures. Run from the root of the repository::
+
+    python -m benchmarks.bench_replay [--repeat N] [--port 5279] [capture.pcap ...]
+"""
+import argparse
+import glob
+import os
+
+from PyGrowatt.growatt_replay import GrowattReplay, read_pcap
+
+CAPTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test", "captures")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("captures", nargs="*", default=sorted(glob.glob(os.path.join(CAPTURES, "*.pcap"))))
+    parser.add_argument("--repeat", type=int, default=50, help="the number of times to replay each capture")
+    parser.add_argument("--port", type=int, default=5279, help="the TCP port of the server in the capture")
+    args = parser.parse_args()
+
+    for path in args.captures:
+        segments = read_pcap(path, port=args.port)
+        stats = GrowattReplay().run(segments, repeat=args.repeat)
+        print("{} x{}".format(os.path.basename(path), args.repeat))
+        print(stats.report())
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Growatt Reply Build Benchmark
+--------------------------------------------------------------------------
+
+Times GrowattV6Framer.buildPacket for the replies the server sends most
+often (the 0x04, 0x50 and 0x03 ACKs and the 0x16 ping reply), encoding
+every reply against reusing the cached frame and only patching in the
+transaction id. Run from the root of the repository::
+
+    python -m benchmarks.bench_reply
+"""
+import timeit
+
+from pymodbus.factory import ServerDecoder
+
+from PyGrowatt.Growatt import GrowattEnergyResponse, GrowattBufferedEnergyResponse, GrowattAnnounceResponse, \
+    GrowattPingResponse
+from PyGrowatt.growatt_framer import GrowattV6Framer, ResponseCache
+
+
+def replies(response, count):
+    messages = []
+    for tid in range(count):
+        message = response()
+        message.transaction_id = tid & 0xffff
+        message.unit_id = 1
+        messages.append(message)
+    return messages
+
+
+def run(framer, messages):
+    build = framer.buildPacket
+    for message in messages:
+        build(message)
+
+
+def main(count=10000):
+    cases = [
+        ("0x04", GrowattEnergyResponse),
+        ("0x50", GrowattBufferedEnergyResponse),
+        ("0x03", GrowattAnnounceResponse),
+        ("0x16", lambda: GrowattPingResponse(wifi_serial=b'ABC1D2345E')),
+    ]
+    uncached = GrowattV6Framer(ServerDecoder())
+    uncached.response_cache = None
+    cached = GrowattV6Framer(ServerDecoder())
+    cached.response_cache = ResponseCache()
+
+    print("{:<6}{:>18}{:>18}{:>10}".format("fc", "encoded (rep/s)", "cached (rep/s)", "speedup"))
+    for name, response in cases:
+        messages = replies(response, count)
+        assert [uncached.buildPacket(m) for m in messages] == [cached.buildPacket(m) for m in messages]
+        encoded = min(timeit.repeat(lambda: run(uncached, messages), number=1, repeat=5))
+        reused = min(timeit.repeat(lambda: run(cached, messages), number=1, repeat=5))
+        print("{:<6}{:>18,.0f}{:>18,.0f}{:>9.1f}x".format(name, count / encoded, count / reused, encoded / reused))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Growatt Restart Benchmark
+--------------------------------------------------------------------------
+
+Measures the time from a simulated ShineWiFi-X module connecting to its
+first energy frame being acknowledged after a server restart, with and
+without a ConfigCache. Without the cache (or on the first start) every
+module is queried for its 31 config values, one round trip each; with it
+only the handshake runs. Run from the root of the repository::
+
+    python -m benchmarks.bench_restart [--connections 100] [--latency 0.05]
+"""
+import argparse
+import asyncio
+import functools
+import os
+import tempfile
+
+from PyGrowatt.growatt_config_cache import ConfigCache
+from PyGrowatt.growatt_datastore import GrowattServerContext, create_slave_context
+from PyGrowatt.growatt_replay import percentile
+from PyGrowatt.growatt_server import GrowattServer
+from PyGrowatt.growatt_simulator import run_fleet
+
+
+async def start(args, cache_path=None):
+    """ Starts a server (with a fresh datastore, as after a restart) and runs the fleet against it """
+    factory = create_slave_context
+    if cache_path is not None:
+        factory = functools.partial(create_slave_context, config_cache=ConfigCache(cache_path))
+    server = GrowattServer(GrowattServerContext(factory=factory), address=("127.0.0.1", 0))
+    await server.start()
+    try:
+        return await run_fleet("127.0.0.1", server.sockets[0].getsockname()[1], args.connections, rate=10,
+                               duration=0.1, ramp=args.ramp, latency=args.latency)
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--connections", type=int, default=100, help="the number of simulated modules")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds to add to every round trip")
+    parser.add_argument("--ramp", type=float, default=0.5, help="seconds over which to open the connections")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache_path = os.path.join(directory, "inverters.jsonl")
+        cases = [("no cache", None), ("cache, first start", cache_path), ("cache, restart", cache_path)]
+        print("{:<22}{:>10}{:>10}{:>10}{:>10}".format("server", "queried", "p50 (ms)", "p90 (ms)", "p99 (ms)"))
+        for name, path in cases:
+            stats = asyncio.run(start(args, path))
+            assert stats.handshakes == args.connections, stats.report()
+            print("{:<22}{:>10}{:>10.0f}{:>10.0f}{:>10.0f}".format(
+                name, stats.queries, *[percentile(stats.first_energy, p) * 1e3 for p in (50, 90, 99)]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Growatt Server Load Test
+--------------------------------------------------------------------------
+
+Connects an increasing number of simulated ShineWiFi-X modules to the
+threaded pymodbus server and to the asyncio GrowattServer, and reports the
+frames per second each sustains along with the number of threads used. Run
+from the root of the repository::
+
+    python -m benchmarks.bench_server
+"""
+import asyncio
+import binascii
+import struct
+import threading
+import time
+
+from pymodbus.datastore import ModbusSparseDataBlock, ModbusSlaveContext, ModbusServerContext
+from pymodbus.server.sync import ModbusTcpServer
+
+from PyGrowatt.growatt_framer import GrowattV6Framer
+from PyGrowatt.growatt_server import GrowattServer, growattFunctions
+
+PING = binascii.unhexlify("000200060020011606302c4625464773472a7761747447726f7761747447726f77617474477268a5")
+
+
+def _context():
+    input_register = ModbusSparseDataBlock([0] * 100)
+    holding_register = ModbusSparseDataBlock([0] * 100)
+    store = ModbusSlaveContext(hr=holding_register, ir=input_register, zero_mode=True)
+    store.register(0x18, 'h', holding_register)
+    store.register(0x19, 'h', holding_register)
+    return ModbusServerContext(slaves=store, single=True)
+
+
+def start_threaded():
+    server = ModbusTcpServer(_context(), GrowattV6Framer, address=("127.0.0.1", 0), allow_reuse_address=True)
+    for f in growattFunctions:
+        server.decoder.register(f)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+    return server.server_address[1], stop
+
+
+def start_async():
+    loop = asyncio.new_event_loop()
+    server = GrowattServer(_context(), address=("127.0.0.1", 0))
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+    return server.sockets[0].getsockname()[1], stop
+
+
+async def client(port, frames, connected):
+    """ Sends ping frames one at a time, returning the number answered """
+    answered = 0
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        connected.append(threading.active_count())
+        for _ in range(frames):
+            writer.write(PING)
+            header = await reader.readexactly(6)
+            await reader.readexactly(struct.unpack('>HHH', header)[2] + 2)
+            answered += 1
+        writer.close()
+    except (OSError, asyncio.IncompleteReadError):
+        pass
+    return answered
+
+
+async def load(port, connections, frames):
+    connected = []
+    start = time.perf_counter()
+    answered = await asyncio.gather(*[client(port, frames, connected) for _ in range(connections)])
+    elapsed = time.perf_counter() - start
+    failed = sum(1 for a in answered if a < frames)
+    return sum(answered) / elapsed, max(connected or [0]), failed
+
+
+def main(frames=50):
+    print("{:<10}{:>8}{:>14}{:>10}{:>8}".format("server", "clients", "frames/s", "threads", "failed"))
+    for connections in (1, 10, 100, 250):
+        for name, start in (("threaded", start_threaded), ("asyncio", start_async)):
+            port, stop = start()
+            fps, threads, failed = asyncio.run(load(port, connections, frames))
+            stop()
+            print("{:<10}{:>8}{:>14.0f}{:>10}{:>8}".format(name, connections, fps, threads, failed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Growatt Snapshot Benchmark
+--------------------------------------------------------------------------
+
+Compares GrowattEnergyRequest.execute writing the input registers with
+setValues against swapping in an EnergySnapshot, and reading the
+registers back with read_snapshot, with and without a publisher thread
+reading concurrently. Run from the root of the repository::
+
+    python -m benchmarks.bench_snapshot
+"""
+import threading
+import time
+import timeit
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_datastore import create_slave_context, read_snapshot
+from PyGrowatt.growatt_snapshot import registerFields
+
+
+def energy(value):
+    request = Growatt.GrowattEnergyRequest()
+    for name in registerFields:
+        setattr(request, name, value)
+    return request
+
+
+def contexts():
+    registers = create_slave_context()
+    # Without a SnapshotStore, execute falls back to setValues
+    del registers.snapshots
+    return [("setValues", registers), ("snapshot", create_slave_context())]
+
+
+def torn_reads(store, frames):
+    """ Counts the reads that mix the fields of two frames while a writer runs """
+    stop = threading.Event()
+    counts = [0, 0]
+
+    def read():
+        while not stop.is_set():
+            counts[0] += 1
+            if len(set(read_snapshot(store).values())) != 1:
+                counts[1] += 1
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    start = time.perf_counter()
+    for value in range(frames):
+        energy(value).execute(store)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    reader.join()
+    return frames / elapsed, counts[0], counts[1]
+
+
+def main(number=20000):
+    request = energy(1)
+    print("{:<12}{:>14}{:>14}".format("store", "execute (us)", "read (us)"))
+    for name, store in contexts():
+        request.execute(store)
+        execute = min(timeit.repeat(lambda: request.execute(store), number=number, repeat=5)) / number
+        read = min(timeit.repeat(lambda: read_snapshot(store), number=number, repeat=5)) / number
+        print("{:<12}{:>14.2f}{:>14.2f}".format(name, execute * 1e6, read * 1e6))
+
+    print()
+    print("{:<12}{:>16}{:>12}{:>12}".format("store", "frames/s", "reads", "torn"))
+    for name, store in contexts():
+        rate, reads, torn = torn_reads(store, number)
+        print("{:<12}{:>16,.0f}{:>12,}{:>12,}".format(name, rate, reads, torn))
+
+
+if __name__ == "__main__":
+    main()
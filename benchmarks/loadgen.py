@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Growatt Fleet Load Generator
+--------------------------------------------------------------------------
+
+Connects a fleet of simulated ShineWiFi-X modules to a Growatt server. Each
+module runs the announce, config and ping handshake, then sends energy
+frames at a fixed rate, and the ACK round-trip latency percentiles and the
+number of dropped and malformed responses are reported. Without --host an
+asyncio GrowattServer is started in-process to run against. Run from the
+root of the repository::
+
+    python -m benchmarks.loadgen [--connections 100] [--rate 1] [--duration 10] [--host HOST] [--port 5279]
+
+Thousands of connections need a higher open file limit than most defaults
+(see ``ulimit -n``); the soft limit is raised to the hard limit on start.
+"""
+import argparse
+import asyncio
+
+from PyGrowatt.growatt_datastore import GrowattServerContext
+from PyGrowatt.growatt_server import GrowattServer
+from PyGrowatt.growatt_simulator import run_fleet
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+
+def _raise_file_limit():
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def load(args):
+    server = None
+    host, port = args.host, args.port
+    if host is None:
+        server = GrowattServer(GrowattServerContext(), address=("127.0.0.1", 0))
+        await server.start()
+        host, port = "127.0.0.1", server.sockets[0].getsockname()[1]
+    try:
+        return await run_fleet(host, port, args.connections, rate=args.rate, duration=args.duration,
+                               timeout=args.timeout, ramp=args.ramp, latency=args.latency)
+    finally:
+        if server is not None:
+            await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--connections", type=int, default=100, help="the number of simulated modules")
+    parser.add_argument("--rate", type=float, default=1.0, help="energy frames per second from each module")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to send energy frames for")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds to wait for each ACK")
+    parser.add_argument("--ramp", type=float, default=1.0, help="seconds over which to open the connections")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to add to every round trip")
+    parser.add_argument("--host", help="the server to test, defaults to an in-process GrowattServer")
+    parser.add_argument("--port", type=int, default=5279)
+    args = parser.parse_args()
+
+    _raise_file_limit()
+    stats = asyncio.run(load(args))
+    print(stats.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+Growatt Capture Generator
+--------------------------------------------------------------------------
+
+Writes the anonymised pcap captures in test/captures, which are replayed by
+the test suite and the replay benchmark. The traffic follows what real
+ShineWiFi-X modules send: the announce (0x03), the config values (0x19),
+pings (0x16), live energy (0x04) and a burst of buffered energy (0x50)
+after an outage, with the server's responses. Serial numbers, addresses
+and config values are made up (the addresses are from TEST-NET-1). Run from
+the root of the repository::
+
+    python -m benchmarks.make_captures
+"""
+import os
+import socket
+import struct
+
+import dpkt
+from pymodbus.factory import ServerDecoder
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_datastore import create_slave_context
+from PyGrowatt.growatt_framer import GrowattV6Framer
+
+CAPTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test", "captures")
+
+SERVER = ("192.0.2.1", 5279)
+# The (address, port, wifi serial, inverter serial) of each module
+MODULES = [("192.0.2.10", 49152, b'ABC1D2345E', b'WXY9Z87654'),
+           ("192.0.2.11", 49153, b'DEF2G3456H', b'STU8V76543')]
+CONFIG_VALUES = [(0x05, b'1'), (0x06, b'32'), (0x08, None), (0x0d, b'16'), (0x0e, b'192.0.2.1'),
+                 (0x10, b'02:00:00:00:00:01'), (0x12, b'5279'), (0x15, b'1.7.7.7')]
+PAYLOAD_SIZE = 575
+MSS = 1448
+
+
+class _Payload(object):
+    """ A stand-in message so buildPacket can build request frames """
+    protocol_id = 6
+    unit_id = 1
+
+    def __init__(self, function_code, transaction_id, data):
+        self.function_code = function_code
+        self.transaction_id = transaction_id
+        self._data = data
+
+    def encode(self):
+        return self._data
+
+
+class _Message(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class _Connection(object):
+    """ Writes both directions of a TCP connection """
+
+    def __init__(self, writer, client, server):
+        self.writer = writer
+        self.client = client
+        self.server = server
+        self.seq = {client: 1000, server: 5000}
+        self.time = 1609459200.0
+
+    def _write(self, source, destination, payload, seq=None):
+        segment = dpkt.tcp.TCP(sport=source[1], dport=destination[1], seq=self.seq[source] if seq is None else seq,
+                               ack=self.seq[destination], flags=dpkt.tcp.TH_ACK | dpkt.tcp.TH_PUSH, win=65535,
+                               data=payload)
+        packet = dpkt.ip.IP(src=socket.inet_aton(source[0]), dst=socket.inet_aton(destination[0]),
+                            p=dpkt.ip.IP_PROTO_TCP, ttl=64, data=segment)
+        packet.len = len(bytes(packet))
+        frame = dpkt.ethernet.Ethernet(src=b'\x02\x00\x00\x00\x00\x02', dst=b'\x02\x00\x00\x00\x00\x01',
+                                       type=dpkt.ethernet.ETH_TYPE_IP, data=packet)
+        self.writer.writepkt(bytes(frame), ts=self.time)
+        self.time += 0.001
+
+    def send(self, payload, source=None):
+        source = source or self.client
+        destination = self.server if source == self.client else self.client
+        for i in range(0, len(payload), MSS):
+            self._write(source, destination, payload[i:i + MSS])
+            self.seq[source] += len(payload[i:i + MSS])
+
+    def retransmit(self, payload):
+        """ Sends the last payload from the client again """
+        self._write(self.client, self.server, payload, seq=self.seq[self.client] - len(payload))
+
+
+class _Module(object):
+    """ Builds the frames a ShineWiFi-X module sends, and the server's responses """
+
+    def __init__(self, wifi_serial, inverter_serial):
+        self.wifi_serial = wifi_serial
+        self.inverter_serial = inverter_serial
+        self.framer = GrowattV6Framer(ServerDecoder())
+        self.store = create_slave_context()
+        self.tid = 0
+
+    def request(self, function_code, data):
+        self.tid = (self.tid + 1) & 0xffff
+        return self.framer.buildPacket(_Payload(function_code, self.tid, data.ljust(PAYLOAD_SIZE, b'\x00')
+                                                if function_code in (0x03, 0x04, 0x50) else data))
+
+    def response(self, request_class, data):
+        request = request_class()
+        request.decode(data.ljust(PAYLOAD_SIZE, b'\x00'))
+        response = request.execute(self.store)
+        if response is None:
+            return b''
+        response.transaction_id = self.tid
+        response.unit_id = 1
+        return self.framer.buildPacket(response)
+
+    def announce(self):
+        message = _Message(wifi_serial=self.wifi_serial, device_serial=self.inverter_serial, active_rate=100,
+                           reactive_rate=0, power_factor=10000, p_max=5000, v_normal=2300, fw_version=b'GH1.0 ',
+                           control_fw_version=b'ZAAA  ', device_type=b'   PV Inverter  ', year=2021, month=1,
+                           day=1, hour=0, min=0, sec=0)
+        data = Growatt.announceSchema.pack(message)
+        return self.request(0x03, data), self.response(Growatt.GrowattAnnounceRequest, data)
+
+    def config(self, config_id, value):
+        value = self.wifi_serial if value is None else value
+        data = self.wifi_serial.ljust(30, b'\x00') + struct.pack(">HH", config_id, len(value)) + value
+        return self.request(0x19, data), self.response(Growatt.GrowattQueryRequest, data)
+
+    def ping(self):
+        data = self.wifi_serial.ljust(30, b'\x00')
+        return self.request(0x16, data), self.response(Growatt.GrowattPingRequest, data)
+
+    def energy(self, minute, function_code=0x04):
+        schema = Growatt.energySchema if function_code == 0x04 else Growatt.bufferedEnergySchema
+        pac = int(30000 * max(0.0, 1 - abs(minute - 720) / 360.0))
+        message = _Message(wifi_serial=self.wifi_serial, inverter_serial=self.inverter_serial, year=21, month=1,
+                           day=1, hour=minute // 60, min=minute % 60, sec=0, inverter_status=1 if pac else 0,
+                           Ppv=pac + 300, Vpv1=3100, Ipv1=pac // 620, Ppv1=pac // 2, Vpv2=3050, Ipv2=pac // 610,
+                           Ppv2=pac // 2, Pac=pac, Fac=5001, Vac1=2400, Iac1=pac // 240, Pac1=pac, Vac_RS=2400,
+                           Eac_today=minute // 10, Eac_total=290000 + minute // 10, Epv_total=300000,
+                           Epv1_today=minute // 20, Epv1_total=150000, Epv2_today=minute // 20, Epv2_total=150000)
+        data = schema.pack(message)
+        request_class = Growatt.GrowattEnergyRequest if function_code == 0x04 else Growatt.GrowattBufferedEnergyRequest
+        return self.request(function_code, data), self.response(request_class, data)
+
+
+def write_session(path):
+    """ Two modules connect, send their config, then live energy with an outage replayed as buffered energy """
+    with open(path, "wb") as f:
+        writer = dpkt.pcap.Writer(f, linktype=dpkt.pcap.DLT_EN10MB)
+        for address, port, wifi_serial, inverter_serial in MODULES:
+            module = _Module(wifi_serial, inverter_serial)
+            connection = _Connection(writer, (address, port), SERVER)
+
+            def exchange(frames):
+                request, response = frames
+                connection.send(request)
+                if response:
+                    connection.send(response, source=SERVER)
+
+            exchange(module.announce())
+            for config_id, value in CONFIG_VALUES:
+                exchange(module.config(config_id, value))
+            exchange(module.ping())
+
+            for minute in range(360, 480, 5):
+                request, response = module.energy(minute)
+                if minute == 400:
+                    # A frame split across two segments, then a retransmission of the second
+                    connection.send(request[:100])
+                    connection.send(request[100:])
+                    connection.retransmit(request[100:])
+                else:
+                    connection.send(request)
+                connection.send(response, source=SERVER)
+                if minute % 30 == 0:
+                    exchange(module.ping())
+
+            # The outage: every buffered record arrives in one burst
+            burst = [module.energy(minute, 0x50) for minute in range(480, 780, 5)]
+            connection.send(b''.join(request for request, _ in burst))
+            connection.send(b''.join(response for _, response in burst), source=SERVER)
+
+
+def main():
+    os.makedirs(CAPTURES, exist_ok=True)
+    path = os.path.join(CAPTURES, "session.pcap")
+    write_session(path)
+    print("Wrote", path, os.path.getsize(path), "bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,18 +13,24 @@ handlers.
 from pymodbus.server.sync import StartTcpServer
 
 from pymodbus.device import ModbusDeviceIdentification
-from pymodbus.datastore import ModbusSparseDataBlock
-from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
 
 from PyGrowatt.Growatt import *
+from PyGrowatt.growatt_aggregate import FleetAggregates
+from PyGrowatt.growatt_api import ApiServer
+from PyGrowatt.growatt_config import GrowattConfig
+from PyGrowatt.growatt_config_cache import ConfigCache
+from PyGrowatt.growatt_datastore import GrowattServerContext, create_slave_context
+from PyGrowatt.growatt_deadband import DeadbandFilter, parse_deadbands
 from PyGrowatt.growatt_framer import GrowattV6Framer
+from PyGrowatt.growatt_metrics import MetricsServer, InverterCollector, AggregateCollector, registry
+from PyGrowatt.growatt_mqtt import GrowattMqttPublisher, check_published, mqttTopics
+from PyGrowatt.growatt_pipeline import Pipeline, Sink, COALESCE_LATEST
+from PyGrowatt.growatt_scheduler import GrowattScheduler
+from PyGrowatt.growatt_server import GrowattRequestHandler, StartAsyncServer
 
 import threading
-import configparser as configparser
 import os
 
-import paho.mqtt.client as mqtt
-
 # --------------------------------------------------------------------------- #
 # configure the service logging
 # --------------------------------------------------------------------------- #
@@ -39,104 +45,88 @@ log.setLevel(logging.INFO)
 # ----------------------------------------------------------------------- #
 # load the config from file
 # ----------------------------------------------------------------------- #
-config = configparser.ConfigParser()
-config.read("config.ini")
+# The file is re-read when it changes or on SIGHUP, so the inverter settings can be changed without a restart
+config = GrowattConfig("config.ini")
 
 
-def publish_data(datastore, interval):
+def publish_snapshot(publisher, key, snapshot, per_inverter=False):
     """ Publish the energy data to MQTT
 
-    :param datastore: the ModbusDataBlock that contains the data
-    :param interval:  the interval to publish the data
-    :param client:    the MQTT client to publish the data
+    :param publisher: the GrowattMqttPublisher connected to the MQTT broker
+    :param key: the WiFi serial of the inverter, or None
+    :param snapshot: the EnergySnapshot of the latest energy frame
+    :param per_inverter: publish under the inverter's WiFi serial, so the topics of several inverters don't
+                         overwrite each other
     """
-    # ----------------------------------------------------------------------- #
-    # establish connection to MQTT broker
-    # ----------------------------------------------------------------------- #
-    client = mqtt.Client("Growatt MQTT")
-    log.debug(f"Connecting to {config['MQTT']['ServerIP']}:{config['MQTT']['ServerPort']}")
-    client.connect(host=config['MQTT']['ServerIP'], port=int(config['MQTT']['ServerPort']))
-    client.loop_start()
-
-    log.info("Publishing data to MQTT")
-    # Publish received Energy data
-    #   NOTE: Commented entries are input registers that are not documented and thus have not been implemented. Entered
-    #   below for future expansion.
-    # client.publish("home/solar/wifi/serial", datastore.getValues(4, inputRegisters["wifi_serial"], 1)[0], retain=True)
-    # client.publish("home/solar/inverter/serial", datastore.getValues(4, inputRegisters["inverter_serial"], 1)[0], retain=True)
-    # client.publish("home/solar/date/year", datastore.getValues(4, inputRegisters["year"], 1)[0], retain=True)
-    # client.publish("home/solar/date/month", datastore.getValues(4, inputRegisters["month"], 1)[0], retain=True)
-    # client.publish("home/solar/date/day", datastore.getValues(4, inputRegisters["day"], 1)[0], retain=True)
-    # client.publish("home/solar/date/hour", datastore.getValues(4, inputRegisters["hour"], 1)[0], retain=True)
-    # client.publish("home/solar/date/minute", datastore.getValues(4, inputRegisters["min"], 1)[0], retain=True)
-    # client.publish("home/solar/date/second", datastore.getValues(4, inputRegisters["sec"], 1)[0], retain=True)
-    client.publish("home/solar/inverter/status",
-                   inverter_status_description[datastore.getValues(4, inputRegisters["inverter_status"], 1)[0]],
-                   retain=True)
-    client.publish("home/solar/PV/power", datastore.getValues(4, inputRegisters["Ppv"], 1)[0] / 10, retain=True)
-    client.publish("home/solar/PV/energy/total", datastore.getValues(4, inputRegisters["Epv_total"], 1)[0] / 10,
-                   retain=True)
-    client.publish("home/solar/PV1/voltage", datastore.getValues(4, inputRegisters["Vpv1"], 1)[0] / 10, retain=True)
-    client.publish("home/solar/PV1/current", datastore.getValues(4, inputRegisters["Ipv1"], 1)[0] / 10, retain=True)
-    client.publish("home/solar/PV1/power", datastore.getValues(4, inputRegisters["Ppv1"], 1)[0] / 10, retain=True)
-    client.publish("home/solar/PV1/energy/today", datastore.getValues(4, inputRegisters["Epv1_today"], 1)[0] / 10,
-                   retain=True)
-    client.publish("home/solar/PV1/energy/total", datastore.getValues(4, inputRegisters["Epv1_total"], 1)[0] / 10,
-                   retain=True)
-    client.publish("home/solar/PV2/voltage", datastore.getValues(4, inputRegisters["Vpv2"], 1)[0] / 10, retain=True)
-    client.publish("home/solar/PV2/current", datastore.getValues(4, inputRegisters["Ipv2"], 1)[0] / 10, retain=True)
-    client.publish("home/solar/PV2/power", datastore.getValues(4, inputRegisters["Ppv2"], 1)[0] / 10, retain=True)
-    client.publish("home/solar/PV2/energy/today", datastore.getValues(4, inputRegisters["Epv2_today"], 1)[0] / 10,
-                   retain=True)
-    client.publish("home/solar/PV2/energy/total", datastore.getValues(4, inputRegisters["Epv2_total"], 1)[0] / 10,
-                   retain=True)
-    client.publish("home/solar/AC/power", datastore.getValues(4, inputRegisters["Pac"], 1)[0] / 10, retain=True)
-    client.publish("home/solar/AC/frequency", datastore.getValues(4, inputRegisters["Fac"], 1)[0] / 100, retain=True)
-    client.publish("home/solar/AC1/voltage", datastore.getValues(4, inputRegisters["Vac1"], 1)[0] / 10, retain=True)
-    client.publish("home/solar/AC1/current", datastore.getValues(4, inputRegisters["Iac1"], 1)[0] / 10, retain=True)
-    client.publish("home/solar/AC1/power", datastore.getValues(4, inputRegisters["Pac1"], 1)[0] / 10, retain=True)
-    # client.publish("home/solar/AC/voltage_RS", datastore.getValues(4, inputRegisters["Vac_RS"], 1)[0] / 10, retain=True)
-    client.publish("home/solar/AC/energy/today", datastore.getValues(4, inputRegisters["Eac_today"], 1)[0] / 10,
-                   retain=True)
-    client.publish("home/solar/AC/energy/total", datastore.getValues(4, inputRegisters["Eac_total"], 1)[0] / 10,
-                   retain=True)
-
-    client.disconnect()
-    client.loop_stop()
-
-    # We've consumed the energy data, so reset the store to prevent uploading duplicate data
-    if time.strftime("%H") == "00":
-        # If it's midnight, reset the whole datastore
-        datastore.reset()
-    else:
-        # It's daytime, so only reset the Input Registers
-        datastore.store['i'].reset()
+    prefix = None
+    if per_inverter and key:
+        prefix = publisher.prefix + "/" + key.strip(b"\x00 ").decode("ascii", "replace")
+    infos = publisher.publish(snapshot.values(), prefix)
+    # Raise if the broker is unreachable, so the sink keeps the frame and retries it
+    check_published(infos)
+    log.info("Published %d messages to MQTT (%d suppressed since starting)", len(infos), publisher.suppressed)
 
-    # Keep repeating
-    timer = threading.Timer(interval, publish_data, args=(datastore, interval))
-    timer.start()
 
-    return
+def reset_datastore(context):
+    """ Reset the datastores at midnight
+
+    :param context: the GrowattServerContext that contains the data of every inverter
+    """
+    if time.strftime("%H") == "00":
+        context[0].reset()
+        for inverter in context.inverters():
+            inverter.context.reset()
 
 
 def main():
+    config.install_signal_handler()
+
+    # ----------------------------------------------------------------------- #
+    # establish a persistent connection to the MQTT broker
+    # ----------------------------------------------------------------------- #
+    # Only publish the fields that have changed beyond their deadband, and every field once per heartbeat
+    deadband = None
+    if config.get('MQTT', 'Heartbeat'):
+        deadbands = None
+        if config.has_section('Deadband'):
+            deadbands = parse_deadbands(config['Deadband'].items(), [name for _, name, _ in mqttTopics])
+        deadband = DeadbandFilter(deadbands, heartbeat=float(config['MQTT']['Heartbeat']))
+    publisher = GrowattMqttPublisher(host=config['MQTT']['ServerIP'],
+                                     port=int(config['MQTT']['ServerPort']),
+                                     payload=config['MQTT'].get('Payload', 'topics'),
+                                     deadband=deadband)
+    publisher.start()
+
+    # ----------------------------------------------------------------------- #
+    # publish each energy frame as it arrives, from a separate thread so a
+    # slow broker never delays the server
+    # ----------------------------------------------------------------------- #
+    per_inverter = config['MQTT'].getboolean('PerInverterTopics', False)
+    pipeline = Pipeline([Sink("mqtt", lambda key, snapshot: publish_snapshot(publisher, key, snapshot, per_inverter),
+                              policy=config['MQTT'].get('Overflow', COALESCE_LATEST),
+                              spill_path=config['MQTT'].get('SpillFile', 'mqtt.spill'),
+                              window=float(config['MQTT'].get('Window', '0')),
+                              min_interval=float(config['MQTT'].get('MinInterval', '0')))])
+    pipeline.start()
+
     # ----------------------------------------------------------------------- #
     # initialize the data store
     # The Holding Register is used for config data
     # The Input Register is used for 'live' energy data
     # The BufferedEnergy (0x50) will be stored in a "Buffered Input Register"
     # ----------------------------------------------------------------------- #
-    input_register = ModbusSparseDataBlock([0] * 100)
-    holding_register = ModbusSparseDataBlock([0] * 100)
-    buffered_input_register = ModbusSparseDataBlock([0] * 100)
-    store = ModbusSlaveContext(hr=holding_register,
-                               ir=input_register,
-                               zero_mode=True)
-    store.register(0x18, 'h', holding_register)
-    store.register(0x19, 'h', holding_register)
-    store.register(0x50, 'bi', buffered_input_register)
-
-    context = ModbusServerContext(slaves=store, single=True)
+    # Cache the inverter's config values, so it is not queried for all of them again after a restart
+    config_cache = None
+    if config.get('Growatt', 'ConfigCache'):
+        config_cache = ConfigCache(config['Growatt']['ConfigCache'],
+                                   ttl=float(config['Growatt'].get('ConfigCacheTTL', '168')) * 60 * 60)
+    # Keep the fleet totals up to date for the metrics, retracting inverters that miss three updates
+    aggregates = None
+    if config.has_section('Metrics'):
+        aggregates = FleetAggregates(timeout=int(config['Growatt']['UpdateInterval']) * 60 * 3)
+    # Each inverter gets its own datastore, so they don't overwrite each other's registers
+    context = GrowattServerContext(factory=lambda: create_slave_context(config=config, config_cache=config_cache,
+                                                                       pipeline=pipeline, aggregates=aggregates))
 
     # ----------------------------------------------------------------------- #
     # initialize the server information
@@ -150,11 +140,30 @@ def main():
     identity.MajorMinorRevision = '1.0.0'
     identity.UserApplicationName = os.path.basename(__file__)
 
+    # ----------------------------------------------------------------------- #
+    # optionally serve Prometheus metrics
+    # ----------------------------------------------------------------------- #
+    if config.has_section('Metrics'):
+        registry.add_collector(InverterCollector(context))
+        registry.add_collector(AggregateCollector(aggregates))
+        MetricsServer(address=(config['Metrics'].get('Address', '127.0.0.1'),
+                               int(config['Metrics'].get('Port', '9108')))).start()
+
+    # ----------------------------------------------------------------------- #
+    # optionally serve the latest energy values as JSON
+    # ----------------------------------------------------------------------- #
+    if config.has_section('API'):
+        ApiServer(context, address=(config['API'].get('Address', '127.0.0.1'),
+                                    int(config['API'].get('Port', '9109')))).start()
+
     # ----------------------------------------------------------------------- #
     # start the server in a separate thread so it doesn't block this thread
-    # from publishing data to MQTT
     # ----------------------------------------------------------------------- #
-    server_thread = threading.Thread(target=StartTcpServer,
+    if config['Growatt'].get('Server', 'threaded') == 'asyncio':
+        start_server = StartAsyncServer
+    else:
+        start_server = StartTcpServer
+    server_thread = threading.Thread(target=start_server,
                                      name="ServerThread",
                                      kwargs={"context": context,
                                              "identity": identity,
@@ -167,6 +176,7 @@ def main():
                                                                   GrowattBufferedEnergyRequest,
                                                                   ],
                                              "framer": GrowattV6Framer,
+                                             "handler": GrowattRequestHandler,
                                              "allow_reuse_address": True,
                                              },
                                      )
@@ -174,9 +184,11 @@ def main():
     server_thread.start()
 
     # ----------------------------------------------------------------------- #
-    # Periodically publish the data
+    # Periodically check whether it is time to reset the datastore
     # ----------------------------------------------------------------------- #
-    publish_data(store, int(config['Growatt']['UpdateInterval']) * 60)
+    scheduler = GrowattScheduler()
+    scheduler.add(reset_datastore, int(config['Growatt']['UpdateInterval']) * 60, args=(context,))
+    scheduler.run()
 
 
 if __name__ == "__main__":
@@ -13,16 +13,23 @@ handlers.
 from pymodbus.server.sync import StartTcpServer
 
 from pymodbus.device import ModbusDeviceIdentification
-from pymodbus.datastore import ModbusSparseDataBlock
-from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
 
 from PyGrowatt.Growatt import *
+from PyGrowatt.growatt_aggregate import FleetAggregates
+from PyGrowatt.growatt_api import ApiServer
+from PyGrowatt.growatt_backfill import BackfillQueue
+from PyGrowatt.growatt_config import GrowattConfig
+from PyGrowatt.growatt_config_cache import ConfigCache
+from PyGrowatt.growatt_datastore import GrowattServerContext, create_slave_context
 from PyGrowatt.growatt_framer import GrowattV6Framer
+from PyGrowatt.growatt_metrics import MetricsServer, InverterCollector, AggregateCollector, registry
+from PyGrowatt.growatt_pipeline import Pipeline, Sink, COALESCE_LATEST
+from PyGrowatt.growatt_pvoutput import PVOutputClient, PVOutputUploader
+from PyGrowatt.growatt_scheduler import GrowattScheduler
+from PyGrowatt.growatt_server import GrowattRequestHandler, StartAsyncServer
 
 import threading
-import configparser as configparser
 import os
-import requests
 import time
 
 # --------------------------------------------------------------------------- #
@@ -39,79 +46,87 @@ log.setLevel(logging.INFO)
 # ----------------------------------------------------------------------- #
 # load the config from file
 # ----------------------------------------------------------------------- #
-config = configparser.ConfigParser()
-config.read("config.ini")
+# The file is re-read when it changes or on SIGHUP, so the inverter settings can be changed without a restart
+config = GrowattConfig("config.ini")
 
 
 
-def pv_status_upload(datastore, interval):
-    """ Upload the status information to PVOutput.org throughout the day
+def spool_status(uploader, snapshot):
+    """ Spool the status of an energy frame for PVOutput.org, and upload it
 
-    :param datastore: the ModbusDataBlock that contains the data
-    :param interval: the delay in seconds before uploading
+    :param uploader: the PVOutputUploader that spools and uploads the statuses
+    :param snapshot: the EnergySnapshot of the latest energy frame
     """
-    energy_generated = datastore.getValues(4, inputRegisters["Eac_today"], 1)[0] * 100
-    power_generated = datastore.getValues(4, inputRegisters["Pac"], 1)[0] * 0.1
-
     # Wait until we have data to upload
-    if energy_generated == 0 and power_generated == 0:
+    if snapshot.Eac_today == 0 and snapshot.Pac == 0:
         log.debug("No data to upload to PVOutput.org")
-    else:
-        headers = {
-            'X-Pvoutput-Apikey': config['Pvoutput']['Apikey'],
-            'X-Pvoutput-SystemId': config['Pvoutput']['SystemId'],
-        }
-
-        # Status Interval
-        data = {
-            'd': time.strftime('%Y%m%d'),   # Output Date
-            't': time.strftime('%H:%M'),    # Output Time
-            'v1': energy_generated,         # Energy Generation (watt hours)
-            'v2': power_generated,          # Power Generation (watts)
-            # 'v6': store.getValues(4, inputRegisters["Vpv1"], 1)[0] * 0.1, # Voltage (volts)
-            # 'c1': '2', # Cumulative Energy Flag
-            # 'n': '', # Net Flag
-        }
-        response = requests.post('https://pvoutput.org/service/r2/addstatus.jsp', headers=headers, data=data)
-
-        if response.status_code != 200:
-            log.error("Upload to PVOutput.org failed {}: {}".format(response.status_code, response.reason))
-        else:
-            log.info("Upload to PVOutput.org success! ({}Wh / {}W generated)".format(energy_generated, power_generated))
-
-        # We've consumed the energy data, so reset the store to prevent uploading duplicate data
-        if time.strftime("%H") == "00":
-            # If it's midnight, reset the whole datastore
-            datastore.reset()
-        else:
-            # It's daytime, so only reset the Input Registers
-            datastore.store['i'].reset()
-
-    # Keep repeating
-    timer = threading.Timer(interval, pv_status_upload, args=(datastore, interval))
-    timer.start()
+        return
+
+    # Spool the status first, so it is retried later if the upload fails
+    uploader.add(snapshot.received, snapshot.Eac_today * 100, snapshot.Pac * 0.1)
+    uploader.flush()
+
+
+def pv_status_upload(uploader, context):
+    """ Upload the status information to PVOutput.org throughout the day
+
+    :param uploader: the PVOutputUploader that spools and uploads the statuses
+    :param context: the GrowattServerContext that contains the data of every inverter
+    """
+    # Retry anything that failed to upload when it arrived
+    uploader.flush()
+
+    # If it's midnight, reset the datastore of every inverter
+    if time.strftime("%H") == "00":
+        context[0].reset()
+        for inverter in context.inverters():
+            inverter.context.reset()
 
     return
 
 
 def main():
+    config.install_signal_handler()
+
     # ----------------------------------------------------------------------- #
     # initialize the data store
     # The Holding Register is used for config data
     # The Input Register is used for 'live' energy data
     # The BufferedEnergy (0x50) will be stored in a "Buffered Input Register"
+    # and uploaded to PVOutput.org in batches by the backfill queue
     # ----------------------------------------------------------------------- #
-    input_register = ModbusSparseDataBlock([0] * 100)
-    holding_register = ModbusSparseDataBlock([0] * 100)
-    buffered_input_register = ModbusSparseDataBlock([0] * 100)
-    store = ModbusSlaveContext(hr=holding_register,
-                               ir=input_register,
-                               zero_mode=True)
-    store.register(0x18, 'h', holding_register)
-    store.register(0x19, 'h', holding_register)
-    store.register(0x50, 'bi', buffered_input_register)
-
-    context = ModbusServerContext(slaves=store, single=True)
+    uploader = PVOutputUploader(PVOutputClient(config['Pvoutput']['Apikey'], config['Pvoutput']['SystemId']),
+                                config['Pvoutput'].get('SpoolFile', 'pvoutput.spool'))
+
+    def upload_backfill(records):
+        uploader.add_records(records)
+        uploader.flush()
+
+    backfill = BackfillQueue(upload_backfill)
+    backfill.start()
+
+    # Each energy frame is uploaded as it arrives, from a separate thread so the upload never delays the server,
+    # but each inverter is uploaded at most once per status interval
+    status_interval = int(config['Pvoutput']['StatusInterval']) * 60
+    pipeline = Pipeline([Sink("pvoutput", lambda key, snapshot: spool_status(uploader, snapshot),
+                              policy=COALESCE_LATEST,
+                              window=float(config['Pvoutput'].get('Window', '0')),
+                              min_interval=status_interval)])
+    pipeline.start()
+
+    # Cache the inverter's config values, so it is not queried for all of them again after a restart
+    config_cache = None
+    if config.get('Growatt', 'ConfigCache'):
+        config_cache = ConfigCache(config['Growatt']['ConfigCache'],
+                                   ttl=float(config['Growatt'].get('ConfigCacheTTL', '168')) * 60 * 60)
+    # Keep the fleet totals up to date for the metrics, retracting inverters that miss three updates
+    aggregates = None
+    if config.has_section('Metrics'):
+        aggregates = FleetAggregates(timeout=int(config['Growatt']['UpdateInterval']) * 60 * 3)
+    # Each inverter gets its own datastore, so they don't overwrite each other's registers
+    context = GrowattServerContext(factory=lambda: create_slave_context(backfill=backfill, config=config,
+                                                                       config_cache=config_cache, pipeline=pipeline,
+                                                                       aggregates=aggregates))
 
     # ----------------------------------------------------------------------- #
     # initialize the server information
@@ -125,11 +140,31 @@ def main():
     identity.MajorMinorRevision = '1.0.0'
     identity.UserApplicationName = os.path.basename(__file__)
 
+    # ----------------------------------------------------------------------- #
+    # optionally serve Prometheus metrics
+    # ----------------------------------------------------------------------- #
+    if config.has_section('Metrics'):
+        registry.add_collector(InverterCollector(context))
+        registry.add_collector(AggregateCollector(aggregates))
+        MetricsServer(address=(config['Metrics'].get('Address', '127.0.0.1'),
+                               int(config['Metrics'].get('Port', '9108')))).start()
+
+    # ----------------------------------------------------------------------- #
+    # optionally serve the latest energy values as JSON
+    # ----------------------------------------------------------------------- #
+    if config.has_section('API'):
+        ApiServer(context, address=(config['API'].get('Address', '127.0.0.1'),
+                                    int(config['API'].get('Port', '9109')))).start()
+
     # ----------------------------------------------------------------------- #
     # start the server in a separate thread so it doesn't block this thread
     # from uploading to PVOutput.org
     # ----------------------------------------------------------------------- #
-    server_thread = threading.Thread(target=StartTcpServer,
+    if config['Growatt'].get('Server', 'threaded') == 'asyncio':
+        start_server = StartAsyncServer
+    else:
+        start_server = StartTcpServer
+    server_thread = threading.Thread(target=start_server,
                                      name="ServerThread",
                                      kwargs={"context": context,
                                              "identity": identity,
@@ -142,6 +177,7 @@ def main():
                                                                   GrowattBufferedEnergyRequest,
                                                                   ],
                                              "framer": GrowattV6Framer,
+                                             "handler": GrowattRequestHandler,
                                              "allow_reuse_address": True,
                                              },
                                      )
@@ -149,9 +185,12 @@ def main():
     server_thread.start()
 
     # ----------------------------------------------------------------------- #
-    # periodically upload the data to pvoutput.org
+    # periodically retry failed uploads to pvoutput.org, on the status
+    # interval boundaries of the clock (e.g. hh:00, hh:05, ...)
     # ----------------------------------------------------------------------- #
-    pv_status_upload(store, int(config['Pvoutput']['StatusInterval']) * 60)
+    scheduler = GrowattScheduler()
+    scheduler.add(pv_status_upload, status_interval, args=(uploader, context))
+    scheduler.run()
 
 
 if __name__ == "__main__":
@@ -23,10 +23,13 @@ def _xor(data):
         return data
 
 
+# From a buffered energy (0x50) frame from "ABC1D2345E"
+BUFFERED_ENERGY = b'06302c4625464773472a7761747447726F7761747447726F776174744772382f384d2e7f45594255747447726F7761747447726F7761747447726F7775787846716C756ACC7873726E77614E2B40BE6F6D617461047ECD777D7474626E6F7761747447726F7761747447726F7761747447726F776174747E4A7CFB68EF747C726F4E5B747447726F7761747447726F776174744EE96F7761747447726F776174744772564F61DDB565726F774A747437E66F77101A7447727E77615CC647726F6B61743CFB726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F776174744A4D6F2761747447720F7761751F47726F77617475DB7CDD77613A54476F6F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F77617478727EDE7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447'
+
+
 class TestGrowattBufferedEnergyRequest(TestCase):
     def test_decode(self):
-        data = binascii.unhexlify(
-            b'06302c4625464773472a7761747447726F7761747447726F776174744772382f384d2e7f45594255747447726F7761747447726F7761747447726F7775787846716C756ACC7873726E77614E2B40BE6F6D617461047ECD777D7474626E6F7761747447726F7761747447726F7761747447726F776174747E4A7CFB68EF747C726F4E5B747447726F7761747447726F776174744EE96F7761747447726F776174744772564F61DDB565726F774A747437E66F77101A7447727E77615CC647726F6B61743CFB726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F776174744A4D6F2761747447720F7761751F47726F77617475DB7CDD77613A54476F6F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F77617478727EDE7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447726F7761747447')
+        data = binascii.unhexlify(BUFFERED_ENERGY)
 
         request = Growatt.GrowattBufferedEnergyRequest()
         request.decode(_xor(data))
@@ -67,6 +70,40 @@ class TestGrowattBufferedEnergyRequest(TestCase):
         self.assertEqual(request.Epv2_today, 28)
         self.assertEqual(request.Epv2_total, 18620)
 
+    def test_lazy_decode(self):
+        request = Growatt.GrowattBufferedEnergyRequest()
+        request.decode(_xor(binascii.unhexlify(BUFFERED_ENERGY)))
+
+        # Only the header is decoded up front
+        self.assertEqual((request.wifi_serial, request.inverter_serial), (b'ABC1D2345E', b'WXY9Z87654'))
+        self.assertNotIn('Ppv', vars(request))
+        self.assertEqual(request.Ppv, 14943)
+        self.assertEqual(vars(request)['Epv2_total'], 18620)
+
+        # The eager decode gives the same values
+        eager = Growatt.GrowattBufferedEnergyRequest()
+        eager.lazy = False
+        eager.decode(_xor(binascii.unhexlify(BUFFERED_ENERGY)))
+        self.assertIn('Ppv', vars(eager))
+        self.assertEqual(Growatt.bufferedEnergySchema.unpack(Growatt.bufferedEnergySchema.pack(eager)),
+                         Growatt.bufferedEnergySchema.unpack(Growatt.bufferedEnergySchema.pack(request)))
+
+    def test_debug_log(self):
+        request = Growatt.GrowattBufferedEnergyRequest()
+        with self.assertLogs(level='DEBUG') as logs:
+            request.decode(_xor(binascii.unhexlify(BUFFERED_ENERGY)))
+        self.assertIn("Ppv: 1494.3", "\n".join(logs.output))
+
+    def test_short(self):
+        request = Growatt.GrowattBufferedEnergyRequest()
+        with self.assertLogs(level='ERROR'):
+            request.decode(_xor(binascii.unhexlify(BUFFERED_ENERGY))[:100])
+        self.assertEqual((request.wifi_serial, request.Ppv), ([], 0))
+
+    def test_init(self):
+        request = Growatt.GrowattBufferedEnergyRequest(Ppv=10, year=21)
+        self.assertEqual((request.Ppv, request.year, request.Pac), (10, 21, 0))
+
 
 class TestGrowattBufferedEnergyResponse(TestCase):
     def test_encode(self):
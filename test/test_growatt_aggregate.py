@@ -0,0 +1,114 @@
+import random
+from unittest import TestCase
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_aggregate import FleetAggregates
+from PyGrowatt.growatt_datastore import GrowattServerContext, create_slave_context
+from PyGrowatt.growatt_metrics import MetricsRegistry, AggregateCollector
+from PyGrowatt.growatt_snapshot import SnapshotStore
+
+
+def _snapshot(pac, eac_today=0, status=1):
+    request = Growatt.GrowattEnergyRequest()
+    request.Pac = pac
+    request.Eac_today = eac_today
+    request.inverter_status = status
+    return SnapshotStore().update(request, now=1000.0)
+
+
+class TestFleetAggregates(TestCase):
+    def setUp(self):
+        self.aggregates = FleetAggregates(fields=("Pac", "Eac_today"),
+                                          groups={b'A': ("north",), b'B': ("north", "tag"), b'C': ("south",)},
+                                          timeout=600, clock=lambda: 0.0)
+
+    def test_replace(self):
+        self.aggregates.update(b'A', _snapshot(100, 10), now=0)
+        self.aggregates.update(b'B', _snapshot(200, 20), now=0)
+        self.aggregates.update(b'C', _snapshot(300, 30, status=3), now=0)
+        # A frame replaces the inverter's previous values rather than adding to them
+        self.aggregates.update(b'A', _snapshot(150, 12), now=1)
+
+        fleet = self.aggregates.fleet
+        self.assertEqual((fleet.count, fleet.sums, fleet.faults), (3, {"Pac": 650, "Eac_today": 62}, 1))
+        self.assertEqual((fleet.minimum("Pac"), fleet.maximum("Pac")), (150, 300))
+        north = self.aggregates.group("north")
+        self.assertEqual((north.count, north.sums["Pac"], north.faults), (2, 350, 0))
+        self.assertEqual((north.minimum("Pac"), north.maximum("Pac")), (150, 200))
+        self.assertEqual(self.aggregates.group("tag").sums["Pac"], 200)
+        self.assertIsNone(self.aggregates.group("east"))
+
+        # The fault clears
+        self.aggregates.update(b'C', _snapshot(300, 30), now=2)
+        self.assertEqual((fleet.faults, dict(fleet.statuses)), (0, {1: 3}))
+
+    def test_summary(self):
+        self.aggregates.update(b'A', _snapshot(14648, 58), now=0)
+        self.aggregates.update(b'C', _snapshot(0, 0, status=3), now=0)
+        summary = self.aggregates.fleet.summary()
+        self.assertEqual((summary["count"], summary["faults"]), (2, 1))
+        self.assertEqual(summary["statuses"], {"Normal": 1, "Fault": 1})
+        self.assertEqual(summary["Pac"], {"sum": 1464.8, "min": 0.0, "max": 1464.8})
+        self.assertEqual(summary["Eac_today"]["sum"], 5.8)
+
+    def test_timeout(self):
+        self.aggregates.update(b'A', _snapshot(100), now=0)
+        self.aggregates.update(b'B', _snapshot(200), now=300)
+        self.assertEqual(self.aggregates.expire(now=599), [])
+        # A is retracted from the fleet and from its groups
+        self.aggregates.update(b'C', _snapshot(300), now=601)
+        self.assertEqual((self.aggregates.fleet.count, self.aggregates.fleet.sums["Pac"]), (2, 500))
+        self.assertEqual(self.aggregates.fleet.minimum("Pac"), 200)
+        self.assertEqual(self.aggregates.group("north").count, 1)
+        self.assertEqual(self.aggregates.expire(now=1000), [b'B'])
+        self.assertEqual(self.aggregates.group("north").minimum("Pac"), None)
+        self.assertEqual((len(self.aggregates), self.aggregates.retracted), (1, 2))
+
+    def test_assign(self):
+        self.aggregates.update(b'D', _snapshot(100), now=0)
+        self.aggregates.assign(b'D', ("south",))
+        self.assertEqual(self.aggregates.group("south").sums["Pac"], 100)
+        self.aggregates.assign(b'D', ())
+        self.assertEqual((self.aggregates.group("south").count, self.aggregates.fleet.count), (0, 1))
+
+    def test_matches_full_scan(self):
+        aggregates = FleetAggregates(fields=("Pac",))
+        latest = {}
+        for _ in range(5000):
+            key = random.randrange(50)
+            pac = random.randrange(100000)
+            aggregates.update(key, _snapshot(pac))
+            latest[key] = pac
+            if random.random() < 0.1:
+                self.assertEqual(aggregates.fleet.sums["Pac"], sum(latest.values()))
+                self.assertEqual(aggregates.fleet.minimum("Pac"), min(latest.values()))
+                self.assertEqual(aggregates.fleet.maximum("Pac"), max(latest.values()))
+        # The replaced values are compacted out of the heaps
+        self.assertLessEqual(len(aggregates.fleet._minimums[0]), 50 + 50 + 17)
+
+    def test_execute_updates(self):
+        aggregates = FleetAggregates()
+        context = GrowattServerContext(factory=lambda: create_slave_context(aggregates=aggregates))
+        for wifi_serial, pac in ((b'ABC1D2345E', 100), (b'WXY9Z87654', 200), (b'ABC1D2345E', 300)):
+            request = Growatt.GrowattEnergyRequest()
+            request.wifi_serial = wifi_serial
+            request.Pac = pac
+            request.execute(context.route(request))
+        self.assertEqual((aggregates.fleet.count, aggregates.fleet.sums["Pac"]), (2, 500))
+
+        # A frame without a WiFi serial can't be attributed to an inverter, so it is left out
+        request = Growatt.GrowattEnergyRequest()
+        request.Pac = 400
+        request.execute(context.route(request))
+        self.assertEqual((aggregates.fleet.count, aggregates.fleet.sums["Pac"]), (2, 500))
+
+    def test_collector(self):
+        self.aggregates.update(b'A', _snapshot(14648, 58), now=0)
+        self.aggregates.update(b'C', _snapshot(100, 2, status=3), now=0)
+        self.assertEqual([name for name, _ in self.aggregates.items()], [None, "north", "south"])
+        registry = MetricsRegistry()
+        registry.add_collector(AggregateCollector(self.aggregates))
+        metrics = registry.render()
+        self.assertIn('growatt_fleet_inverters{group=""} 2\n', metrics)
+        self.assertIn('growatt_fleet_faults{group="south"} 1\n', metrics)
+        self.assertIn('growatt_fleet_sum{group="north",field="Pac"} 1464.8\n', metrics)
@@ -0,0 +1,139 @@
+import http.client
+import json
+from unittest import TestCase
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_api import ApiServer, SnapshotApi
+from PyGrowatt.growatt_datastore import GrowattServerContext, create_slave_context
+
+
+def _energy(context, wifi_serial=b'ABC1D2345E', inverter_serial=b'XYZ7A19031', pac=14648):
+    request = Growatt.GrowattEnergyRequest()
+    request.wifi_serial = wifi_serial
+    request.inverter_serial = inverter_serial
+    request.inverter_status = 1
+    request.Pac = pac
+    request.Fac = 5004
+    store = context.route(request) if hasattr(context, "route") else context
+    request.execute(store)
+    return store
+
+
+def _announce(store, wifi_serial=b'ABC1D2345E'):
+    request = Growatt.GrowattAnnounceRequest()
+    for name in Growatt.announceSchema.names:
+        setattr(request, name, 0)
+    request.wifi_serial = wifi_serial
+    request.device_serial = b'XYZ7A19031'
+    request.device_type = b'   PV Inverter  '
+    request.year, request.month, request.day = 2021, 1, 9
+    request.execute(store)
+
+
+class TestSnapshotApi(TestCase):
+    def test_inverter(self):
+        context = GrowattServerContext()
+        _announce(_energy(context))
+        api = SnapshotApi(context)
+
+        body, etag = api.inverter(b'ABC1D2345E')
+        document = json.loads(body)
+        self.assertEqual((document["wifi_serial"], document["inverter_serial"]), ("ABC1D2345E", "XYZ7A19031"))
+        self.assertEqual((document["status"], document["sequence"]), ("Normal", 0))
+        self.assertEqual((document["values"]["Pac"], document["values"]["Fac"]), (1464.8, 50.04))
+        self.assertEqual(document["metadata"]["device_type"], "PV Inverter")
+        self.assertEqual(document["metadata"]["year"], 2021)
+
+        # Served from the cache, by either serial, until the next frame
+        self.assertEqual(api.inverter(b'XYZ7A19031'), (body, etag))
+        self.assertEqual(api.renders, 1)
+        _energy(context, pac=100)
+        body, changed = api.inverter(b'ABC1D2345E')
+        self.assertNotEqual(changed, etag)
+        self.assertEqual(json.loads(body)["values"]["Pac"], 10.0)
+        self.assertEqual(api.renders, 2)
+
+        self.assertIsNone(api.inverter(b'WXY9Z87654'))
+
+    def test_announce_after_get(self):
+        # The document changes when the inverter announces itself, even without a new energy frame
+        context = GrowattServerContext()
+        ping = Growatt.GrowattPingRequest()
+        ping.wifi_serial = b'ABC1D2345E'
+        ping.execute(context.route(ping))
+        api = SnapshotApi(context)
+
+        body, etag = api.inverter(b'ABC1D2345E')
+        self.assertIsNone(json.loads(body)["metadata"])
+        _announce(context.route(ping))
+        body, changed = api.inverter(b'ABC1D2345E')
+        self.assertNotEqual(changed, etag)
+        self.assertEqual(json.loads(body)["metadata"]["device_type"], "PV Inverter")
+        self.assertEqual(api.inverter(b'ABC1D2345E'), (body, changed))
+        self.assertEqual(api.renders, 2)
+
+    def test_fleet(self):
+        context = GrowattServerContext()
+        api = SnapshotApi(context)
+        self.assertEqual(json.loads(api.fleet()[0]), {"inverters": []})
+        _energy(context, b'ABC1D2345E')
+        _energy(context, b'WXY9Z87654', b'WXY9Z87654')
+        body, etag = api.fleet()
+        self.assertEqual([inverter["wifi_serial"] for inverter in json.loads(body)["inverters"]],
+                         ["ABC1D2345E", "WXY9Z87654"])
+        self.assertEqual(api.fleet(), (body, etag))
+        _energy(context, b'ABC1D2345E')
+        self.assertNotEqual(api.fleet()[1], etag)
+
+    def test_single_inverter(self):
+        store = create_slave_context()
+        api = SnapshotApi(store)
+        _energy(store)
+        # Until it announces itself, the inverter's serial is not known
+        self.assertEqual(json.loads(api.fleet()[0]), {"inverters": []})
+        _announce(store)
+        document = json.loads(api.inverter(b'ABC1D2345E')[0])
+        self.assertEqual((document["inverter_serial"], document["values"]["Pac"]), (None, 1464.8))
+        self.assertEqual(json.loads(api.fleet()[0])["inverters"][0]["sequence"], 0)
+
+
+class TestApiServer(TestCase):
+    def setUp(self):
+        self.context = GrowattServerContext()
+        _energy(self.context)
+        self.server = ApiServer(self.context, address=("127.0.0.1", 0))
+        self.server.start()
+        self.connection = http.client.HTTPConnection("127.0.0.1", self.server.port, timeout=5)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.stop()
+
+    def _get(self, path, etag=None):
+        self.connection.request("GET", path, headers={"If-None-Match": etag} if etag else {})
+        response = self.connection.getresponse()
+        return response.status, response.getheader("ETag"), response.read()
+
+    def test_etag(self):
+        status, etag, body = self._get("/inverters/ABC1D2345E")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["wifi_serial"], "ABC1D2345E")
+
+        # The same connection is kept open for every poll
+        self.assertEqual(self._get("/inverters/ABC1D2345E", etag), (304, etag, b''))
+        self.assertEqual(self._get("/inverters/ABC1D2345E", '"other", ' + etag)[0], 304)
+        _energy(self.context, pac=100)
+        status, changed, body = self._get("/inverters/ABC1D2345E", etag)
+        self.assertEqual(status, 200)
+        self.assertNotEqual(changed, etag)
+        self.assertEqual(self.server.api.renders, 2)
+
+    def test_fleet(self):
+        status, etag, body = self._get("/inverters")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body)["inverters"]), 1)
+        self.assertEqual(self._get("/inverters/", etag)[0], 304)
+
+    def test_not_found(self):
+        self.assertEqual(self._get("/inverters/WXY9Z87654")[0], 404)
+        self.assertEqual(self._get("/other")[0], 404)
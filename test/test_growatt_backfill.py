@@ -0,0 +1,114 @@
+import threading
+import time
+from unittest import TestCase
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_backfill import BackfillQueue
+from PyGrowatt.growatt_datastore import create_slave_context
+
+
+def _buffered(minute, pac=100, serial=b'WXY9Z87654', hour=10):
+    return Growatt.GrowattBufferedEnergyRequest(wifi_serial=b'ABC1D2345E', inverter_serial=serial,
+                                                year=20, month=12, day=12, hour=hour, min=minute, sec=0,
+                                                Pac=pac, Eac_today=minute)
+
+
+class TestBackfillQueue(TestCase):
+    def test_order_and_dedupe(self):
+        backfill = BackfillQueue()
+        for minute in (30, 10, 20, 10, 0):
+            backfill.add(_buffered(minute))
+        # The same timestamp from a different inverter is not a duplicate
+        self.assertTrue(backfill.add(_buffered(10, serial=b'OTHER00000')))
+        self.assertFalse(backfill.add(_buffered(30)))
+        self.assertFalse(backfill.add(_buffered(0, hour=25)))
+
+        self.assertEqual(len(backfill), 5)
+        self.assertEqual(backfill.duplicates, 2)
+        self.assertEqual(backfill.undated, 1)
+
+        batch = backfill.take(3)
+        self.assertEqual([(r.serial, r.Eac_today) for r in batch],
+                         [(b'WXY9Z87654', 0), (b'OTHER00000', 10), (b'WXY9Z87654', 10)])
+        self.assertEqual([r.Eac_today for r in backfill.take()], [20, 30])
+        self.assertEqual(backfill.take(), [])
+
+        # Records stay de-duplicated after they have been sent
+        self.assertFalse(backfill.add(_buffered(20)))
+
+    def test_execute_adds(self):
+        backfill = BackfillQueue()
+        store = create_slave_context(backfill=backfill)
+        response = _buffered(5, pac=1234).execute(store)
+        self.assertIsInstance(response, Growatt.GrowattBufferedEnergyResponse)
+        self.assertEqual(backfill.take()[0].Pac, 1234)
+
+        # A plain datastore has no backfill queue
+        _buffered(5).execute(create_slave_context())
+
+    def test_flush_batches(self):
+        batches = []
+        backfill = BackfillQueue(batches.append, batch_size=30)
+        for minute in range(12 * 60):
+            backfill.add(_buffered(minute % 60, hour=minute // 60))
+        self.assertEqual(backfill.flush(), 720)
+        self.assertEqual(len(batches), 24)
+        self.assertTrue(all(len(batch) == 30 for batch in batches))
+        timestamps = [record.timestamp for batch in batches for record in batch]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual(backfill.sent, 720)
+
+    def test_failed_batch_requeued(self):
+        def sink(batch):
+            raise IOError("Service unavailable")
+
+        backfill = BackfillQueue(sink)
+        backfill.add(_buffered(1))
+        backfill.add(_buffered(2))
+        with self.assertLogs('PyGrowatt.growatt_backfill', 'ERROR'):
+            self.assertEqual(backfill.flush(), 0)
+        self.assertEqual(len(backfill), 2)
+        self.assertEqual(backfill.sent, 0)
+
+    def test_background_drain(self):
+        received = []
+        done = threading.Event()
+
+        def sink(batch):
+            received.extend(batch)
+            if len(received) == 300:
+                done.set()
+
+        backfill = BackfillQueue(sink, linger=0.05)
+        backfill.start()
+        try:
+            # A multi-hour backlog arrives in a burst...
+            for minute in range(300):
+                backfill.add(_buffered(minute % 60, hour=minute // 60))
+            # ...and is drained in 10 batches, the last one after the linger time
+            self.assertTrue(done.wait(5))
+        finally:
+            backfill.stop(5)
+        self.assertEqual(len(backfill), 0)
+        self.assertEqual(backfill.sent, 300)
+
+    def test_retry_interval(self):
+        attempts = []
+
+        def sink(batch):
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise IOError("Service unavailable")
+
+        backfill = BackfillQueue(sink, linger=0, retry_interval=0.1)
+        with self.assertLogs('PyGrowatt.growatt_backfill', 'ERROR'):
+            backfill.start()
+            try:
+                backfill.add(_buffered(1))
+                deadline = time.monotonic() + 5
+                while backfill.sent == 0 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            finally:
+                backfill.stop(5)
+        self.assertEqual(backfill.sent, 1)
+        self.assertGreaterEqual(attempts[1] - attempts[0], 0.1)
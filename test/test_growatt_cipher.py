@@ -0,0 +1,56 @@
+import binascii
+from unittest import TestCase
+
+from PyGrowatt.growatt_cipher import GrowattCipher, get_cipher
+
+
+def _xor(data, key=b'Growatt'):
+    decrypted = b''
+    for i in range(0, len(data)):
+        decrypted += bytes([data[i] ^ key[i % len(key)]])
+    return decrypted
+
+
+class TestGrowattCipher(TestCase):
+    def test_xor(self):
+        cipher = GrowattCipher()
+
+        # Ping payload from "test_growatt_framer.test_check_frame"
+        data = binascii.unhexlify(b'06302c4625464773472a7761747447726f7761747447726f776174744772')
+        self.assertEqual(cipher.xor(data), b'ABC1D2345E' + b'\x00' * 20)
+        self.assertEqual(cipher.xor(cipher.xor(data)), data)
+
+    def test_matches_reference(self):
+        cipher = GrowattCipher(b'Key')
+        for length in (0, 1, 2, 3, 4, 30, 575):
+            data = bytes(range(256)) * 3
+            data = data[:length]
+            self.assertEqual(cipher.xor(data), _xor(data, b'Key'))
+            self.assertEqual(cipher.xor(bytearray(data)), _xor(data, b'Key'))
+            self.assertEqual(cipher.xor(memoryview(data)), _xor(data, b'Key'))
+
+    def test_leading_zeros(self):
+        # The first byte XORs to zero, which must not be dropped by the big-int conversion
+        cipher = GrowattCipher()
+        self.assertEqual(cipher.xor(b'Gr\x00'), b'\x00\x00o')
+
+    def test_start(self):
+        cipher = GrowattCipher()
+        self.assertEqual(cipher.xor(b'\x16Growatt', 1), b'\x16' + b'\x00' * 7)
+        self.assertEqual(cipher.xor(b'\x16', 1), b'\x16')
+        self.assertEqual(cipher.xor(memoryview(b'\x00\x00Gr'), 2), b'\x00\x00\x00\x00')
+
+    def test_keystream_cache(self):
+        cipher = GrowattCipher()
+        cipher.max_cached_lengths = 2
+        for length in range(1, 10):
+            cipher.xor(b'\x00' * length)
+            self.assertLessEqual(len(cipher._keystreams), 2)
+
+    def test_empty_key(self):
+        with self.assertRaises(ValueError):
+            GrowattCipher(b'')
+
+    def test_get_cipher(self):
+        self.assertIs(get_cipher(b'Growatt'), get_cipher(bytearray(b'Growatt')))
+        self.assertIsNot(get_cipher(b'Growatt'), get_cipher(b'Other'))
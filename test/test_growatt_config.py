@@ -0,0 +1,144 @@
+import os
+import signal
+import tempfile
+import unittest
+from unittest import TestCase
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_config import GrowattConfig
+from PyGrowatt.growatt_datastore import create_slave_context
+
+CONFIG = "[Growatt]\nUpdateInterval = 5\nServerIP = 192.0.2.1\n"
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestGrowattConfig(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "config.ini")
+        self._write(CONFIG)
+        self.clock = _Clock()
+
+    def _write(self, text, mtime=None):
+        with open(self.path, "w") as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_get(self):
+        config = GrowattConfig(self.path)
+        self.assertEqual(config.get('Growatt', 'UpdateInterval'), "5")
+        self.assertEqual(config['Growatt']['ServerIP'], "192.0.2.1")
+        self.assertIsNone(config.get('Growatt', 'Missing'))
+        self.assertEqual(config.get('Missing', 'Missing', fallback="x"), "x")
+        self.assertTrue(config.has_section('Growatt'))
+        self.assertIn('Growatt', config)
+        self.assertEqual(config.reloads, 1)
+
+    def test_missing_file(self):
+        os.remove(self.path)
+        with self.assertLogs("PyGrowatt.growatt_config", "WARNING"):
+            config = GrowattConfig(self.path, check_interval=0)
+        self.assertIsNone(config.get('Growatt', 'UpdateInterval'))
+
+        # The file is picked up once it is created
+        self._write(CONFIG)
+        self.assertEqual(config.get('Growatt', 'UpdateInterval'), "5")
+
+    def test_reload_on_change(self):
+        config = GrowattConfig(self.path, check_interval=10, clock=self.clock)
+        self._write(CONFIG.replace("= 5", "= 10"), mtime=1000000000)
+
+        # The file is not checked again until the interval has passed
+        self.clock.now = 9
+        self.assertEqual(config.get('Growatt', 'UpdateInterval'), "5")
+        self.clock.now = 10
+        self.assertEqual(config.get('Growatt', 'UpdateInterval'), "10")
+        self.assertEqual(config.reloads, 2)
+
+        # An unchanged file is not parsed again
+        for _ in range(100):
+            self.clock.now += 10
+            config.get('Growatt', 'UpdateInterval')
+        self.assertEqual(config.reloads, 2)
+
+    def test_invalid_file(self):
+        config = GrowattConfig(self.path, check_interval=0)
+        self._write("UpdateInterval = 10\n", mtime=1000000000)
+        with self.assertLogs("PyGrowatt.growatt_config", "ERROR"):
+            self.assertEqual(config.get('Growatt', 'UpdateInterval'), "5")
+        # The broken file is not parsed again until it changes
+        self.assertEqual(config.get('Growatt', 'UpdateInterval'), "5")
+
+    def test_reload(self):
+        config = GrowattConfig(self.path, check_interval=3600, clock=self.clock)
+        config.get('Growatt', 'UpdateInterval')
+        # Keep the modification time, so only an explicit reload picks up the change
+        stat = os.stat(self.path)
+        self._write(CONFIG.replace("= 5", "= 1"))
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(config.get('Growatt', 'UpdateInterval'), "5")
+        config.reload()
+        self.assertEqual(config.get('Growatt', 'UpdateInterval'), "1")
+
+    @unittest.skipUnless(hasattr(signal, "SIGHUP"), "requires SIGHUP")
+    def test_sighup(self):
+        config = GrowattConfig(self.path, check_interval=3600, clock=self.clock)
+        previous = signal.getsignal(signal.SIGHUP)
+        self.addCleanup(signal.signal, signal.SIGHUP, previous)
+        config.install_signal_handler()
+
+        self._write(CONFIG.replace("= 5", "= 15"))
+        os.kill(os.getpid(), signal.SIGHUP)
+        self.assertEqual(config.get('Growatt', 'UpdateInterval'), "15")
+
+
+class TestQueryRequest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "config.ini")
+        with open(path, "w") as f:
+            f.write(CONFIG)
+        self.config = GrowattConfig(path)
+        self.store = create_slave_context(config=self.config)
+
+    def _query(self, config_id, value):
+        request = Growatt.GrowattQueryRequest(wifi_serial=b'ABC1D2345E', config_id=config_id,
+                                              config_length=len(value), config_value=value)
+        return request.execute(self.store)
+
+    def test_matching(self):
+        response = self._query(0x04, b'5')
+        self.assertIsInstance(response, Growatt.GrowattQueryResponse)
+        self.assertEqual(response.first_config, 0x04)
+        self.assertIsInstance(self._query(0x11, b'192.0.2.1\x00'), Growatt.GrowattQueryResponse)
+
+    def test_different(self):
+        response = self._query(0x04, b'1')
+        self.assertIsInstance(response, Growatt.GrowattConfigResponse)
+        self.assertEqual((response.config_id, response.config_value), (0x04, "5"))
+
+        response = self._query(0x11, b'192.0.2.99')
+        self.assertIsInstance(response, Growatt.GrowattConfigResponse)
+        self.assertEqual(response.config_value, "192.0.2.1")
+
+    def test_unmanaged(self):
+        # Settings that are not in the config, or datastores without a config, are only ACKed
+        self.assertIsInstance(self._query(0x05, b'1'), Growatt.GrowattQueryResponse)
+        self.store.config = None
+        self.assertIsInstance(self._query(0x04, b'1'), Growatt.GrowattQueryResponse)
+
+    def test_no_disk_io(self):
+        # The burst of queries after a reconnect is served from the cached config
+        for config_id in range(0x01, 0x20):
+            self._query(config_id, b'1')
+        self.assertEqual(self.config.reloads, 1)
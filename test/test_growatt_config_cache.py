@@ -0,0 +1,144 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_config import GrowattConfig
+from PyGrowatt.growatt_config_cache import ConfigCache
+from PyGrowatt.growatt_datastore import create_slave_context
+
+SERIAL = b'ABC1D2345E'
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _query(config_id, value, wifi_serial=SERIAL):
+    return Growatt.GrowattQueryRequest(wifi_serial=wifi_serial, config_id=config_id, config_value=value)
+
+
+def _ping(wifi_serial=SERIAL):
+    request = Growatt.GrowattPingRequest()
+    request.wifi_serial = wifi_serial
+    return request
+
+
+class TestConfigCache(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "inverters.jsonl")
+        self.clock = _Clock()
+
+    def _cache(self, ttl=None):
+        return ConfigCache(self.path, ttl=ttl, clock=self.clock)
+
+    def _sweep(self, cache, values=None):
+        values = values or {0x04: b'5', 0x0e: b'192.0.2.1\x00', 0x1F: b'2021-01-01 00:00:00'}
+        for config_id in range(0x01, 0x20):
+            cache.put(SERIAL, config_id, values.get(config_id, b'0'))
+
+    def test_saved_after_last_config(self):
+        cache = self._cache()
+        self.assertIsNone(cache.get(SERIAL))
+        cache.put(SERIAL, 0x04, b'5')
+        self.assertIsNone(cache.get(SERIAL))
+        self.assertFalse(os.path.exists(self.path))
+
+        self._sweep(cache)
+        self.assertEqual(cache.get(SERIAL)[0x0e], b'192.0.2.1\x00')
+        self.assertEqual(len(cache.get(SERIAL)), 31)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        # Reloaded from the file after a restart
+        reloaded = self._cache()
+        self.assertEqual(reloaded.get(SERIAL), cache.get(SERIAL))
+        self.assertEqual(len(reloaded), 1)
+
+    def test_ttl(self):
+        self._sweep(self._cache())
+        self.clock.now += 60
+        self.assertIsNotNone(self._cache(ttl=60).get(SERIAL))
+        self.clock.now += 1
+        cache = self._cache(ttl=60)
+        self.assertIsNone(cache.get(SERIAL))
+        self.assertEqual(cache.stale, 1)
+
+        # Querying again refreshes the values
+        self._sweep(cache, {0x04: b'1', 0x1F: b'2021-01-02 00:00:00'})
+        self.assertEqual(cache.get(SERIAL)[0x04], b'1')
+
+    def test_compaction(self):
+        cache = self._cache()
+        for day in range(1, 29):
+            self._sweep(cache, {0x1F: b'2021-01-%02d 00:00:00' % day})
+        with open(self.path) as f:
+            lines = len(f.readlines())
+        self.assertLess(lines, 18)
+        self.assertEqual(self._cache().get(SERIAL)[0x1F], b'2021-01-28 00:00:00')
+
+    def test_discard(self):
+        cache = self._cache()
+        self._sweep(cache)
+        cache.discard(SERIAL)
+        self.assertIsNone(cache.get(SERIAL))
+        self.assertIsNone(self._cache().get(SERIAL))
+
+    def test_corrupt_file(self):
+        with open(self.path, "w") as f:
+            f.write('{"ABC1D2345E": {"values": ')
+        with self.assertLogs('PyGrowatt.growatt_config_cache', level='ERROR'):
+            cache = self._cache()
+        self.assertEqual(len(cache), 0)
+        self._sweep(cache)
+        self.assertIsNotNone(self._cache().get(SERIAL))
+
+
+class TestPingWithConfigCache(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "inverters.jsonl")
+        config_path = os.path.join(directory.name, "config.ini")
+        with open(config_path, "w") as f:
+            f.write("[Growatt]\nUpdateInterval = 5\n")
+        self.config = GrowattConfig(config_path)
+
+    def _store(self, config=None):
+        return create_slave_context(config=config, config_cache=ConfigCache(self.path))
+
+    def _run_query(self, store, values):
+        return [_query(config_id, values.get(config_id, b'0')).execute(store) for config_id in range(0x01, 0x20)]
+
+    def test_restart_skips_query(self):
+        store = self._store()
+        self.assertIsInstance(_ping().execute(store), Growatt.GrowattQueryResponse)
+        self._run_query(store, {0x04: b'5', 0x1F: b'2021-01-01 00:00:00'})
+        self.assertIsInstance(_ping().execute(store), Growatt.GrowattPingResponse)
+
+        # A new datastore (as after a restart) restores the values from the cache
+        store = self._store()
+        self.assertIsInstance(_ping().execute(store), Growatt.GrowattPingResponse)
+        self.assertEqual(store.getValues(0x19, 0x04)[0], b'5')
+        self.assertEqual(store.getValues(0x19, 0x1F)[0], b'2021-01-01 00:00:00')
+
+        # An unknown inverter is still queried
+        self.assertIsInstance(_ping(b'XYZ1D2345E').execute(self._store()), Growatt.GrowattQueryResponse)
+
+    def test_config_change_queries(self):
+        store = self._store(self.config)
+        responses = self._run_query(store, {0x04: b'1', 0x1F: b'2021-01-01 00:00:00'})
+        self.assertIsInstance(responses[0x04 - 1], Growatt.GrowattConfigResponse)
+
+        # The cached UpdateInterval differs from the config file, so the query runs again to push the setting
+        store = self._store(self.config)
+        self.assertIsInstance(_ping().execute(store), Growatt.GrowattQueryResponse)
+        self._run_query(store, {0x04: b'5', 0x1F: b'2021-01-01 00:00:00'})
+
+        store = self._store(self.config)
+        self.assertIsInstance(_ping().execute(store), Growatt.GrowattPingResponse)
@@ -0,0 +1,72 @@
+from unittest import TestCase
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_datastore import GrowattServerContext
+
+
+def _energy(wifi_serial, inverter_serial, pac):
+    request = Growatt.GrowattEnergyRequest()
+    request.wifi_serial = wifi_serial
+    request.inverter_serial = inverter_serial
+    request.Pac = pac
+    return request
+
+
+class TestGrowattServerContext(TestCase):
+    def test_route(self):
+        context = GrowattServerContext()
+        first = _energy(b'AAAAAAAAAA', b'INV0000001', 100)
+        second = _energy(b'BBBBBBBBBB', b'INV0000002', 200)
+
+        first.execute(context.route(first))
+        second.execute(context.route(second))
+
+        pac = Growatt.inputRegisters["Pac"]
+        self.assertEqual(context.get(b'AAAAAAAAAA').context.getValues(4, pac, 1), [100])
+        self.assertEqual(context.get(b'BBBBBBBBBB').context.getValues(4, pac, 1), [200])
+        self.assertIs(context.get(b'INV0000002'), context.get(b'BBBBBBBBBB'))
+        self.assertIsNone(context.get(b'CCCCCCCCCC'))
+        self.assertEqual(len(context.inverters()), 2)
+
+        # The default context is untouched
+        self.assertEqual(context[1].getValues(4, pac, 1), [0])
+
+    def test_route_without_serial(self):
+        context = GrowattServerContext()
+        request = Growatt.GrowattEnergyRequest()
+        self.assertIs(context.route(request), context[request.unit_id])
+        self.assertEqual(len(context.inverters()), 0)
+
+    def test_same_inverter(self):
+        context = GrowattServerContext()
+        ping = Growatt.GrowattPingRequest(wifi_serial=b'AAAAAAAAAA')
+        slave = context.route(ping)
+        self.assertIs(context.route(_energy(b'AAAAAAAAAA', b'INV0000001', 1)), slave)
+        self.assertEqual(context.get(b'AAAAAAAAAA').inverter_serial, b'INV0000001')
+
+        # A new inverter behind the same WiFi module replaces the old index entry
+        context.route(_energy(b'AAAAAAAAAA', b'INV0000009', 1))
+        self.assertIsNone(context.get(b'INV0000001'))
+        self.assertIs(context.get(b'INV0000009').context, slave)
+
+    def test_evict_idle(self):
+        context = GrowattServerContext(idle_timeout=60)
+        context.route(_energy(b'AAAAAAAAAA', b'INV0000001', 1), now=0)
+        context.route(_energy(b'BBBBBBBBBB', b'INV0000002', 1), now=30)
+        context.route(_energy(b'AAAAAAAAAA', b'INV0000001', 1), now=40)
+        self.assertEqual([i.wifi_serial for i in context.inverters()], [b'BBBBBBBBBB', b'AAAAAAAAAA'])
+
+        # Routing evicts inverters as they expire
+        context.route(_energy(b'CCCCCCCCCC', b'INV0000003', 1), now=95)
+        self.assertEqual([i.wifi_serial for i in context.inverters()], [b'AAAAAAAAAA', b'CCCCCCCCCC'])
+        self.assertIsNone(context.get(b'INV0000002'))
+
+        evicted = context.evict_idle(now=150)
+        self.assertEqual([i.wifi_serial for i in evicted], [b'AAAAAAAAAA'])
+        self.assertEqual([i.wifi_serial for i in context.inverters()], [b'CCCCCCCCCC'])
+
+    def test_no_eviction(self):
+        context = GrowattServerContext()
+        context.route(_energy(b'AAAAAAAAAA', b'INV0000001', 1), now=0)
+        self.assertEqual(context.evict_idle(now=10 ** 9), [])
+        self.assertEqual(len(context.inverters()), 1)
@@ -0,0 +1,77 @@
+from unittest import TestCase
+
+from PyGrowatt.growatt_deadband import DeadbandFilter, parse_deadband, parse_deadbands
+
+
+class TestParseDeadband(TestCase):
+    def test_parse(self):
+        self.assertEqual(parse_deadband("0.5"), (0.5, 0.0))
+        self.assertEqual(parse_deadband(" 2% "), (0.0, 0.02))
+        for text in ("-1", "-2%", "volts"):
+            with self.assertRaises(ValueError):
+                parse_deadband(text)
+
+    def test_parse_section(self):
+        # configparser lowercases the option names
+        self.assertEqual(parse_deadbands([("vac1", "1"), ("PAC", "2%")], ["Vac1", "Pac"]),
+                         {"Vac1": (1.0, 0.0), "Pac": (0.0, 0.02)})
+        with self.assertRaises(ValueError):
+            parse_deadbands([("vac2", "1")], ["Vac1"])
+
+
+class TestDeadbandFilter(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.filter = DeadbandFilter({"Vac1": (1.0, 0.0), "Pac": (0.0, 0.1)}, heartbeat=300,
+                                     clock=lambda: self.now)
+
+    def _names(self, key, **fields):
+        return [name for name, _ in self.filter.filter(key, sorted(fields.items()))]
+
+    def test_first_frame_passes(self):
+        self.assertEqual(self._names("A", Vac1=230.0, Pac=1000.0, Fac=50.0), ["Fac", "Pac", "Vac1"])
+
+    def test_absolute_deadband(self):
+        self._names("A", Vac1=230.0)
+        self.assertEqual(self._names("A", Vac1=230.9), [])
+        self.assertEqual(self._names("A", Vac1=229.1), [])
+        # Measured from the last published value, so a slow drift is still published
+        self.assertEqual(self._names("A", Vac1=231.1), ["Vac1"])
+        self.assertEqual(self._names("A", Vac1=230.5), [])
+
+    def test_relative_deadband(self):
+        self._names("A", Pac=1000.0)
+        self.assertEqual(self._names("A", Pac=1099.0), [])
+        self.assertEqual(self._names("A", Pac=890.0), ["Pac"])
+        self.assertEqual(self._names("A", Pac=0.0), ["Pac"])
+
+    def test_default_and_text(self):
+        self._names("A", Fac=50.0, inverter_status="Normal")
+        self.assertEqual(self._names("A", Fac=50.0, inverter_status="Normal"), [])
+        self.assertEqual(self._names("A", Fac=50.01, inverter_status="Fault"), ["Fac", "inverter_status"])
+
+    def test_heartbeat(self):
+        self._names("A", Vac1=230.0, Fac=50.0)
+        self.now = 200.0
+        self.assertEqual(self._names("A", Vac1=230.0, Fac=50.1), ["Fac"])
+        # Vac1 was last published at 0, Fac at 200
+        self.now = 300.0
+        self.assertEqual(self._names("A", Vac1=230.0, Fac=50.1), ["Vac1"])
+
+    def test_keys_and_forget(self):
+        self._names("A", Vac1=230.0)
+        self.assertEqual(self._names("B", Vac1=230.0), ["Vac1"])
+        self.filter.forget("A")
+        self.assertEqual(self._names("A", Vac1=230.0), ["Vac1"])
+        self.assertEqual(self._names("B", Vac1=230.0), [])
+        self.filter.clear()
+        self.assertEqual(self._names("A", Vac1=230.0), ["Vac1"])
+        self.assertEqual(self._names("B", Vac1=230.0), ["Vac1"])
+
+    def test_counts(self):
+        self.assertEqual(self.filter.suppressed_ratio(), 0.0)
+        self._names("A", Vac1=230.0, Fac=50.0)
+        for _ in range(3):
+            self._names("A", Vac1=230.0, Fac=50.0)
+        self.assertEqual((self.filter.passed, self.filter.suppressed), (2, 6))
+        self.assertEqual(self.filter.suppressed_ratio(), 0.75)
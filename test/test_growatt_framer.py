@@ -1,9 +1,10 @@
 import binascii
-from unittest import TestCase
+from unittest import TestCase, mock
 
 from pymodbus.factory import ServerDecoder
+from pymodbus.utilities import checkCRC
 
-from PyGrowatt.growatt_framer import GrowattV6Framer
+from PyGrowatt.growatt_framer import GrowattV6Framer, ResponseCache
 
 
 class TestGrowattV6Framer(TestCase):
@@ -68,4 +69,186 @@ class TestGrowattV6Framer(TestCase):
         message.unit_id = 1
         message.protocol_id = 6
         self.assertEqual(binascii.hexlify(framer.buildPacket(message)),
-                         b'00020006002001161f352b4420454d714a2d7761747447726f7761747447726f77617474477267ca')
\ No newline at end of file
+                         b'00020006002001161f352b4420454d714a2d7761747447726f7761747447726f77617474477267ca')
+
+
+# Ping frames from "ABC1D2345E" and "XGD3A1968B"
+PING = binascii.unhexlify("000200060020011606302c4625464773472a7761747447726f7761747447726f77617474477268a5")
+PING_2 = binascii.unhexlify("00500006002001161f352b4420454d714a2d7761747447726f7761747447726f776174744772015d")
+
+
+class TestGrowattV6FramerStream(TestCase):
+    def setUp(self):
+        from PyGrowatt.Growatt import GrowattPingRequest
+
+        decoder = ServerDecoder()
+        decoder.register(GrowattPingRequest)
+        self.framer = GrowattV6Framer(decoder)
+        self.results = []
+
+    def process(self, data):
+        self.framer.processIncomingPacket(data, self.results.append, 1, single=True)
+
+    def test_coalesced_frames(self):
+        self.process(PING + PING_2 + PING)
+        self.assertEqual([r.wifi_serial for r in self.results], [b'ABC1D2345E', b'XGD3A1968B', b'ABC1D2345E'])
+        self.assertEqual([r.transaction_id for r in self.results], [2, 0x50, 2])
+        self.assertEqual(self.framer.getRawFrame(), b'')
+
+    def test_split_frame(self):
+        for i in range(len(PING)):
+            self.process(PING[i:i + 1])
+            self.assertEqual(len(self.results), 1 if i == len(PING) - 1 else 0)
+        self.assertEqual(self.results[0].wifi_serial, b'ABC1D2345E')
+
+    def test_frame_and_partial_frame(self):
+        self.process(PING + PING_2[:20])
+        self.assertEqual(len(self.results), 1)
+        self.assertEqual(self.framer.getRawFrame(), PING_2[:20])
+
+        self.process(PING_2[20:] + PING[:3])
+        self.assertEqual([r.wifi_serial for r in self.results], [b'ABC1D2345E', b'XGD3A1968B'])
+        self.assertEqual(self.framer.getRawFrame(), PING[:3])
+
+    def test_crc_checked_once(self):
+        from PyGrowatt import growatt_framer
+
+        calls = []
+
+        def check_crc(data, crc):
+            calls.append(len(data))
+            return checkCRC(data, crc)
+
+        with mock.patch.object(growatt_framer, 'checkCRC', check_crc):
+            for i in range(0, len(PING), 3):
+                self.process(PING[i:i + 3])
+        self.assertEqual(calls, [len(PING) - 2])
+        self.assertEqual(len(self.results), 1)
+
+    def test_corrupted_frame(self):
+        corrupted = PING[:20] + b'\x00' + PING[21:]
+        self.process(PING_2 + corrupted + PING)
+        self.assertEqual([r.wifi_serial for r in self.results], [b'XGD3A1968B', b'ABC1D2345E'])
+
+    def test_buffer_compaction(self):
+        self.framer.compact_threshold = 100
+        self.process(PING + PING[:10])
+        self.assertEqual(self.framer._offset, len(PING))
+
+        # Below the threshold the consumed bytes stay in the buffer
+        self.process(PING[10:20])
+        self.assertEqual(self.framer._offset, len(PING))
+        self.process(PING[20:] + PING + PING[:5])
+        self.assertEqual(len(self.results), 3)
+        self.assertEqual(self.framer._offset, 3 * len(PING))
+
+        # Past the threshold they are compacted away before the next read
+        self.process(PING[5:])
+        self.assertEqual(len(self.results), 4)
+        self.assertEqual(self.framer.getRawFrame(), b'')
+        self.assertLessEqual(len(self.framer._frame_buffer), len(PING))
+
+    def test_frame_views(self):
+        self.framer.addToFrame(PING + PING_2[:10])
+        frames = self.framer.scanFrames()
+        self.assertEqual(len(frames), 1)
+        header, frame = frames[0]
+        self.assertIsInstance(frame, memoryview)
+        self.assertEqual(header['tid'], 2)
+        self.assertEqual(frame.tobytes(), PING[7:-2])
+
+        # Holding on to a frame must not stop the buffer from growing
+        self.framer.addToFrame(PING_2[10:])
+        self.assertEqual(frame.tobytes(), PING[7:-2])
+        self.assertEqual(self.framer.getRawFrame(), PING_2)
+        frame.release()
+
+    def test_corrupted_frame_counters(self):
+        corrupted = PING[:20] + b'\x00' + PING[21:]
+        self.process(PING_2 + corrupted + PING)
+        self.assertEqual(self.framer.crc_errors, 1)
+        self.assertEqual(self.framer.discarded_bytes, len(PING))
+
+    def test_leading_garbage(self):
+        garbage = b'\xde\xad\xbe\xef' * 5
+        self.process(garbage + PING)
+        self.assertEqual([r.wifi_serial for r in self.results], [b'ABC1D2345E'])
+        self.assertEqual(self.framer.discarded_bytes, len(garbage))
+        self.assertEqual(self.framer.crc_errors, 0)
+
+    def test_implausible_length(self):
+        # A header claiming a huge frame must not stall the connection waiting for it
+        garbage = binascii.unhexlify("00010006ffff0116")
+        self.process(garbage + PING_2)
+        self.assertEqual([r.wifi_serial for r in self.results], [b'XGD3A1968B'])
+        self.assertEqual(self.framer.discarded_bytes, len(garbage))
+
+    def test_false_candidate(self):
+        # A plausible header whose CRC does not match is skipped one byte at a time
+        false_header = binascii.unhexlify("12340006002001160000")
+        self.process(false_header + PING[:30])
+        self.assertEqual(self.results, [])
+        self.process(PING[30:] + PING_2)
+        self.assertEqual([r.wifi_serial for r in self.results], [b'ABC1D2345E', b'XGD3A1968B'])
+        self.assertEqual(self.framer.discarded_bytes, len(false_header))
+        self.assertEqual(self.framer.crc_errors, 1)
+
+    def test_garbage_split_across_reads(self):
+        self.process(b'\xff' * 50)
+        self.assertEqual(self.framer.discarded_bytes, 50 - 7)
+        self.process(b'\xff' * 3 + PING[:4])
+        self.process(PING[4:])
+        self.assertEqual([r.wifi_serial for r in self.results], [b'ABC1D2345E'])
+        self.assertEqual(self.framer.discarded_bytes, 53)
+
+
+class TestResponseCache(TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(max_size=2)
+        self.framer = GrowattV6Framer(ServerDecoder())
+        self.framer.response_cache = self.cache
+
+    def build(self, response, transaction_id, cache=True):
+        response.transaction_id = transaction_id
+        response.unit_id = 1
+        if not cache:
+            self.framer.response_cache = None
+        try:
+            return self.framer.buildPacket(response)
+        finally:
+            self.framer.response_cache = self.cache
+
+    def test_matches_uncached(self):
+        from PyGrowatt.Growatt import GrowattAnnounceResponse, GrowattEnergyResponse, GrowattPingResponse, \
+            GrowattBufferedEnergyResponse
+
+        for response in [GrowattAnnounceResponse(), GrowattEnergyResponse(), GrowattBufferedEnergyResponse(),
+                         GrowattPingResponse(wifi_serial=b'ABC1D2345E')]:
+            for transaction_id in [0, 1, 0xff, 0x100, 0x1234, 0xffff]:
+                packet = self.build(response, transaction_id)
+                self.assertEqual(packet, self.build(response, transaction_id, cache=False))
+                self.assertTrue(checkCRC(packet[:-2], int.from_bytes(packet[-2:], 'little')))
+
+    def test_hits_and_eviction(self):
+        from PyGrowatt.Growatt import GrowattEnergyResponse, GrowattPingResponse
+
+        self.build(GrowattEnergyResponse(), 1)
+        self.build(GrowattEnergyResponse(), 2)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # Each datalogger's ping reply is a separate frame, the least recently used is evicted
+        self.build(GrowattPingResponse(wifi_serial=b'AAAAAAAAAA'), 3)
+        self.build(GrowattEnergyResponse(), 4)
+        self.build(GrowattPingResponse(wifi_serial=b'BBBBBBBBBB'), 5)
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.evictions, 1)
+        packet = self.build(GrowattPingResponse(wifi_serial=b'AAAAAAAAAA'), 6)
+        self.assertEqual(packet, self.build(GrowattPingResponse(wifi_serial=b'AAAAAAAAAA'), 6, cache=False))
+        self.assertEqual(self.cache.misses, 4)
+
+    def test_uncacheable(self):
+        from PyGrowatt.Growatt import GrowattConfigResponse
+
+        self.build(GrowattConfigResponse(wifi_serial=b'ABC1D2345E', config_id=0x04, config_value='5'), 1)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.misses, 0)
@@ -0,0 +1,93 @@
+import sys
+import time
+from unittest import TestCase
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_datastore import create_slave_context
+from PyGrowatt.growatt_history import EnergyHistory, historyFields, inverter_timestamp
+
+
+def _energy(pac, year=21, month=6, day=1, hour=12, minute=0, sec=0):
+    request = Growatt.GrowattEnergyRequest()
+    request.year, request.month, request.day = year, month, day
+    request.hour, request.min, request.sec = hour, minute, sec
+    request.Pac = pac
+    request.Eac_total = 290380
+    return request
+
+
+class TestEnergyHistory(TestCase):
+    def test_append_since(self):
+        history = EnergyHistory(4)
+        self.assertEqual(history.since(), ([], 0))
+        self.assertIsNone(history.latest())
+
+        history.append(_energy(100), timestamp=1)
+        history.append(_energy(200), timestamp=2)
+        samples, cursor = history.since()
+        self.assertEqual([s.Pac for s in samples], [100, 200])
+        self.assertEqual([s.timestamp for s in samples], [1, 2])
+        self.assertEqual(samples[0].Eac_total, 290380)
+        self.assertEqual(cursor, 2)
+
+        # Nothing new until another sample is appended
+        self.assertEqual(history.since(cursor), ([], 2))
+        history.append(_energy(300), timestamp=3)
+        samples, cursor = history.since(cursor)
+        self.assertEqual([s.Pac for s in samples], [300])
+        self.assertEqual(cursor, 3)
+        self.assertEqual(history.latest().Pac, 300)
+
+    def test_wraparound(self):
+        history = EnergyHistory(3)
+        for pac in range(10):
+            history.append(_energy(pac), timestamp=pac)
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history.cursor, 10)
+
+        # A reader that fell behind only gets the samples that are still stored
+        samples, cursor = history.since(2)
+        self.assertEqual([s.Pac for s in samples], [7, 8, 9])
+        self.assertEqual(cursor, 10)
+        samples, _ = history.since(8)
+        self.assertEqual([s.Pac for s in samples], [8, 9])
+
+    def test_inverter_timestamp(self):
+        expected = int(time.mktime((2021, 6, 1, 12, 30, 15, 0, 0, -1)))
+        self.assertEqual(inverter_timestamp(_energy(0, minute=30, sec=15)), expected)
+
+        history = EnergyHistory()
+        history.append(_energy(0, minute=30, sec=15))
+        self.assertEqual(history.latest().timestamp, expected)
+
+        # Frames without a date fall back to the default
+        self.assertIsNone(inverter_timestamp(_energy(0, month=0)))
+        self.assertEqual(inverter_timestamp(_energy(0, day=0), default=5), 5)
+        self.assertEqual(inverter_timestamp(_energy(0, month=13), default=5), 5)
+
+    def test_execute_appends(self):
+        store = create_slave_context(history_capacity=10)
+        _energy(100).execute(store)
+        _energy(200).execute(store)
+        samples, _ = store.history.since()
+        self.assertEqual([s.Pac for s in samples], [100, 200])
+        self.assertEqual(store.getValues(4, Growatt.inputRegisters["Pac"], 1), [200])
+
+    def test_memory_per_inverter_day(self):
+        # Every row is the timestamp plus the energy input registers, 4 bytes each:
+        #   1 minute interval: 1440 rows * 21 values * 4 bytes = 120,960 bytes (~118 KiB)
+        #   5 minute interval:  288 rows * 21 values * 4 bytes =  24,192 bytes (~24 KiB)
+        self.assertEqual(len(historyFields), 21)
+
+        per_minute = EnergyHistory()
+        self.assertEqual(per_minute.capacity, 1440)
+        self.assertEqual(per_minute.nbytes, 120960)
+        self.assertLess(sys.getsizeof(per_minute._data), 120960 + 128)
+
+        per_five_minutes = EnergyHistory(24 * 12)
+        self.assertEqual(per_five_minutes.nbytes, 24192)
+
+        # Appending never grows the storage
+        for pac in range(2000):
+            per_five_minutes.append(_energy(pac), timestamp=pac)
+        self.assertEqual(per_five_minutes.nbytes, 24192)
@@ -0,0 +1,140 @@
+import binascii
+import urllib.error
+import urllib.request
+from unittest import TestCase
+
+from pymodbus.factory import ServerDecoder
+
+from PyGrowatt.growatt_datastore import GrowattServerContext
+from PyGrowatt.growatt_framer import GrowattV6Framer
+from PyGrowatt.growatt_metrics import MetricsRegistry, MetricsServer, InverterCollector, registry, framesReceived, \
+    crcErrors, discardedBytes, decodeSeconds, executeSeconds, sinkFailures, sinkPublishSeconds
+from PyGrowatt.growatt_pvoutput import PVOutputClient
+from PyGrowatt.growatt_server import growattFunctions, execute_request
+
+# Ping from "ABC1D2345E", transaction id 2
+PING = binascii.unhexlify("000200060020011606302c4625464773472a7761747447726f7761747447726f77617474477268a5")
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        counter = self.registry.counter("frames_total", "Frames", ("function_code",))
+        counter.inc(1, ("0x04",))
+        counter.inc(2, ("0x04",))
+        counter.inc(1, ("0x16",))
+        self.assertEqual(counter.value(("0x04",)), 3)
+        self.assertEqual(self.registry.render(), "# HELP frames_total Frames\n# TYPE frames_total counter\n"
+                                                 'frames_total{function_code="0x04"} 3\n'
+                                                 'frames_total{function_code="0x16"} 1\n')
+        # Registering the same name again returns the same metric
+        self.assertIs(self.registry.counter("frames_total", "Frames", ("function_code",)), counter)
+        self.assertRaises(ValueError, self.registry.gauge, "frames_total", "Frames")
+
+    def test_gauge(self):
+        gauge = self.registry.gauge("connections", "Connections")
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(gauge.value(), 1)
+        gauge.set(2.5)
+        self.assertIn("\nconnections 2.5\n", self.registry.render())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.count(), 4)
+        self.assertEqual(histogram.samples(), [("latency_seconds_bucket", '{le="0.1"}', 2),
+                                               ("latency_seconds_bucket", '{le="1"}', 3),
+                                               ("latency_seconds_bucket", '{le="+Inf"}', 4),
+                                               ("latency_seconds_sum", "", 2.65),
+                                               ("latency_seconds_count", "", 4)])
+
+    def test_escape(self):
+        gauge = self.registry.gauge("info", "Info", ("name",))
+        gauge.set(1, ('a "quoted"\\name',))
+        self.assertIn('info{name="a \\"quoted\\"\\\\name"} 1', self.registry.render())
+
+    def test_collector(self):
+        context = GrowattServerContext()
+        decoder = ServerDecoder()
+        for f in growattFunctions:
+            decoder.register(f)
+        GrowattV6Framer(decoder).processIncomingPacket(PING, lambda r: execute_request(context, r), [1],
+                                                      single=True)
+        self.registry.add_collector(InverterCollector(context))
+        self.assertIn('growatt_inverter_last_seen_timestamp_seconds{wifi_serial="ABC1D2345E"} ',
+                      self.registry.render())
+
+        # A failing collector does not stop the rest being rendered
+        self.registry.add_collector(lambda: 1 / 0)
+        with self.assertLogs("PyGrowatt.growatt_metrics", "WARNING"):
+            self.assertIn("wifi_serial", self.registry.render())
+
+
+class TestHotPath(TestCase):
+    def setUp(self):
+        registry.reset()
+        decoder = ServerDecoder()
+        for f in growattFunctions:
+            decoder.register(f)
+        self.framer = GrowattV6Framer(decoder)
+        self.context = GrowattServerContext()
+
+    def tearDown(self):
+        registry.enabled = False
+        registry.reset()
+
+    def _process(self, data):
+        self.framer.processIncomingPacket(data, lambda r: execute_request(self.context, r), [1], single=True)
+
+    def test_disabled(self):
+        self._process(PING + PING[:-1] + b'\x00')
+        self.assertEqual(self.framer.crc_errors, 1)
+        self.assertEqual(registry.render().count("\n"), 2 * len(registry._metrics))
+
+    def test_enabled(self):
+        registry.enabled = True
+        corrupt = PING[:-1] + b'\x00'
+        self._process(b'\xff' * 5 + PING + corrupt + PING)
+
+        self.assertEqual(framesReceived.value(("0x16",)), 2)
+        self.assertEqual(decodeSeconds.count(("0x16",)), 2)
+        self.assertEqual(executeSeconds.count(("0x16",)), 2)
+        self.assertEqual(crcErrors.value(), 1)
+        self.assertEqual(discardedBytes.value(), self.framer.discarded_bytes)
+        self.assertIn('growatt_frames_received_total{function_code="0x16"} 2', registry.render())
+
+    def test_sink_failure(self):
+        registry.enabled = True
+        client = PVOutputClient("key", 1234, url="http://127.0.0.1:1", timeout=1)
+        self.assertRaises(OSError, client.add_batch_status, ["20210101,12:00,100,200"])
+        self.assertEqual(sinkFailures.value(("pvoutput",)), 1)
+        self.assertEqual(sinkPublishSeconds.count(("pvoutput",)), 1)
+
+
+class TestMetricsServer(TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.registry.counter("requests_total", "Requests").inc()
+        self.server = MetricsServer(self.registry, address=("127.0.0.1", 0))
+        self.server.start()
+        self.url = "http://127.0.0.1:%d" % self.server.port
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_metrics(self):
+        self.assertTrue(self.registry.enabled)
+        with urllib.request.urlopen(self.url + "/metrics", timeout=5) as response:
+            self.assertEqual(response.headers["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+            self.assertIn(b"\nrequests_total 1\n", response.read())
+
+    def test_not_found(self):
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            urllib.request.urlopen(self.url + "/other", timeout=5)
+        self.assertEqual(raised.exception.code, 404)
+        raised.exception.close()
@@ -0,0 +1,259 @@
+import json
+import socket
+import socketserver
+import struct
+import threading
+import time
+from unittest import TestCase
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_datastore import create_slave_context, read_snapshot
+from PyGrowatt.growatt_deadband import DeadbandFilter
+from PyGrowatt.growatt_mqtt import GrowattMqttPublisher, check_published, mqttTopics
+from PyGrowatt.growatt_pipeline import Sink, COALESCE_LATEST
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    """ Just enough of an MQTT 3.1.1 broker to accept a client and its publishes """
+
+    def _read(self, count):
+        data = b''
+        while len(data) < count:
+            chunk = self.request.recv(count - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _packet(self):
+        header = self._read(1)[0]
+        length, shift = 0, 0
+        while True:
+            byte = self._read(1)[0]
+            length += (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header, self._read(length)
+
+    def handle(self):
+        self.server.connections += 1
+        self.server.sockets.append(self.request)
+        try:
+            while True:
+                header, body = self._packet()
+                kind = header >> 4
+                if kind == 1:  # CONNECT
+                    self.request.sendall(b'\x20\x02\x00\x00')
+                elif kind == 3:  # PUBLISH
+                    qos = (header >> 1) & 3
+                    topic_length = struct.unpack(">H", body[:2])[0]
+                    topic = body[2:2 + topic_length].decode()
+                    offset = 2 + topic_length
+                    if qos:
+                        self.request.sendall(b'\x40\x02' + body[offset:offset + 2])
+                        offset += 2
+                    with self.server.lock:
+                        self.server.messages.append((topic, body[offset:].decode(), bool(header & 1)))
+                elif kind == 12:  # PINGREQ
+                    self.request.sendall(b'\xd0\x00')
+                elif kind == 14:  # DISCONNECT
+                    return
+        except (EOFError, ConnectionError):
+            return
+
+
+class _Broker(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        socketserver.ThreadingTCPServer.__init__(self, address, _BrokerHandler)
+        self.lock = threading.Lock()
+        self.messages = []
+        self.connections = 0
+        self.sockets = []
+
+    def drop_connections(self):
+        for sock in self.sockets:
+            sock.shutdown(socket.SHUT_RDWR)
+
+
+def _store():
+    store = create_slave_context()
+    request = Growatt.GrowattEnergyRequest()
+    request.inverter_status = 1
+    request.Ppv = 14943
+    request.Pac = 14648
+    request.Fac = 5004
+    request.Eac_total = 290380
+    request.execute(store)
+    return store
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestGrowattMqttPublisher(TestCase):
+    def setUp(self):
+        self.broker = _Broker()
+        self.thread = threading.Thread(target=self.broker.serve_forever, args=(0.01,))
+        self.thread.start()
+        self.port = self.broker.server_address[1]
+
+    def tearDown(self):
+        self.broker.shutdown()
+        self.broker.server_close()
+        self.thread.join()
+
+    def _publisher(self, **kwargs):
+        publisher = GrowattMqttPublisher("127.0.0.1", self.port, **kwargs)
+        publisher.start()
+        self.addCleanup(publisher.stop)
+        self.assertTrue(_wait_for(lambda: publisher.connected))
+        return publisher
+
+    def test_read_snapshot(self):
+        snapshot = read_snapshot(_store())
+        self.assertEqual(snapshot['Pac'], 14648)
+        self.assertEqual(snapshot['Eac_total'], 290380)
+        self.assertEqual(snapshot['Vpv1'], 0)
+
+    def test_topics(self):
+        publisher = self._publisher(qos=1)
+        publisher.publish_datastore(_store(), timeout=5)
+        self.assertTrue(_wait_for(lambda: len(self.broker.messages) == len(mqttTopics)))
+
+        messages = {topic: (payload, retain) for topic, payload, retain in self.broker.messages}
+        self.assertEqual(messages["home/solar/inverter/status"], ("Normal", True))
+        self.assertEqual(messages["home/solar/PV/power"], ("1494.3", True))
+        self.assertEqual(messages["home/solar/AC/frequency"], ("50.04", True))
+        self.assertEqual(messages["home/solar/AC/energy/total"], ("29038.0", True))
+
+    def test_json(self):
+        publisher = self._publisher(payload="json", retain=False)
+        publisher.publish_datastore(_store(), prefix="home/solar/WXY9Z87654")
+        self.assertTrue(_wait_for(lambda: len(self.broker.messages) == 1))
+
+        topic, payload, retain = self.broker.messages[0]
+        self.assertEqual(topic, "home/solar/WXY9Z87654/state")
+        self.assertFalse(retain)
+        self.assertEqual(json.loads(payload)["Pac"], 1464.8)
+        self.assertNotIn(" ", payload)
+
+    def test_single_connection(self):
+        publisher = self._publisher(qos=1, max_inflight=5)
+        store = _store()
+        for _ in range(10):
+            publisher.publish_datastore(store, timeout=5)
+        self.assertTrue(_wait_for(lambda: len(self.broker.messages) == 10 * len(mqttTopics)))
+        self.assertEqual(self.broker.connections, 1)
+        self.assertEqual(publisher.cycles, 10)
+
+        # Every cycle of 20 QoS 1 messages is acknowledged by a local broker well within a second
+        self.assertLess(publisher.last_cycle, 1)
+
+    def test_reconnect(self):
+        publisher = self._publisher()
+        publisher.client.reconnect_delay_set(min_delay=0.1, max_delay=0.1)
+        with self.assertLogs('PyGrowatt.growatt_mqtt', 'WARNING'):
+            self.broker.drop_connections()
+            self.assertTrue(_wait_for(lambda: not publisher.connected))
+        self.assertTrue(_wait_for(lambda: publisher.connected))
+        self.assertEqual(self.broker.connections, 2)
+
+        publisher.publish_datastore(_store())
+        self.assertTrue(_wait_for(lambda: len(self.broker.messages) == len(mqttTopics)))
+
+    def test_deadband(self):
+        publisher = self._publisher(qos=1, deadband=DeadbandFilter({"Pac": (0.0, 0.05)}))
+        snapshot = read_snapshot(_store())
+        publisher.publish(snapshot, timeout=5)
+        snapshot['Pac'] += 100
+        publisher.publish(snapshot, timeout=5)
+        snapshot['Pac'] += 1000
+        snapshot['Fac'] += 1
+        publisher.publish(snapshot, timeout=5)
+        self.assertTrue(_wait_for(lambda: len(self.broker.messages) == len(mqttTopics) + 2))
+
+        self.assertEqual([(topic, payload) for topic, payload, _ in self.broker.messages[len(mqttTopics):]],
+                         [("home/solar/AC/power", "1574.8"), ("home/solar/AC/frequency", "50.05")])
+        self.assertEqual((publisher.published, publisher.suppressed), (len(mqttTopics) + 2, 2 * len(mqttTopics) - 2))
+
+    def test_deadband_json(self):
+        publisher = self._publisher(payload="json", deadband=DeadbandFilter())
+        snapshot = read_snapshot(_store())
+        publisher.publish(snapshot)
+        publisher.publish(snapshot)
+        snapshot['Fac'] += 1
+        publisher.publish(snapshot)
+        self.assertTrue(_wait_for(lambda: len(self.broker.messages) == 2))
+
+        # The whole state is published when any field changes
+        self.assertEqual(json.loads(self.broker.messages[1][1])["Pac"], 1464.8)
+        self.assertEqual((publisher.published, publisher.suppressed), (2, 1))
+
+    def test_sink_broker_down(self):
+        # A frame published while the broker is unreachable stays queued, and is sent once it is back
+        with socket.socket() as unused:
+            unused.bind(("127.0.0.1", 0))
+            port = unused.getsockname()[1]
+        publisher = GrowattMqttPublisher("127.0.0.1", port)
+        publisher.client.reconnect_delay_set(min_delay=0.1, max_delay=0.1)
+        publisher.start()
+        self.addCleanup(publisher.stop)
+        sink = Sink("mqtt", lambda key, snapshot: check_published(publisher.publish(snapshot.values())),
+                    policy=COALESCE_LATEST, retry_interval=0.05)
+        sink.start()
+        self.addCleanup(sink.stop)
+
+        sink.submit(b'ABC1D2345E', _store().snapshots.latest())
+        self.assertTrue(_wait_for(lambda: sink.failures >= 2))
+        self.assertEqual((sink.published, len(sink.queue)), (0, 1))
+
+        broker = _Broker(("127.0.0.1", port))
+        thread = threading.Thread(target=broker.serve_forever, args=(0.01,))
+        thread.start()
+        try:
+            self.assertTrue(_wait_for(lambda: len(broker.messages) == len(mqttTopics)))
+            self.assertTrue(_wait_for(lambda: sink.published == 1))
+            self.assertEqual(len(sink.queue), 0)
+        finally:
+            broker.shutdown()
+            broker.server_close()
+            thread.join()
+
+    def test_deadband_broker_down(self):
+        # Fields that could not be sent are not recorded as published
+        with socket.socket() as unused:
+            unused.bind(("127.0.0.1", 0))
+            port = unused.getsockname()[1]
+        publisher = GrowattMqttPublisher("127.0.0.1", port, deadband=DeadbandFilter())
+        publisher.client.reconnect_delay_set(min_delay=0.1, max_delay=0.1)
+        publisher.start()
+        self.addCleanup(publisher.stop)
+        snapshot = read_snapshot(_store())
+        for _ in range(2):
+            infos = publisher.publish(snapshot)
+            self.assertEqual(len(infos), len(mqttTopics))
+            self.assertRaises(IOError, check_published, infos)
+
+        broker = _Broker(("127.0.0.1", port))
+        thread = threading.Thread(target=broker.serve_forever, args=(0.01,))
+        thread.start()
+        try:
+            self.assertTrue(_wait_for(lambda: publisher.connected))
+            check_published(publisher.publish(snapshot))
+            self.assertTrue(_wait_for(lambda: len(broker.messages) == len(mqttTopics)))
+        finally:
+            broker.shutdown()
+            broker.server_close()
+            thread.join()
+
+    def test_invalid_payload(self):
+        with self.assertRaises(ValueError):
+            GrowattMqttPublisher("127.0.0.1", payload="xml")
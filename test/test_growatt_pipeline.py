@@ -0,0 +1,301 @@
+import functools
+import os
+import tempfile
+import threading
+import time
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_datastore import GrowattServerContext, create_slave_context
+from PyGrowatt.growatt_pipeline import SinkQueue, Sink, Pipeline, DROP_OLDEST, COALESCE_LATEST, SPILL, \
+    dump_snapshot, load_snapshot
+from PyGrowatt.growatt_replay import percentile
+from PyGrowatt.growatt_server import GrowattServer
+from PyGrowatt.growatt_simulator import run_fleet
+from PyGrowatt.growatt_snapshot import SnapshotStore
+
+
+def _snapshot(pac):
+    request = Growatt.GrowattEnergyRequest()
+    request.Pac = pac
+    return SnapshotStore().update(request, now=1000.0)
+
+
+def _drain(queue):
+    items = []
+    while True:
+        entry = queue.get(timeout=0)
+        if entry is None:
+            return items
+        items.append(entry)
+
+
+class TestSinkQueue(TestCase):
+    def test_drop_oldest(self):
+        queue = SinkQueue(capacity=3, policy=DROP_OLDEST)
+        results = [queue.put(b'A', value) for value in range(5)]
+        self.assertEqual(results, [True, True, True, False, False])
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual(_drain(queue), [(b'A', 2), (b'A', 3), (b'A', 4)])
+
+    def test_coalesce_latest(self):
+        queue = SinkQueue(capacity=2, policy=COALESCE_LATEST)
+        queue.put(b'A', 1)
+        queue.put(b'B', 1)
+        queue.put(b'A', 2)
+        self.assertEqual((len(queue), queue.coalesced, queue.dropped), (2, 1, 0))
+        self.assertEqual(_drain(queue), [(b'A', 2), (b'B', 1)])
+
+        # A new key evicts the oldest key once the queue is full
+        for key in (b'A', b'B', b'C'):
+            queue.put(key, 3)
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(_drain(queue), [(b'B', 3), (b'C', 3)])
+
+        # Items without a key are never coalesced with each other
+        queue = SinkQueue(policy=COALESCE_LATEST, min_interval=60)
+        for value in (1, 2):
+            queue.put(None, value)
+        queue.put(b'A', 3)
+        self.assertEqual(queue.coalesced, 0)
+        self.assertEqual(_drain(queue), [(None, 1), (None, 2), (b'A', 3)])
+        queue.put(None, 4)
+        self.assertEqual(_drain(queue), [(None, 4)])
+        self.assertEqual(queue._last.keys(), {b'A'})
+
+    def test_requeue(self):
+        queue = SinkQueue(policy=COALESCE_LATEST)
+        queue.put(b'A', 1)
+        queue.put(b'B', 1)
+        queue.requeue(b'C', 0)
+        # A newer item for the key is already queued, so the failed one is dropped
+        queue.requeue(b'A', 0)
+        self.assertEqual(_drain(queue), [(b'C', 0), (b'A', 1), (b'B', 1)])
+
+        queue = SinkQueue(capacity=2)
+        queue.put(b'A', 1)
+        queue.requeue(b'A', 0)
+        queue.requeue(b'A', -1)
+        self.assertEqual(_drain(queue), [(b'A', 0), (b'A', 1)])
+
+    def test_spill(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mqtt.spill")
+            queue = SinkQueue(capacity=2, policy=SPILL, spill_path=path)
+            for pac in range(5):
+                self.assertTrue(queue.put(b'A', _snapshot(pac)))
+            self.assertEqual((len(queue), queue.spilled, queue.dropped), (5, 3, 0))
+
+            # Nothing is lost and the order is kept, even for items put while the spill is being read
+            self.assertEqual(queue.get()[1].Pac, 0)
+            self.assertEqual(queue.get()[1].Pac, 1)
+            queue.put(b'A', _snapshot(5))
+            self.assertEqual([item.Pac for _, item in _drain(queue)], [2, 3, 4, 5])
+            self.assertEqual(os.path.getsize(path), 0)
+
+            # Spilled items survive a restart
+            for pac in range(4):
+                queue.put(b'B', _snapshot(pac))
+            queue._spill.close()
+            queue = SinkQueue(capacity=2, policy=SPILL, spill_path=path)
+            self.assertEqual([(key, item.Pac) for key, item in _drain(queue)], [(b'B', 2), (b'B', 3)])
+            queue._spill.close()
+
+    def test_spill_offset(self):
+        # Items already read from the spill file are not read again after a restart
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mqtt.spill")
+            queue = SinkQueue(capacity=1, policy=SPILL, spill_path=path)
+            for pac in range(5):
+                queue.put(b'A', _snapshot(pac))
+            self.assertEqual([queue.get()[1].Pac for _ in range(3)], [0, 1, 2])
+            queue._spill.close()
+
+            queue = SinkQueue(capacity=1, policy=SPILL, spill_path=path)
+            self.assertEqual(len(queue), 2)
+            self.assertEqual([item.Pac for _, item in _drain(queue)], [3, 4])
+            queue._spill.close()
+
+            # An offset that is not the start of an item is ignored, so nothing is lost
+            with open(path, "wb") as spill:
+                spill.write(dump_snapshot(b'A', _snapshot(5)) + b"\n")
+            with open(path + ".offset", "wb") as offset:
+                offset.write(b"3")
+            queue = SinkQueue(capacity=1, policy=SPILL, spill_path=path)
+            self.assertEqual([item.Pac for _, item in _drain(queue)], [5])
+            queue._spill.close()
+
+    def test_window(self):
+        clock = [100.0]
+        queue = SinkQueue(policy=COALESCE_LATEST, window=1.0, clock=lambda: clock[0])
+        queue.put(b'A', 1)
+        clock[0] = 100.5
+        queue.put(b'B', 1)
+        queue.put(b'A', 2)
+        self.assertIsNone(queue.get(timeout=0))
+
+        # Each key is due a window after its first item, with the latest item
+        clock[0] = 101.0
+        self.assertEqual(_drain(queue), [(b'A', 2)])
+        clock[0] = 101.5
+        self.assertEqual(_drain(queue), [(b'B', 1)])
+
+    def test_min_interval(self):
+        clock = [100.0]
+        queue = SinkQueue(policy=COALESCE_LATEST, min_interval=10.0, clock=lambda: clock[0])
+        queue.put(b'A', 1)
+        queue.put(b'B', 1)
+        self.assertEqual(_drain(queue), [(b'A', 1), (b'B', 1)])
+
+        # A is held until 10 seconds after it was last returned, C has not been returned before
+        clock[0] = 104.0
+        queue.put(b'A', 2)
+        queue.put(b'A', 3)
+        queue.put(b'C', 1)
+        self.assertEqual(_drain(queue), [(b'C', 1)])
+        clock[0] = 110.0
+        self.assertEqual(_drain(queue), [(b'A', 3)])
+
+        # Once the interval has passed, an item is due straight away
+        clock[0] = 125.0
+        queue.put(b'A', 4)
+        self.assertEqual(_drain(queue), [(b'A', 4)])
+
+    def test_window_wakes_consumer(self):
+        queue = SinkQueue(policy=COALESCE_LATEST, window=0.05)
+        start = time.monotonic()
+        queue.put(b'A', 1)
+        self.assertEqual(queue.get(timeout=5), (b'A', 1))
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    def test_window_requires_coalesce(self):
+        with self.assertRaises(ValueError):
+            SinkQueue(policy=DROP_OLDEST, window=1.0)
+
+    def test_spill_requires_path(self):
+        with self.assertRaises(ValueError):
+            SinkQueue(policy=SPILL)
+        with self.assertRaises(ValueError):
+            SinkQueue(policy="drop-newest")
+
+    def test_dump_snapshot(self):
+        snapshot = _snapshot(14648)
+        self.assertEqual(load_snapshot(dump_snapshot(b'ABC1D2345E', snapshot)), (b'ABC1D2345E', snapshot))
+        self.assertEqual(load_snapshot(dump_snapshot(None, snapshot)), (None, snapshot))
+
+    def test_get_timeout_and_close(self):
+        queue = SinkQueue()
+        self.assertIsNone(queue.get(timeout=0.01))
+        threading.Timer(0.05, queue.close).start()
+        self.assertIsNone(queue.get())
+        self.assertTrue(queue.wait_closed(0))
+
+
+class TestSink(TestCase):
+    def test_slow_sink_does_not_block(self):
+        release = threading.Event()
+        fast = []
+        slow = Sink("slow", lambda key, item: release.wait(), capacity=10)
+        pipeline = Pipeline([slow, Sink("fast", lambda key, item: fast.append(item))])
+        pipeline.start()
+        try:
+            timings = []
+            for value in range(1000):
+                start = time.perf_counter()
+                pipeline.submit(b'A', value)
+                timings.append(time.perf_counter() - start)
+            deadline = time.monotonic() + 5
+            while len(fast) < 1000 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            release.set()
+            pipeline.stop(timeout=5)
+
+        self.assertEqual(fast, list(range(1000)))
+        self.assertLessEqual(len(slow.queue), 10)
+        self.assertGreaterEqual(slow.queue.dropped, 1000 - 10 - 1)
+        self.assertLess(max(timings), 0.05)
+
+    def test_retry(self):
+        attempts = []
+
+        def publish(key, item):
+            attempts.append(item)
+            if len(attempts) == 1:
+                raise IOError("broker unavailable")
+
+        sink = Sink("flaky", publish, retry_interval=0.01)
+        sink.start()
+        try:
+            sink.submit(b'A', 1)
+            deadline = time.monotonic() + 5
+            while sink.published < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            sink.stop(timeout=5)
+        self.assertEqual(attempts, [1, 1])
+        self.assertEqual((sink.published, sink.failures), (1, 1))
+
+    def test_latency(self):
+        sink = Sink("test", lambda key, item: None, policy=COALESCE_LATEST, window=0.05)
+        sink.start()
+        try:
+            store = SnapshotStore()
+            request = Growatt.GrowattEnergyRequest()
+            for pac in range(5):
+                request.Pac = pac
+                sink.submit(b'A', store.update(request))
+            deadline = time.monotonic() + 5
+            while sink.published < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            sink.stop(timeout=5)
+        # The burst is published once, a window after the first frame arrived
+        self.assertEqual((sink.published, sink.queue.coalesced), (1, 4))
+        self.assertGreaterEqual(sink.latency, 0.04)
+        self.assertLess(sink.latency, 1.0)
+
+    def test_execute_submits(self):
+        received = []
+        pipeline = Pipeline([Sink("test", lambda key, item: received.append((key, item)))])
+        store = create_slave_context(pipeline=pipeline)
+        request = Growatt.GrowattEnergyRequest()
+        request.wifi_serial = b'ABC1D2345E'
+        request.Pac = 100
+        request.execute(store)
+        key, snapshot = pipeline.sinks[0].queue.get(timeout=0)
+        self.assertEqual((key, snapshot.Pac), (b'ABC1D2345E', 100))
+        self.assertIs(snapshot, store.snapshots.latest())
+
+
+class TestPipelineServer(IsolatedAsyncioTestCase):
+    async def _run(self, pipeline):
+        factory = functools.partial(create_slave_context, pipeline=pipeline)
+        server = GrowattServer(GrowattServerContext(factory=factory), address=("127.0.0.1", 0))
+        await server.start()
+        try:
+            return await run_fleet("127.0.0.1", server.sockets[0].getsockname()[1], 10, rate=50, duration=0.4)
+        finally:
+            await server.stop()
+
+    async def test_throttled_sink_ack_latency(self):
+        baseline = await self._run(None)
+
+        # One sink never returns, the other publishes everything
+        release = threading.Event()
+        published = []
+        pipeline = Pipeline([Sink("stuck", lambda key, item: release.wait(), capacity=5, policy=COALESCE_LATEST),
+                             Sink("fast", lambda key, item: published.append(key))])
+        pipeline.start()
+        try:
+            stats = await self._run(pipeline)
+        finally:
+            release.set()
+            pipeline.stop(timeout=5)
+
+        self.assertEqual((stats.dropped, stats.malformed), (0, 0))
+        self.assertEqual(stats.sent, baseline.sent)
+        self.assertEqual(len(published), 10 * 20)
+        self.assertLessEqual(len(pipeline.sinks[0].queue), 5)
+        # The stuck sink adds nothing to the time to ACK a frame
+        self.assertLess(percentile(stats.latencies, 99), max(5 * percentile(baseline.latencies, 99), 0.05))
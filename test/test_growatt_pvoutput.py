@@ -0,0 +1,235 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+from urllib.parse import parse_qs
+
+from PyGrowatt.growatt_backfill import BackfillRecord
+from PyGrowatt.growatt_pvoutput import PVOutputBatchSink, PVOutputClient, PVOutputError, PVOutputUploader, \
+    StatusSpool, format_status, status_line
+
+
+def _record(hour, minute, eac_today=12, pac=14648):
+    timestamp = int(time.mktime((2020, 12, 12, hour, minute, 0, 0, 0, -1)))
+    return BackfillRecord(timestamp, b'WXY9Z87654', *([0] * (len(BackfillRecord._fields) - 2)))._replace(
+        Eac_today=eac_today, Pac=pac)
+
+
+def _statuses(count):
+    start = time.mktime((2020, 12, 12, 6, 0, 0, 0, 0, -1))
+    return [status_line(start + 300 * i, i * 10, 100) for i in range(count)]
+
+
+class _PVOutputHandler(BaseHTTPRequestHandler):
+    """ A stand-in for the PVOutput API that can inject failures and latency """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        time.sleep(self.server.latency)
+        status = self.server.failures.pop(0) if self.server.failures else 200
+        self.server.requests.append((self.path, dict(self.headers), parse_qs(body), status))
+        reply = b"OK" if status == 200 else b"Bad request"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+
+class _PVOutputTestCase(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _PVOutputHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.failures = []
+        self.server.latency = 0
+        self.server.connections = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def _client(self, timeout=5):
+        client = PVOutputClient("key", 1234, url=self.url, timeout=timeout)
+        self.addCleanup(client.close)
+        return client
+
+    def _uploaded(self):
+        return [status for _, _, body, code in self.server.requests if code == 200
+                for status in body['data'][0].split(";")]
+
+
+class TestPVOutputBatchSink(_PVOutputTestCase):
+    def test_format_status(self):
+        self.assertEqual(format_status(_record(10, 5)), "20201212,10:05,1200,1464.8")
+
+    def test_batch(self):
+        sink = PVOutputBatchSink("key", 1234, url=self.url)
+        self.addCleanup(sink.client.close)
+        sink([_record(10, 0), _record(10, 5, eac_today=13)])
+
+        self.assertEqual(len(self.server.requests), 1)
+        path, headers, body, _ = self.server.requests[0]
+        self.assertEqual(path, "/service/r2/addbatchstatus.jsp")
+        self.assertEqual(headers['X-Pvoutput-Apikey'], "key")
+        self.assertEqual(headers['X-Pvoutput-SystemId'], "1234")
+        self.assertEqual(body['data'], ["20201212,10:00,1200,1464.8;20201212,10:05,1300,1464.8"])
+
+    def test_rejected(self):
+        self.server.failures = [400]
+        sink = PVOutputBatchSink("key", 1234, url=self.url)
+        self.addCleanup(sink.client.close)
+        with self.assertRaises(PVOutputError) as cm:
+            sink([_record(10, 0)])
+        self.assertEqual(cm.exception.status, 400)
+
+
+class TestPVOutputClient(_PVOutputTestCase):
+    def test_keep_alive(self):
+        client = self._client()
+        for _ in range(5):
+            client.add_batch_status(_statuses(1))
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(client.connections, 1)
+
+    def test_reconnect(self):
+        client = self._client()
+        client.add_batch_status(_statuses(1))
+        # Closing the pooled connection (as an idle server would) is recovered from transparently
+        client._connection.sock.close()
+        client.add_batch_status(_statuses(1))
+        self.assertEqual(client.connections, 2)
+
+
+class TestStatusSpool(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "pvoutput.spool")
+
+    def test_consume(self):
+        spool = StatusSpool(self.path)
+        spool.append(_statuses(5))
+        self.assertEqual(spool.pending(2), _statuses(5)[:2])
+        self.assertEqual(len(spool), 5)
+        spool.consume(spool.pending(2))
+        self.assertEqual(spool.pending(), _statuses(5)[2:])
+        self.assertEqual(len(spool), 3)
+        spool.close()
+
+        # The offset survives a restart
+        spool = StatusSpool(self.path)
+        self.assertEqual(len(spool), 3)
+        spool.consume(spool.pending())
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertEqual(len(spool), 0)
+        spool.close()
+
+    def test_partial_line(self):
+        spool = StatusSpool(self.path)
+        spool.append(_statuses(2))
+        spool.close()
+        with open(self.path, "ab") as f:
+            f.write(b"20201212,07")
+
+        spool = StatusSpool(self.path)
+        self.assertEqual(spool.pending(), _statuses(2))
+        self.assertEqual(len(spool), 2)
+        spool.append(_statuses(3)[2:])
+        self.assertEqual(spool.pending(), _statuses(3))
+        self.assertEqual(len(spool), 3)
+        spool.close()
+
+
+class TestPVOutputUploader(_PVOutputTestCase):
+    def setUp(self):
+        _PVOutputTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.spool_path = os.path.join(self.directory, "pvoutput.spool")
+
+    def _uploader(self, client=None, **kwargs):
+        uploader = PVOutputUploader(client or self._client(), self.spool_path, **kwargs)
+        self.addCleanup(uploader.spool.close)
+        return uploader
+
+    def test_batches(self):
+        uploader = self._uploader()
+        for status in _statuses(75):
+            uploader.spool.append([status])
+        self.assertEqual(uploader.flush(), 75)
+        self.assertEqual([len(body['data'][0].split(";")) for _, _, body, _ in self.server.requests], [30, 30, 15])
+        self.assertEqual(self._uploaded(), _statuses(75))
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(uploader), 0)
+
+    def test_add(self):
+        uploader = self._uploader()
+        uploader.add(time.mktime((2020, 12, 12, 10, 0, 0, 0, 0, -1)), 1200, 1464.8)
+        uploader.add_records([_record(10, 5)])
+        uploader.flush()
+        self.assertEqual(self._uploaded(), ["20201212,10:00,1200,1464.8", "20201212,10:05,1200,1464.8"])
+
+    def test_failure_keeps_statuses(self):
+        self.server.failures = [503]
+        uploader = self._uploader()
+        uploader.spool.append(_statuses(40))
+        with self.assertLogs('PyGrowatt.growatt_pvoutput', 'ERROR'):
+            self.assertEqual(uploader.flush(), 0)
+        self.assertEqual(len(uploader), 40)
+
+        # Nothing is lost if the process restarts before the next flush
+        uploader = self._uploader()
+        self.assertEqual(uploader.flush(), 40)
+        self.assertEqual(self._uploaded(), _statuses(40))
+
+    def test_failure_part_way(self):
+        self.server.failures = [200, 500]
+        uploader = self._uploader()
+        uploader.spool.append(_statuses(70))
+        with self.assertLogs('PyGrowatt.growatt_pvoutput', 'ERROR'):
+            self.assertEqual(uploader.flush(), 30)
+        self.assertEqual(uploader.spool.pending(), _statuses(70)[30:])
+        self.assertEqual(uploader.flush(), 40)
+        self.assertEqual(self._uploaded(), _statuses(70))
+
+    def test_bad_request_dropped(self):
+        self.server.failures = [400]
+        uploader = self._uploader(batch_size=10)
+        uploader.spool.append(_statuses(20))
+        with self.assertLogs('PyGrowatt.growatt_pvoutput', 'ERROR'):
+            self.assertEqual(uploader.flush(), 10)
+        self.assertEqual(uploader.rejected, 10)
+        self.assertEqual(len(uploader), 0)
+
+    def test_latency_timeout(self):
+        self.server.latency = 0.2
+        uploader = self._uploader(self._client(timeout=0.05))
+        uploader.spool.append(_statuses(5))
+        with self.assertLogs('PyGrowatt.growatt_pvoutput', 'ERROR'):
+            self.assertEqual(uploader.flush(), 0)
+        self.assertEqual(len(uploader), 5)
+
+    def test_hourly_limit(self):
+        uploader = self._uploader(requests_per_hour=2)
+        uploader.spool.append(_statuses(100))
+        with self.assertLogs('PyGrowatt.growatt_pvoutput', 'WARNING'):
+            self.assertEqual(uploader.flush(now=1000), 60)
+            self.assertEqual(uploader.flush(now=2000), 0)
+        self.assertEqual(uploader.flush(now=4600), 40)
+        self.assertEqual(len(self.server.requests), 4)
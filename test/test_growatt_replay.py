@@ -0,0 +1,63 @@
+import os
+from unittest import TestCase
+
+from PyGrowatt.growatt_datastore import GrowattServerContext
+from PyGrowatt.growatt_replay import GrowattReplay, percentile, read_pcap
+
+SESSION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "captures", "session.pcap")
+
+# The frames sent by the two modules in session.pcap (see benchmarks/make_captures.py)
+SESSION_FRAMES = {0x03: 2, 0x19: 16, 0x16: 10, 0x04: 48, 0x50: 120}
+
+
+class TestReadPcap(TestCase):
+    def test_read(self):
+        segments = read_pcap(SESSION)
+        self.assertEqual({connection for connection, _ in segments},
+                         {(b'\xc0\x00\x02\x0a', 49152), (b'\xc0\x00\x02\x0b', 49153)})
+        # Only the client to server direction, and the retransmitted segments are dropped
+        self.assertEqual(sum(len(payload) for _, payload in segments), 101628)
+
+    def test_other_port(self):
+        self.assertEqual(read_pcap(SESSION, port=502), [])
+
+
+class TestGrowattReplay(TestCase):
+    def test_replay(self):
+        context = GrowattServerContext()
+        stats = GrowattReplay(context).run(read_pcap(SESSION))
+
+        self.assertEqual(stats.counts(), SESSION_FRAMES)
+        self.assertEqual(stats.frames, sum(SESSION_FRAMES.values()))
+        self.assertEqual(stats.errors, 0)
+        self.assertEqual(stats.bytes, 101628)
+
+        # Each module's frames were executed against its own datastore
+        self.assertEqual(len(context.inverters()), 2)
+        inverter = context.get(b'WXY9Z87654')
+        self.assertEqual(len(inverter.context.history), 24)
+
+        percentiles = stats.percentiles()
+        self.assertEqual(sorted(percentiles), sorted(SESSION_FRAMES))
+        for latency in percentiles.values():
+            self.assertEqual(len(latency["decode"]), 3)
+            self.assertLessEqual(latency["execute"][0], latency["execute"][2])
+        self.assertIn("0x50", stats.report())
+
+    def test_throughput(self):
+        # A regression gate rather than a benchmark, so the floor is well below what any machine manages
+        stats = GrowattReplay().run(read_pcap(SESSION), repeat=5)
+        self.assertEqual(stats.frames, 5 * sum(SESSION_FRAMES.values()))
+        self.assertGreater(stats.frames_per_second, 500)
+        self.assertGreater(stats.bytes_per_second, 250000)
+
+
+class TestPercentile(TestCase):
+    def test_percentile(self):
+        values = list(range(100, 0, -1))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertEqual(percentile([5], 90), 5)
+        self.assertIsNone(percentile([], 50))
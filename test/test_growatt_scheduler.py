@@ -0,0 +1,127 @@
+import threading
+from unittest import TestCase
+
+from PyGrowatt.growatt_scheduler import GrowattScheduler
+
+
+class _FakeClock(object):
+    """ A monotonic and wall clock that only move when told to """
+
+    def __init__(self, wall=1600000000.0):
+        self.now = 1000.0
+        self.offset = wall - self.now
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now + self.offset
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class _FakeRandom(object):
+    def __init__(self, value):
+        self.value = value
+
+    def uniform(self, low, high):
+        return low + (high - low) * self.value
+
+
+class TestGrowattScheduler(TestCase):
+    def setUp(self):
+        # 1600000000 is 2020-09-13 12:26:40 UTC, 100 seconds after a 5 minute boundary
+        self.clock = _FakeClock()
+        self.scheduler = GrowattScheduler(clock=self.clock.monotonic, wall_clock=self.clock.time,
+                                          random=_FakeRandom(0.5))
+
+    def _run_until(self, seconds, step=1):
+        for _ in range(int(seconds / step)):
+            self.clock.advance(step)
+            self.scheduler.run_pending()
+
+    def test_aligned(self):
+        runs = []
+        self.scheduler.add(lambda: runs.append(self.clock.time()), 300)
+        self.assertEqual(self.scheduler.next_due(), 1200.0)
+
+        self._run_until(1000)
+        self.assertEqual(runs, [1600000200.0, 1600000500.0, 1600000800.0])
+        self.assertTrue(all(run % 300 == 0 for run in runs))
+
+    def test_unaligned(self):
+        runs = []
+        self.scheduler.add(lambda: runs.append(self.clock.monotonic()), 60, align=False)
+        self.assertEqual(self.scheduler.run_pending(), 1)
+        self._run_until(180)
+        self.assertEqual(runs, [1000.0, 1060.0, 1120.0, 1180.0])
+
+    def test_no_drift(self):
+        # Every run takes 40 seconds, which would add up with a re-armed Timer
+        runs = []
+
+        def upload():
+            runs.append(self.clock.time())
+            self.clock.advance(40)
+
+        job = self.scheduler.add(upload, 300)
+        self._run_until(2700)
+        self.assertEqual(len(runs), 10)
+        self.assertEqual([run % 300 for run in runs], [0] * 10)
+        self.assertEqual(job.skipped, 0)
+
+    def test_overrun_skips(self):
+        runs = []
+
+        def upload():
+            runs.append(self.clock.time())
+            # The second run takes longer than two periods
+            if len(runs) == 2:
+                self.clock.advance(700)
+
+        job = self.scheduler.add(upload, 300)
+        with self.assertLogs('PyGrowatt.growatt_scheduler', 'WARNING'):
+            self._run_until(2000)
+        self.assertEqual(job.skipped, 2)
+        self.assertEqual([run - 1600000000 for run in runs], [200, 500, 1400, 1700, 2000, 2300, 2600])
+
+    def test_jitter(self):
+        runs = []
+        job = self.scheduler.add(lambda: runs.append(self.clock.time()), 300, jitter=10)
+        self.assertEqual(job.due, 1205.0)
+        self._run_until(600)
+        # The jitter delays each run, but is not carried into the next tick
+        self.assertEqual([run - 1600000000 for run in runs], [205, 505])
+
+    def test_failure(self):
+        def fail():
+            raise RuntimeError("PVOutput is down")
+
+        job = self.scheduler.add(fail, 60, align=False)
+        with self.assertLogs('PyGrowatt.growatt_scheduler', 'ERROR'):
+            self._run_until(120)
+        self.assertEqual(job.failures, 3)
+        self.assertEqual(job.tick, 1180.0)
+
+    def test_args(self):
+        runs = []
+        self.scheduler.add(runs.append, 60, args=("store",), align=False)
+        self.scheduler.run_pending()
+        self.assertEqual(runs, ["store"])
+
+    def test_invalid_interval(self):
+        with self.assertRaises(ValueError):
+            self.scheduler.add(print, 0)
+
+    def test_thread(self):
+        scheduler = GrowattScheduler()
+        ran = threading.Event()
+        scheduler.start()
+        try:
+            # A job added after starting wakes the thread up
+            scheduler.add(ran.set, 0.01, align=False)
+            self.assertTrue(ran.wait(5))
+        finally:
+            scheduler.stop(5)
+        self.assertIsNone(scheduler._thread)
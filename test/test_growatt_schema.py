@@ -0,0 +1,110 @@
+import struct
+from unittest import TestCase
+
+from pymodbus.datastore import ModbusSparseDataBlock, ModbusSlaveContext
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_schema import Field, LazySchema, MessageSchema
+
+
+class _Message(object):
+    pass
+
+
+class TestMessageSchema(TestCase):
+    def setUp(self):
+        self.schema = MessageSchema([
+            Field("b", 4, "H", scale=10, register=2),
+            Field("a", 0, "2s"),
+            Field("c", 6, "I", scale=100, register=3),
+            Field("d", 12, "B", register=10),
+        ])
+
+    def test_compile(self):
+        self.assertEqual(self.schema.names, ("a", "b", "c", "d"))
+        self.assertEqual(self.schema.struct.format, ">2s2xHI2xB")
+        self.assertEqual(self.schema.size, 13)
+        self.assertEqual(self.schema.registers(), {"b": 2, "c": 3, "d": 10})
+        self.assertEqual(self.schema.register_runs, [(2, ("b", "c")), (10, ("d",))])
+
+    def test_overlap(self):
+        with self.assertRaises(ValueError):
+            MessageSchema([Field("a", 0, "I"), Field("b", 2, "H")])
+
+    def test_decode_and_pack(self):
+        data = b"AB\xff\xff" + struct.pack(">HI", 1234, 56789) + b"\xff\xff" + b"\x07" + b"trailing"
+        message = _Message()
+        self.schema.decode_into(message, data)
+        self.assertEqual((message.a, message.b, message.c, message.d), (b"AB", 1234, 56789, 7))
+        self.assertEqual(self.schema.unpack(data), {"a": b"AB", "b": 1234, "c": 56789, "d": 7})
+        self.assertEqual(self.schema.pack(message), b"AB\x00\x00" + data[4:10] + b"\x00\x00\x07")
+        self.assertEqual(self.schema.scaled(message), {"a": b"AB", "b": 123.4, "c": 567.89, "d": 7})
+
+    def test_execute(self):
+        block = ModbusSparseDataBlock([0] * 20)
+        store = ModbusSlaveContext(di=block, co=block, hr=block, ir=block, zero_mode=True)
+        message = _Message()
+        message.a, message.b, message.c, message.d = b"AB", 1, 2, 3
+        self.schema.execute(message, store, 4)
+        self.assertEqual(store.getValues(4, 2, 2), [1, 2])
+        self.assertEqual(store.getValues(4, 10, 1), [3])
+
+
+class TestLazySchema(TestCase):
+    def setUp(self):
+        class _LazyMessage(object):
+            pass
+        self.cls = _LazyMessage
+        self.schema = MessageSchema([
+            Field("a", 0, "2s"),
+            Field("b", 4, "H", scale=10, register=2),
+            Field("c", 6, "I", scale=100, register=3),
+        ])
+        self.lazy = LazySchema(self.schema, self.cls, ("a",))
+        self.data = b"AB\xff\xff" + struct.pack(">HI", 1234, 56789)
+
+    def test_decode(self):
+        message = self.cls()
+        self.assertEqual(message.b, 0)
+        self.lazy.decode_into(message, memoryview(self.data))
+        self.assertEqual(vars(message), {"a": b"AB", "_payload": (memoryview(self.data), 0)})
+
+        # The first read unpacks every lazy field
+        self.assertEqual(message.c, 56789)
+        self.assertEqual(vars(message), {"a": b"AB", "b": 1234, "c": 56789, "_unpacked": True})
+        self.assertEqual(self.schema.pack(message), b"AB\x00\x00" + self.data[4:])
+
+    def test_decode_again(self):
+        message = self.cls()
+        self.lazy.decode_into(message, self.data)
+        self.assertEqual(message.b, 1234)
+        self.lazy.decode_into(message, b"CD\x00\x00" + struct.pack(">HI", 1, 2))
+        self.assertEqual((message.a, message.b, message.c), (b"CD", 1, 2))
+
+    def test_writable_payload(self):
+        data = bytearray(self.data)
+        message = self.cls()
+        self.lazy.decode_into(message, data)
+        data[4:6] = b"\x00\x00"
+        self.assertEqual(message.b, 1234)
+
+    def test_short_payload(self):
+        with self.assertRaises(struct.error):
+            self.lazy.decode_into(self.cls(), self.data[:-1])
+
+
+class TestGrowattSchemas(TestCase):
+    def test_register_maps(self):
+        self.assertEqual(Growatt.inputRegisters["inverter_status"], 0)
+        self.assertEqual(Growatt.inputRegisters["Vac1"], 14)
+        self.assertEqual(Growatt.inputRegisters["Epv2_total"], 54)
+        self.assertNotIn("Vac_RS", Growatt.inputRegisters)
+        self.assertEqual(Growatt.holdingRegisters["device_type"], 139)
+        self.assertEqual(Growatt.holdingRegisters["sec"], 171)
+
+    def test_frame_sizes(self):
+        # Every schema must fit within the shortest frame it decodes
+        self.assertLessEqual(Growatt.energySchema.size, 575)
+        self.assertLessEqual(Growatt.bufferedEnergySchema.size, 575)
+        self.assertEqual(Growatt.pingSchema.size, 10)
+        self.assertEqual(Growatt.configResponseSchema.size, 34)
@@ -0,0 +1,133 @@
+import asyncio
+import binascii
+import socket
+import struct
+import threading
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from pymodbus.datastore import ModbusSparseDataBlock, ModbusSlaveContext, ModbusServerContext
+from pymodbus.server.sync import ModbusTcpServer
+
+from PyGrowatt.Growatt import GrowattPingResponse
+from PyGrowatt.growatt_datastore import GrowattServerContext
+from PyGrowatt.growatt_framer import GrowattV6Framer
+from PyGrowatt.growatt_server import GrowattServer, GrowattRequestHandler, growattFunctions
+
+# Ping from "ABC1D2345E", transaction id 2
+PING = binascii.unhexlify("000200060020011606302c4625464773472a7761747447726f7761747447726f77617474477268a5")
+
+
+def _context():
+    input_register = ModbusSparseDataBlock([0] * 100)
+    holding_register = ModbusSparseDataBlock([0] * 100)
+    store = ModbusSlaveContext(hr=holding_register, ir=input_register, zero_mode=True)
+    store.register(0x18, 'h', holding_register)
+    store.register(0x19, 'h', holding_register)
+    return ModbusServerContext(slaves=store, single=True)
+
+
+async def _read_frame(reader):
+    header = await reader.readexactly(6)
+    length = struct.unpack('>HHH', header)[2]
+    return header + await reader.readexactly(length + 2)
+
+
+class TestGrowattServer(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.context = _context()
+        self.server = GrowattServer(self.context, address=("127.0.0.1", 0))
+        await self.server.start()
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        await self.server.stop()
+
+    async def test_ping(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(PING)
+        frame = await asyncio.wait_for(_read_frame(reader), 5)
+
+        # No date has been received, so the ping is answered with a query for all config values
+        tid, pid, length, uid, function_code = struct.unpack('>HHHBB', frame[:8])
+        self.assertEqual((tid, pid, uid, function_code), (2, 6, 1, 0x19))
+
+        self.assertEqual(len(self.server.connections), 1)
+        connection = next(iter(self.server.connections))
+        self.assertEqual(connection.frames_received, 1)
+        self.assertEqual(connection.frames_sent, 1)
+        self.assertEqual(connection.wifi_serial, b'ABC1D2345E')
+
+        writer.close()
+        await writer.wait_closed()
+
+    async def test_split_and_coalesced_frames(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(PING[:10])
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        writer.write(PING[10:] + PING)
+        first = await asyncio.wait_for(_read_frame(reader), 5)
+        second = await asyncio.wait_for(_read_frame(reader), 5)
+        self.assertEqual((first[7], second[7]), (0x19, 0x19))
+        writer.close()
+        await writer.wait_closed()
+
+    async def test_route(self):
+        self.server.context = GrowattServerContext()
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(PING)
+        await asyncio.wait_for(_read_frame(reader), 5)
+        self.assertIsNotNone(self.server.context.get(b'ABC1D2345E'))
+        writer.close()
+        await writer.wait_closed()
+
+    async def test_stop(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(PING)
+        await asyncio.wait_for(_read_frame(reader), 5)
+
+        await self.server.stop()
+        self.assertEqual(await asyncio.wait_for(reader.read(), 5), b'')
+        self.assertEqual(len(self.server.connections), 0)
+        writer.close()
+
+
+class TestGrowattRequestHandler(TestCase):
+    def test_route(self):
+        context = GrowattServerContext()
+        server = ModbusTcpServer(context, GrowattV6Framer, address=("127.0.0.1", 0), handler=GrowattRequestHandler,
+                                 allow_reuse_address=True)
+        for f in growattFunctions:
+            server.decoder.register(f)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            with socket.create_connection(server.server_address, timeout=5) as client:
+                client.sendall(PING)
+                self.assertEqual(client.recv(1024)[7], 0x19)
+            self.assertIsNotNone(context.get(b'ABC1D2345E'))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_should_respond(self):
+        # A response that should not be sent is dropped, as the asyncio server does
+        class Request(object):
+            unit_id = transaction_id = 1
+
+            def __init__(self, should_respond):
+                self.response = GrowattPingResponse()
+                self.response.should_respond = should_respond
+
+            def execute(self, context):
+                return self.response
+
+        handler = GrowattRequestHandler.__new__(GrowattRequestHandler)
+        handler.server = type("Server", (object,), {"context": _context()})()
+        sent = []
+        handler.send = sent.append
+        handler.execute(Request(False))
+        self.assertEqual(sent, [])
+        request = Request(True)
+        handler.execute(request)
+        self.assertEqual(sent, [request.response])
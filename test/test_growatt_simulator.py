@@ -0,0 +1,132 @@
+import asyncio
+import functools
+import os
+import struct
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from pymodbus.factory import ServerDecoder
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_config_cache import ConfigCache
+from PyGrowatt.growatt_datastore import GrowattServerContext, create_slave_context
+from PyGrowatt.growatt_framer import GrowattV6Framer
+from PyGrowatt.growatt_server import GrowattServer, growattFunctions
+from PyGrowatt.growatt_simulator import SimulatedInverter, run_fleet
+
+
+class TestSimulatedInverter(TestCase):
+    def setUp(self):
+        self.inverter = SimulatedInverter(b'SIM0000001', b'INV0000001')
+        decoder = ServerDecoder()
+        for f in growattFunctions:
+            decoder.register(f)
+        self.framer = GrowattV6Framer(decoder)
+
+    def _decode(self, frame):
+        requests = []
+        self.framer.processIncomingPacket(frame, requests.append, [1], single=True)
+        self.assertEqual(len(requests), 1)
+        return requests[0]
+
+    def test_handshake(self):
+        frames = self.inverter.handshake()
+        requests = [self._decode(frame) for frame in frames]
+        self.assertEqual([r.function_code for r in requests], [0x03] + [0x19] * 4 + [0x16])
+        self.assertEqual([r.transaction_id for r in requests], list(range(1, 7)))
+        self.assertIsInstance(requests[0], Growatt.GrowattAnnounceRequest)
+
+    def test_energy(self):
+        frame = self.inverter.energy(pac=12345, now=1609459200)
+        tid, pid, length = struct.unpack(">HHH", frame[:6])
+        self.assertEqual((tid, pid, length, len(frame)), (1, 6, 577, 585))
+        request = self._decode(frame)
+        self.assertIsInstance(request, Growatt.GrowattEnergyRequest)
+
+    def test_query(self):
+        requests = [self._decode(frame) for frame in self.inverter.query(now=1609459200)]
+        self.assertEqual([r.config_id for r in requests], list(range(0x01, 0x20)))
+        self.assertEqual(requests[0x0e - 1].config_value, b'192.0.2.1')
+        self.assertEqual(len(requests[-1].config_value), 19)
+
+    def test_transaction_id_wraps(self):
+        self.inverter.transaction_id = 0xffff
+        self.assertEqual(self.inverter.ping()[:2], b'\x00\x00')
+
+
+class TestRunFleet(IsolatedAsyncioTestCase):
+    async def _serve(self, handler):
+        server = await asyncio.start_server(handler, "127.0.0.1", 0)
+        self.addAsyncCleanup(self._close, server)
+        return server.sockets[0].getsockname()[1]
+
+    @staticmethod
+    async def _close(server):
+        server.close()
+        await server.wait_closed()
+
+    async def test_fleet(self):
+        context = GrowattServerContext()
+        server = GrowattServer(context, address=("127.0.0.1", 0))
+        await server.start()
+        try:
+            stats = await run_fleet("127.0.0.1", server.sockets[0].getsockname()[1], 20, rate=20, duration=0.2)
+        finally:
+            await server.stop()
+
+        self.assertEqual((stats.connections, stats.connect_failures, stats.handshakes), (20, 0, 20))
+        self.assertEqual((stats.dropped, stats.malformed), (0, 0))
+        self.assertEqual(stats.sent, stats.acknowledged)
+        # Six handshake frames, the 31 config values the server queries, then four energy frames from each module
+        self.assertEqual(stats.queries, 20)
+        self.assertEqual(stats.sent, 20 * (6 + 31 + 4))
+        self.assertEqual(len(stats.latencies), stats.acknowledged)
+        self.assertEqual(len(stats.first_energy), 20)
+        self.assertEqual(len(context.inverters()), 20)
+        self.assertIn("0 dropped, 0 malformed", stats.report())
+
+    async def test_fleet_config_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "inverters.jsonl")
+
+            async def run():
+                factory = functools.partial(create_slave_context, config_cache=ConfigCache(path))
+                server = GrowattServer(GrowattServerContext(factory=factory), address=("127.0.0.1", 0))
+                await server.start()
+                try:
+                    return await run_fleet("127.0.0.1", server.sockets[0].getsockname()[1], 5, rate=20,
+                                           duration=0.05)
+                finally:
+                    await server.stop()
+
+            # After a restart the config values come from the cache, so the modules are not queried again
+            first = await run()
+            second = await run()
+        self.assertEqual((first.queries, first.handshakes), (5, 5))
+        self.assertEqual((second.queries, second.handshakes), (0, 5))
+        self.assertEqual((second.dropped, second.malformed), (0, 0))
+        self.assertEqual(second.sent, 5 * (6 + 1))
+
+    async def test_malformed(self):
+        async def handler(reader, writer):
+            header = await reader.readexactly(6)
+            await reader.readexactly(struct.unpack(">HHH", header)[2])
+            # A valid header with a corrupt CRC
+            writer.write(header[:4] + b'\x00\x04\x01\x03\x00\x00\xff\xff')
+
+        port = await self._serve(handler)
+        stats = await run_fleet("127.0.0.1", port, 3, duration=0.1, timeout=1)
+        self.assertEqual((stats.connections, stats.handshakes, stats.sent, stats.malformed), (3, 0, 3, 3))
+
+    async def test_dropped(self):
+        async def handler(reader, writer):
+            await reader.read()
+
+        port = await self._serve(handler)
+        stats = await run_fleet("127.0.0.1", port, 2, duration=0.1, timeout=0.1)
+        self.assertEqual((stats.connections, stats.sent, stats.dropped, stats.acknowledged), (2, 2, 2, 0))
+
+    async def test_connect_failure(self):
+        # Nothing listens on port 1
+        stats = await run_fleet("127.0.0.1", 1, 2, duration=0.1, timeout=1)
+        self.assertEqual((stats.connections, stats.connect_failures), (0, 2))
@@ -0,0 +1,152 @@
+import threading
+from unittest import TestCase, mock
+
+from PyGrowatt import Growatt
+from PyGrowatt.growatt_datastore import create_slave_context, read_snapshot
+from PyGrowatt.growatt_snapshot import EnergySnapshot, SnapshotStore, registerFields, registerCount
+
+
+def _energy(value):
+    # Every register field holds the same value, so a snapshot that mixes two frames is easy to spot
+    request = Growatt.GrowattEnergyRequest()
+    for name in registerFields:
+        setattr(request, name, value)
+    return request
+
+
+class TestSnapshotStore(TestCase):
+    def test_update(self):
+        store = SnapshotStore()
+        self.assertIsNone(store.latest())
+        snapshot = store.update(_energy(7), now=100.0)
+        self.assertIs(store.latest(), snapshot)
+        self.assertEqual((snapshot.sequence, snapshot.received, snapshot.Pac), (0, 100.0, 7))
+        self.assertEqual(snapshot.values(), dict.fromkeys(registerFields, 7))
+        with self.assertRaises(AttributeError):
+            snapshot.Pac = 8
+        with self.assertRaises(AttributeError):
+            snapshot.extra = 8
+
+    def test_registers(self):
+        snapshot = SnapshotStore().update(_energy(3))
+        registers = snapshot.registers()
+        self.assertEqual(len(registers), registerCount)
+        for name, address in Growatt.inputRegisters.items():
+            self.assertEqual(registers[address], 3)
+        self.assertEqual(registers[2], 0)
+
+    def test_since_and_take(self):
+        store = SnapshotStore()
+        self.assertIsNone(store.take())
+        first = store.update(_energy(1))
+        self.assertIs(store.since(0), first)
+        self.assertIsNone(store.since(1))
+        self.assertIs(store.take(), first)
+        self.assertIsNone(store.take())
+
+        # Only the latest snapshot is returned, but a newer one is never lost
+        store.update(_energy(2))
+        third = store.update(_energy(3))
+        self.assertIs(store.take(), third)
+        self.assertIsNone(store.take())
+
+        store.clear()
+        self.assertIsNone(store.latest())
+        self.assertIs(store.take(), None)
+        self.assertEqual(store.update(_energy(4)).sequence, 3)
+
+    def test_slow_writer(self):
+        # A writer that stalls after numbering its snapshot must not replace a newer one
+        store = SnapshotStore()
+        make = EnergySnapshot._make
+        second = threading.Thread(target=store.update, args=(_energy(2),))
+
+        def stall(values):
+            if values[0] == 0:
+                second.start()
+                second.join(0.1)
+            return make(values)
+
+        with mock.patch.object(EnergySnapshot, '_make', stall):
+            store.update(_energy(1))
+            second.join()
+        self.assertEqual((store.latest().sequence, store.latest().Pac), (1, 2))
+
+
+class TestSlaveContextSnapshots(TestCase):
+    def test_execute(self):
+        store = create_slave_context()
+        self.assertIsInstance(_energy(5).execute(store), Growatt.GrowattEnergyResponse)
+        self.assertIsInstance(store.snapshots.latest(), EnergySnapshot)
+        self.assertEqual(read_snapshot(store), dict.fromkeys(registerFields, 5))
+        self.assertEqual(store.getValues(4, Growatt.inputRegisters["Pac"], 2), [5, 0])
+        self.assertEqual(store.getValues(4, registerCount - 1, 3), [5, 0, 0])
+
+        # The input registers themselves are never written
+        self.assertEqual(store.store['i'].getValues(Growatt.inputRegisters["Pac"], 1), [0])
+
+        store.reset()
+        self.assertIsNone(store.snapshots.latest())
+        self.assertEqual(read_snapshot(store), dict.fromkeys(registerFields, 0))
+
+    def test_concurrent_readers(self):
+        store = create_slave_context()
+        _energy(0).execute(store)
+        frames = 5000
+        stop = threading.Event()
+        torn = []
+        reads = [0]
+
+        def write(offset):
+            for value in range(offset, frames, 2):
+                _energy(value).execute(store)
+
+        def read():
+            while not stop.is_set():
+                values = set(read_snapshot(store).values())
+                registers = store.getValues(4, 0, registerCount)
+                values_registers = set(registers[address] for address in Growatt.inputRegisters.values())
+                if len(values) != 1 or len(values_registers) != 1:
+                    torn.append((values, values_registers))
+                reads[0] += 1
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        writers = [threading.Thread(target=write, args=(offset,)) for offset in range(2)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        stop.set()
+        for thread in readers:
+            thread.join()
+
+        self.assertEqual(torn, [])
+        self.assertGreater(reads[0], 0)
+        # Each snapshot is numbered and published at once, so the last one is the newest whatever the interleaving
+        self.assertEqual(store.snapshots.latest().sequence, frames)
+
+    def test_concurrent_take(self):
+        # A single consumer takes each snapshot at most once, and always ends with the last one
+        store = SnapshotStore()
+        frames = 5000
+        taken = []
+        done = threading.Event()
+
+        def consume():
+            while not done.is_set():
+                snapshot = store.take()
+                if snapshot is not None:
+                    taken.append(snapshot.sequence)
+            snapshot = store.take()
+            if snapshot is not None:
+                taken.append(snapshot.sequence)
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        for value in range(frames):
+            store.update(_energy(value))
+        done.set()
+        consumer.join()
+
+        self.assertEqual(taken, sorted(set(taken)))
+        self.assertEqual(taken[-1], frames - 1)